@@ -0,0 +1,184 @@
+import datetime
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from tabulate import tabulate
+from lib import database, hashing
+from lib.decorators import get_retry_count
+from lib.scheduler import WorkerPool
+
+logger = logging.getLogger()
+
+
+class Bench:
+    def __init__(self, config, engine, tapelibrary, tools, local=False):
+        self.config = config
+        self.engine = engine
+        self.tapelibrary = tapelibrary
+        self.tools = tools
+        self.local_files = local
+        self.interrupted = False
+
+    def set_interrupted(self):
+        self.interrupted = True
+
+    def db_profiles(self):
+        """
+        Profiles to compare: SQLite defaults (like before database-tuning) and the configured one. The default profile
+        runs without busy timeout, otherwise the 5 seconds busy timeout of pysqlite absorbs the lock contention and no
+        lock retries are counted.
+        """
+        configured = dict(self.config.get('database-tuning') or {})
+        if configured.get('profile', 'default') == 'default' and not configured.get('pragmas'):
+            configured = {'profile': 'wal', 'pool-size': 16}
+        return [('default', {'profile': 'default', 'pragmas': {'busy_timeout': 0}}),
+                (configured.get('profile'), configured)]
+
+    def db_get_thread(self, engine, thread_id, files):
+        """
+        Same database operations as a get thread for every file: insert, duplicate check, update after download
+        """
+        session = database.create_session(engine)
+        for i in range(files):
+            if self.interrupted:
+                break
+            file = database.insert_file(session, f"file{i}", f"bench/{thread_id}/file{i}")
+            md5 = f"{thread_id:08x}{i:024x}"
+            database.get_file_by_md5(session, md5)
+            database.update_file_after_download(session, file, i, datetime.datetime.now(), datetime.datetime.now(),
+                                                md5)
+        session.close()
+
+    def db_run(self, name, tuning, threads, files):
+        directory = tempfile.mkdtemp(prefix='tapebackup-bench-',
+                                     dir=os.path.dirname(os.path.abspath(self.config['database'])))
+        try:
+            engine = database.connect(f"{directory}/bench.db", tuning)
+            database.create_tables(engine)
+
+            get_retry_count(reset=True)
+            pool = WorkerPool(f"bench-{name}", threads)
+            time_started = time.time()
+            futures = [pool.submit(self.db_get_thread, engine, i, files) for i in range(threads)]
+            pool.wait()
+            duration = time.time() - time_started
+            pool.shutdown()
+            engine.dispose()
+
+            failed = sum(1 for future in futures if future is None or future.cancelled() or future.exception())
+            retries = get_retry_count(reset=True)
+            logger.info(f"Benchmark database profile '{name}': {duration:.2f} seconds, lock retries: {retries}, "
+                        f"failed threads: {failed}")
+            return [name, threads, threads * files, f"{duration:.2f}", f"{threads * files / duration:.0f}", retries,
+                    failed]
+        finally:
+            shutil.rmtree(directory)
+
+    def db(self, threads=8, files=200):
+        """
+        Compare database profiles with concurrent get threads on a temporary database (next to the configured
+        one, so it is on the same filesystem)
+        """
+        table = []
+        for name, tuning in self.db_profiles():
+            logger.info(f"Benchmark database profile '{name}' with {threads} threads, {files} files each")
+            table.append(self.db_run(name, tuning, threads, files))
+            if self.interrupted:
+                break
+
+        print(tabulate(table, headers=['Profile', 'Threads', 'Files', 'Seconds', 'Files/s', 'Lock Retries',
+                                       'Failed Threads'], tablefmt='grid'))
+
+    @staticmethod
+    def md5sum_legacy(path):
+        """
+        md5sum like before the hashing engine: 4 KiB reads, a new bytes object for every read
+        """
+        d = hashlib.md5()
+        with open(path, mode='rb') as f:
+            for buf in iter(lambda: f.read(4096), b''):
+                d.update(buf)
+        return {'md5': d.hexdigest()}
+
+    @staticmethod
+    def drop_cache(paths):
+        """
+        Remove files from page cache (if possible), so they are read from the storage again
+        """
+        for path in paths:
+            with open(path, mode='rb') as f:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def hash_run(self, name, threads, paths, function):
+        self.drop_cache(paths)
+        time_started = time.time()
+        if threads > 1:
+            pool = WorkerPool('bench-hash', threads)
+            futures = [pool.submit(function, path) for path in paths]
+            pool.wait()
+            pool.shutdown()
+            results = [future.result() for future in futures]
+        else:
+            results = [function(path) for path in paths]
+        duration = time.time() - time_started
+        size = sum(os.path.getsize(path) for path in paths)
+        logger.info(f"Benchmark hashing '{name}' with {threads} threads: {duration:.2f} seconds")
+        return [name, threads, self.tools.convert_size(size), f"{duration:.2f}", f"{size / duration / 1e9:.2f}"], \
+            results
+
+    def hash(self, size='1G', files=4):
+        """
+        Compare the old md5sum with the hashing engine on files in local-data-dir (the staging storage). Files are
+        dropped from page cache before every run, so the storage is measured and not the memory.
+        :param size: size of every test file, Number[Unit]
+        :param files: count of test files
+        """
+        hasher = self.tools.hasher
+        digest = hasher.digest or 'sha256'
+        threads = hasher.threads or os.cpu_count() or 1
+        filesize = self.tools.back_convert_size(str(size))
+        directory = tempfile.mkdtemp(prefix='tapebackup-bench-', dir=os.path.abspath(self.config['local-data-dir']))
+        try:
+            logger.info(f"Writing {files} test files of {self.tools.convert_size(filesize)} into {directory}")
+            block = os.urandom(hashing.BLOCK_SIZE)
+            paths = []
+            for i in range(files):
+                path = f"{directory}/file{i}"
+                with open(path, mode='wb') as f:
+                    for offset in range(0, filesize, len(block)):
+                        f.write(block[:filesize - offset])
+                    f.flush()
+                    os.fsync(f.fileno())
+                paths.append(path)
+
+            runs = [
+                ('md5 4 KiB read (before)', 1, self.md5sum_legacy),
+                (f"md5 {self.tools.convert_size(hasher.block_size)} readinto", 1,
+                 lambda path: hashing.hash_file(path, ('md5',), hasher.block_size)),
+                (f"md5 + {digest} readinto", 1,
+                 lambda path: hashing.hash_file(path, ('md5', digest), hasher.block_size)),
+                (f"md5 + {digest} mmap", 1,
+                 lambda path: hashing.hash_file(path, ('md5', digest), hasher.block_size, use_mmap=True)),
+                (f"md5 + {digest} configured", threads,
+                 lambda path: hasher.hash_file(path, ('md5', digest))),
+            ]
+            table = []
+            expected = None
+            for name, run_threads, function in runs:
+                if self.interrupted:
+                    break
+                row, results = self.hash_run(name, run_threads, paths, function)
+                md5sums = [result['md5'] for result in results]
+                if expected is None:
+                    expected = md5sums
+                elif md5sums != expected:
+                    logger.error(f"Benchmark hashing '{name}': md5sum differs from the old implementation")
+                table.append(row)
+
+            print(tabulate(table, headers=['Method', 'Threads', 'Size', 'Seconds', 'GB/s'], tablefmt='grid'))
+        finally:
+            shutil.rmtree(directory)
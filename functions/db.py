@@ -3,7 +3,9 @@ import logging
 import os
 import time
 import shutil
-from lib import database
+import sys
+from lib import database, upgrade
+from functions.files import PARTIAL_DIR
 from lib.migrate import Migrate
 logger = logging.getLogger()
 
@@ -11,6 +13,7 @@ logger = logging.getLogger()
 class Db:
     def __init__(self, config, engine, tapelibrary, tools, local=False):
         self.config = config
+        self.engine = engine
         self.session = database.create_session(engine)
         self.tapelibrary = tapelibrary
         self.tools = tools
@@ -21,10 +24,19 @@ class Db:
         self.interrupted = True
 
     def repair(self):
-        broken_d = database.get_broken_db_download_entry(self.session)
-        for file in broken_d:
+        broken_d = []
+        resumable = 0
+        for file in database.get_broken_db_download_entry(self.session):
+            # Keep files with a partial download, the next get resumes them
+            directory, filename = os.path.split(file.path)
+            if not self.local_files and os.path.isfile(os.path.join(self.config['local-data-dir'], directory,
+                                                                    PARTIAL_DIR, filename)):
+                logger.info(f"Keeping Database ID: {file.id}, partial download will be resumed by next get")
+                resumable += 1
+                continue
             logger.info("Fixing Database ID: {}".format(file.id))
             database.delete_broken_file(self.session, file)
+            broken_d.append(file)
 
         broken_p = database.get_broken_db_encrypt_entry(self.session)
         for file in broken_p:
@@ -64,7 +76,8 @@ class Db:
 
                 if no2all:
                     break
-        logger.info(f"Fixed {len(broken_d)} messed up download entries (Download not finished)")
+        logger.info(f"Fixed {len(broken_d)} messed up download entries (Download not finished), kept {resumable} "
+                    f"resumable partial downloads")
         logger.info(f"Fixed {len(broken_p)} messed up encrypt entries (Encryption not finished)")
         logger.info(f"Deleted {delete_m} 'write to tape' entries with missing files")
 
@@ -262,3 +275,12 @@ class Db:
         # TODO: Need Rework
         #self.database.export(f"{self.config['database-backup-git-path']}/tapebackup-{int(time.time())}.sql")
         ## TODO: Compare to old git and commit if changed
+
+    def upgrade(self, db_version):
+        """
+        Upgrade database model to db_version (e.g. add new indexes), see lib/upgrade.py
+        """
+        logger.info("Starting upgrade of database")
+        if not upgrade.upgrade(self.engine, db_version):
+            logger.error("Upgrade of database failed")
+            sys.exit(1)
@@ -4,15 +4,16 @@ import subprocess
 import os
 import sys
 import time
-import threading
-from lib import database
+from lib import database, cipher, container
+from lib.fingerprint import FingerprintCache
+from lib.scheduler import Scheduler
 from pathlib import Path
 
 logger = logging.getLogger()
 
 
 class Encryption:
-    def __init__(self, config, engine, tapelibrary, tools, local=False):
+    def __init__(self, config, engine, tapelibrary, tools, local=False, scheduler=None):
         self.config = config
         self.engine = engine
         self.session = database.create_session(engine)
@@ -20,54 +21,240 @@ class Encryption:
         self.tools = tools
         self.local_files = local
         self.interrupted = False
-        self.active_threads = []
+        self.scheduler = scheduler if scheduler is not None else Scheduler(config)
+        self.writer = database.get_writer(engine, config)
+        self.fingerprints = FingerprintCache(config, tools.hasher, self.writer)
+        # Encryption engine in use, chosen at first use (see use_python_engine)
+        self.python_engine = None
+
+        container_config = self.config.get('container') or {}
+        self.container_file_size = self.tools.back_convert_size(
+            str(container_config.get('file-size') or container.FILE_SIZE))
+        self.container_size = self.tools.back_convert_size(
+            str(container_config.get('size') or container.CONTAINER_SIZE))
 
     def set_interrupted(self):
         self.interrupted = True
+        self.scheduler.set_interrupted()
+
+    def use_python_engine(self):
+        """
+        Check which encryption engine will be used: 'python' (single pass encrypt + md5sum) or 'openssl'
+        """
+        if self.python_engine is None:
+            self.python_engine = self.config.get('encryption-engine', 'python') == 'python'
+            if self.python_engine and not cipher.available():
+                logger.warning("Python module 'cryptography' not found, falling back to openssl encryption engine")
+                self.python_engine = False
+        return self.python_engine
+
+    def encrypt_file_python(self, src, dst, md5sum_file):
+        """
+        Encrypt file and calculate md5sum of the encrypted file in one pass
+        :return: tuple (success, filesize encrypted, md5sum encrypted)
+        """
+        verify_source = self.config.get('encryption-verify-source', False)
+        try:
+            filesize, md5, md5_plain = cipher.encrypt_file(src, dst, self.config['enc-key'], hash_plain=verify_source)
+        except OSError as e:
+            logger.warning(f"encrypt file failed, file: {src} error: {e}")
+            if os.path.isfile(dst):
+                os.remove(dst)
+            return False, None, None
+
+        if verify_source and md5sum_file is not None and md5_plain != md5sum_file:
+            logger.error(f"md5sum of source file changed since download, file: {src} "
+                         f"(database: {md5sum_file}, now: {md5_plain})")
+            os.remove(dst)
+            return False, None, None
+        return True, filesize, md5
+
+    def encrypt_file_openssl(self, src, dst):
+        """
+        Encrypt file with openssl and read it again to calculate the md5sum
+        :return: tuple (success, filesize encrypted, md5sum encrypted)
+        """
+        command = ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-iter', '100000', '-in', src, '-out', dst, '-k',
+                   self.config['enc-key']]
+        openssl = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
+        if openssl.returncode != 0:
+            logger.warning(f"encrypt file failed, file: {src} error: {openssl.stderr}")
+            return False, None, None
 
-    def encrypt_single_file_thread(self, threadnr, id, filepath, filename_enc):
+        time_started = time.time()
+        md5 = self.tools.md5sum(dst)
+        logger.debug(f"Execution Time: md5sum encrypted file: {time.time() - time_started} seconds")
+        return True, os.path.getsize(dst), md5
+
+    def new_filename_encrypted(self, session):
+        """
+        Create a random encrypted filename which is not used yet
+        """
+        filename_enc = self.tools.create_filename_encrypted()
+        while database.filename_encrypted_already_used(session, filename_enc):
+            logger.warning(f"Filename ({filename_enc}) encrypted already exists, creating new one!")
+            filename_enc = self.tools.create_filename_encrypted()
+        return filename_enc
+
+    def encrypt_single_file_thread(self, id, filepath, filename_enc):
+        """
+        Job which will encrypt a file and update it in database
+        :return: True if encryption succeeded
+        """
         thread_session = database.create_session(self.engine)
         file = database.update_filename_enc(thread_session, id, filename_enc)
 
-        time_started = time.time()
-
         if not self.local_files:
-            command = ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-iter', '100000', '-in',
-                       os.path.abspath(f"{self.config['local-data-dir']}/{filepath}"), '-out',
-                       os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}"), '-k',
-                       self.config['enc-key']]
+            src = os.path.abspath(f"{self.config['local-data-dir']}/{filepath}")
         else:
-            command = ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-iter', '100000', '-in',
-                       os.path.abspath(f"{self.config['local-base-dir']}/{filepath}"), '-out',
-                       os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}"), '-k',
-                       self.config['enc-key']]
-        openssl = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
+            src = os.path.abspath(f"{self.config['local-base-dir']}/{filepath}")
+        dst = os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}")
 
-        if openssl.returncode == 0:
-            logger.debug(f"Execution Time: Encrypt file with openssl: {time.time() - time_started} seconds")
-
-            time_started = time.time()
-            md5 = self.tools.md5sum(os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}"))
-            logger.debug(f"Execution Time: md5sum encrypted file: {time.time() - time_started} seconds")
+        time_started = time.time()
+        if self.use_python_engine():
+            success, filesize, md5 = self.encrypt_file_python(src, dst, file.md5sum_file)
+        else:
+            success, filesize, md5 = self.encrypt_file_openssl(src, dst)
+        logger.debug(f"Execution Time: Encrypt file with {'python' if self.python_engine else 'openssl'}: "
+                     f"{time.time() - time_started} seconds")
 
-            filesize = os.path.getsize(os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}"))
+        if success:
             encrypted_date = datetime.datetime.now()
-            database.update_file_after_encrypt(thread_session, file, filesize, encrypted_date, md5)
+            database.update_file_after_encrypt(thread_session, file, filesize, encrypted_date, md5,
+                                               writer=self.writer)
+            self.tools.storage.add('local-enc-dir', dst, filesize)
+            self.scheduler.record('encrypt', filesize)
 
             if not self.local_files:
                 time_started = time.time()
-                os.remove(os.path.abspath(f"{self.config['local-data-dir']}/{filepath}"))
+                st = os.stat(src)
+                self.fingerprints.forget(thread_session, st)
+                os.remove(src)
+                self.tools.storage.remove('local-data-dir', src, st.st_size)
                 logger.debug(f"Execution Time: Remove file after encryption: {time.time() - time_started} seconds")
-        else:
-            logger.warning(f"encrypt file failed, file: {id} error: {openssl.stderr}")
-            logger.debug(f"Execution Time: Encrypt file with openssl: {time.time() - time_started} seconds")
 
-        self.active_threads.remove(threadnr)
         thread_session.close()
+        return success
+
+    def encrypt_container_thread(self, members, filename_enc):
+        """
+        Job which packs files into one container, encrypts it once and stores the position of every member
+        :param members: list of tuples (file id, relative path, filesize, md5sum_file)
+        :return: list of members which changed since download (not packed), None if encryption failed
+        """
+        thread_session = database.create_session(self.engine)
+        base_dir = self.config['local-base-dir'] if self.local_files else self.config['local-data-dir']
+        reader = container.MemberReader([(file_id, os.path.abspath(f"{base_dir}/{path}"))
+                                         for file_id, path, _, _ in members])
+        dst = os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}")
+
+        time_started = time.time()
+        try:
+            with open(dst, 'wb') as writer:
+                filesize_encrypted, md5, _ = cipher.encrypt_stream(reader, writer, self.config['enc-key'])
+        except OSError as e:
+            logger.warning(f"encrypt container failed, container: {filename_enc} error: {e}")
+            if os.path.isfile(dst):
+                os.remove(dst)
+            thread_session.close()
+            return None
+        finally:
+            reader.close()
+        logger.debug(f"Execution Time: Encrypt container with {len(members)} files: {time.time() - time_started} "
+                     f"seconds")
+
+        # Offsets are only right if every member still is the file which was downloaded
+        expected = {file_id: (filesize, md5sum_file) for file_id, _, filesize, md5sum_file in members}
+        changed = []
+        for file_id, offset, length, md5_plain in reader.positions:
+            filesize, md5sum_file = expected[file_id]
+            if length != filesize or (md5sum_file is not None and md5_plain != md5sum_file):
+                changed.append(file_id)
+        if changed:
+            logger.warning(f"{len(changed)} files changed since download, encrypting container again without them: "
+                           f"{filename_enc}")
+            os.remove(dst)
+            thread_session.close()
+            return [member for member in members if member[0] in changed]
+
+        try:
+            database.insert_container(thread_session, filename_enc, reader.offset, filesize_encrypted, md5,
+                                      datetime.datetime.now(),
+                                      [(file_id, offset, length) for file_id, offset, length, _ in reader.positions])
+        except Exception as e:
+            # Neither the container nor its members are stored, the encrypted container is of no use
+            logger.error(f"Storing container {filename_enc} in database failed: {e}")
+            thread_session.rollback()
+            thread_session.close()
+            os.remove(dst)
+            return None
+        self.tools.storage.add('local-enc-dir', dst, filesize_encrypted)
+        self.scheduler.record('encrypt', filesize_encrypted)
+
+        if not self.local_files:
+            time_started = time.time()
+            for _, path, filesize, _ in members:
+                path = os.path.abspath(f"{base_dir}/{path}")
+                self.fingerprints.forget(thread_session, os.stat(path))
+                os.remove(path)
+                self.tools.storage.remove('local-data-dir', path, filesize)
+            logger.debug(f"Execution Time: Remove files after encryption: {time.time() - time_started} seconds")
+
+        thread_session.close()
+        return []
+
+    def encrypt_container(self, members, filename_enc):
+        """
+        Encrypt a container, members which changed since download are left for encryption as single files
+        :return: False if encryption failed
+        """
+        while members:
+            changed = self.encrypt_container_thread(members, filename_enc)
+            if changed is None:
+                logger.error(f"Encrypting container {filename_enc} failed, its {len(members)} files stay unencrypted")
+                return False
+            if not changed:
+                return True
+            changed = {member[0] for member in changed}
+            members = [member for member in members if member[0] not in changed]
+        return True
+
+    def pack_containers(self):
+        """
+        Pack files smaller than 'container: file-size' into containers of 'container: size' and encrypt them
+        """
+        if self.container_file_size <= 0:
+            return
+        if not self.use_python_engine():
+            logger.warning("Containers need the python encryption engine, small files are encrypted one by one")
+            return
+
+        groups = container.group_files(database.get_files_to_be_encrypted(self.session), self.container_file_size,
+                                       self.container_size)
+        if not groups:
+            return
+        logger.info(f"Packing {sum(len(files) for files in groups)} small files into {len(groups)} containers")
+
+        pool = self.scheduler.pool('encrypt')
+        count = 0
+        for files in groups:
+            count += 1
+            logger.info(f"Queueing container ({count}/{len(groups)}): {len(files)} files, "
+                        f"{self.tools.convert_size(sum(file.filesize for file in files))}")
+            members = [(file.id, file.path, file.filesize, file.md5sum_file) for file in files]
+            pool.submit(self.encrypt_container, members, self.new_filename_encrypted(self.session))
+
+            if self.interrupted:
+                break
+        pool.wait()
+        self.session.expire_all()
 
     def encrypt(self):
         logger.info("Starting encrypt files job")
 
+        self.pack_containers()
+
+        pool = self.scheduler.pool('encrypt')
         while True:
             files = database.get_files_to_be_encrypted(self.session)
 
@@ -79,44 +266,26 @@ class Encryption:
 
             for file in files:
                 file_count_current += 1
-                for i in range(0, self.config['threads']['encrypt']):
-                    if i not in self.active_threads:
-                        next_thread = i
-                        break
-
-                logger.info(f"Starting Thread #{next_thread}, processing ({file_count_current}/{file_count_total}): "
+                logger.info(f"Queueing file ({file_count_current}/{file_count_total}): "
                             f"id: {file.id}, filename: {file.filename}")
 
-                filename_enc = self.tools.create_filename_encrypted()
-                while database.filename_encrypted_already_used(self.session, filename_enc):
-                    logger.warning(f"Filename ({filename_enc}) encrypted already exists, creating new one!")
-                    filename_enc = self.tools.create_filename_encrypted()
-
-                self.active_threads.append(next_thread)
-                x = threading.Thread(target=self.encrypt_single_file_thread,
-                                     args=(next_thread, file.id, file.path, filename_enc,),
-                                     daemon=True)
-                x.start()
-
-                while threading.active_count() > self.config['threads']['encrypt']:
-                    time.sleep(0.2)
+                filename_enc = self.new_filename_encrypted(self.session)
+                pool.submit(self.encrypt_single_file_thread, file.id, file.path, filename_enc)
 
                 if self.interrupted:
-                    while threading.active_count() > 1:
-                        time.sleep(1)
                     break
 
+            ## Multithreading fix: Wait for all jobs to finish, otherwise one file get encrypted twice!
+            pool.wait()
+            if self.writer is not None:
+                self.writer.barrier()
+
             if self.interrupted:
-                while threading.active_count() > 1:
-                    time.sleep(1)
                 break
 
-            ## Multithreading fix: Wait for all threads to finish, otherwise one file get encrypted twice!
-            while threading.active_count() > 1:
-                time.sleep(1)
-
     # src relative to tape, dst relative to restore-dir
-    def decrypt_relative(self, src, dst, mkdir=False):
+    # offset and length: only decrypt this part of the plaintext (member of a container)
+    def decrypt_relative(self, src, dst, mkdir=False, offset=None, length=None):
         if 'restore-dir' not in self.config:
             logging.error('"restore-dir" not configured')
             sys.exit(1)
@@ -132,8 +301,33 @@ class Encryption:
         if mkdir:
             dst_path.parent.mkdir(parents=True, exist_ok=True)
 
+        if offset is not None:
+            return self.decrypt_range(src_path.resolve(), dst_path.resolve(), offset, length)
         return self.decrypt(src_path.resolve(), dst_path.resolve())
 
+    def decrypt_range(self, src, dst, offset, length):
+        """
+        Decrypt a member of a container, only its part of the container is read
+        """
+        if not isinstance(dst, Path):
+            dst = Path(dst)
+        if dst.is_file():
+            logger.error(f'File {dst} already exists, skipping decrypt')
+            return True
+        if not cipher.available():
+            logger.error("Restoring files from containers needs the python module 'cryptography'")
+            return False
+
+        try:
+            with open(src, 'rb') as reader, open(dst, 'wb') as writer:
+                cipher.decrypt_range(reader, writer, self.config['enc-key'], offset, length)
+            return True
+        except (OSError, ValueError) as e:
+            logging.error(f'Decryption failed: {e}')
+            if dst.is_file():
+                dst.unlink()
+            return False
+
     def decrypt(self, src, dst):
         if not isinstance(dst, Path):
             dst = Path(dst)
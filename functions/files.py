@@ -1,21 +1,35 @@
 import datetime
+import errno
+import heapq
 import logging
+import queue
 import time
 import os
-import shutil
+import select
+import shlex
+import stat
 import sys
 import subprocess
+import tempfile
 import threading
 from tabulate import tabulate
-from lib import database
+from lib import cipher, database, hashing, inotify, scan
 from lib.tools import Tools
+from lib.scheduler import Scheduler
+from lib.fingerprint import FingerprintCache
+from lib.md5index import Md5Index
 from lib.models import File, Tape, RestoreJob, RestoreJobFileMap
 
 logger = logging.getLogger()
 
+RSYNC_OUT_PREFIX = 'TAPEBACKUP-DONE:'
+
+## rsync --partial-dir (relative to the directory of every file), interrupted downloads are resumed from here
+PARTIAL_DIR = '.tapebackup-partial'
+
 
 class Files:
-    def __init__(self, config, engine, tapelibrary, tools, local=False):
+    def __init__(self, config, engine, tapelibrary, tools, local=False, scheduler=None):
         self.config = config
         self.engine = engine
         self.session = database.create_session(engine)
@@ -26,203 +40,1026 @@ class Files:
         self.downloaded_count = 0
         self.skipped_count = 0
         self.failed_count = 0
+        # get-scan-directories: state of remote directories, file counts and directories with not registered files
+        self.directory_state = None
+        self.directory_file_counts = {}
+        self.incomplete_directories = set()
         self.deleted_count = 0
-        self.active_threads = []
+        # Relative paths of files with a queued or running download job
+        self.pending_downloads = set()
+        self.scheduler = scheduler if scheduler is not None else Scheduler(config)
+        self.writer = database.get_writer(engine, config)
+        # md5sum -> file id of all downloaded files, loaded at start of get, files of this run are added
+        self.md5_index = Md5Index()
+        # Digests of local files by device, inode, size and mtime, so unchanged files are not hashed again
+        self.fingerprints = FingerprintCache(config, tools.hasher, self.writer)
+        self.precheck_duplicates_enabled = bool(self.config.get('get-precheck-duplicates', False))
+        # Download and encrypt in one pass, no plaintext in local-data-dir
+        self.stream_encrypt = bool(self.config.get('get-stream-encrypt', False)) and not local
+        # Called with file id and filesize of every newly downloaded (not duplicate) file, used by pipeline
+        self.on_downloaded = None
+        # Same for files which are encrypted while downloading (get-stream-encrypt), with the encrypted filesize
+        self.on_encrypted = None
 
     def set_interrupted(self):
         self.interrupted = True
+        self.scheduler.set_interrupted()
 
-    def get_remote_filelist(self):
-        return_list = []
-        count = 0
+    def remote_find(self, name, paths, find_options=''):
+        """
+        Start one find call on the remote server, the process is started right away (so several can run at the same
+        time), the returned generator yields all files as scan.Entry (path, size, mtime), sorted by path
+        ('LC_ALL=C sort'). The records are NUL separated, so any character in a filename is possible.
+        :param name: name of this scan for logging
+        :param paths: remote directories to search in
+        :param find_options: additional options for find (before -type f)
+        """
+        find = f"find {' '.join(shlex.quote(path) for path in paths)} {find_options} -type f " \
+               f"-printf '{scan.FIND_PRINTF}'"
+        return self.start_remote_listing(name, find)
+
+    def remote_find_directories(self, name, directories):
+        """
+        Like remote_find, but lists only the files directly in the given directories. The directories are sent on
+        stdin (xargs), so there is no limit for their count.
+        """
+        if not directories:
+            return iter(())
+        # -r: without any directory find would list the login directory of the remote user
+        find = f"find \"$@\" -mindepth 1 -maxdepth 1 -type f -printf '{scan.FIND_PRINTF}'"
+        return self.start_remote_listing(name, f"xargs -0 -r sh -c {shlex.quote(find)} sh",
+                                         b'\0'.join(directory.encode('utf-8') for directory in directories))
+
+    def start_remote_listing(self, name, command, stdin=None):
+        """
+        Start a (remote) command which prints scan.FIND_PRINTF records, its output gets sorted by path
+        :param stdin: bytes sent to stdin of the command
+        """
+        commands = self.tools.ssh_command() + [self.config['remote-server'],
+                                               self.tools.sorted_shell_command(command, "-z -t ' ' -k3")]
+        stderr = tempfile.TemporaryFile()
         time_started = time.time()
+        process = subprocess.Popen(commands, stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=stderr)
+        # Sorting needs the whole output of find, so the first output marks the end of the scan on remote server.
+        # It's taken in a thread of its own, several listings are merged and read one after another.
+        time_scanned = []
+        threading.Thread(target=self.wait_remote_output, args=(process.stdout, time_scanned),
+                         name=f"scan-{name}", daemon=True).start()
+        if stdin is not None:
+            # The remote side sorts, so it doesn't write any output before stdin is closed
+            process.stdin.write(stdin)
+            process.stdin.close()
+        return self.read_remote_find(name, process, stderr, time_started, time_scanned)
 
-        logger.info(f"Retrieving file list from server {self.config['remote-server']} directory {self.config['remote-data-dir']}")
-        commands = ['ssh', self.config['remote-server'], f"find \"{self.config['remote-data-dir']}\" -type f"]
-        process = subprocess.Popen(commands, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        while True:
-            output = process.stdout.readline().strip().decode("UTF-8")
-            if output == '' and process.poll() is not None:
-                break
-            if output:
+    @staticmethod
+    def wait_remote_output(stdout, time_scanned):
+        """
+        Append the time when output (or EOF) of a listing is available, without reading it
+        """
+        select.select([stdout], [], [])
+        time_scanned.append(time.time())
+
+    def read_remote_find(self, name, process, stderr, time_started, time_scanned):
+        count = 0
+        time_first = None
+        completed = False
+        try:
+            for record in scan.iter_records(process.stdout):
+                if time_first is None:
+                    time_first = time.time()
                 count += 1
-                return_list.append(output)
-                if count % 10000 == 0:
-                    logger.info(f"Entries found until now: {count}")
-        rc = process.poll()
+                yield scan.parse_find_record(record)
+            completed = True
+        finally:
+            # Reading was stopped early (e.g. interrupted)
+            if not completed and process.poll() is None:
+                process.kill()
+            rc = process.wait()
+            stderr.seek(0)
+            error = stderr.read()
+            stderr.close()
 
         if rc != 0:
-            logger.error(f"Failed to retrieve filelist from remote server, error: {process.stderr}")
-            logger.debug(f"Execution Time: Building filelist: {time.time() - time_started} seconds")
+            logger.error(f"Failed to retrieve filelist ({name}) from remote server, error: {error}")
+            logger.debug(f"Execution Time: Building filelist ({name}): {time.time() - time_started} seconds")
+            sys.exit(1)
+        time_first = min(time_scanned + [time_first or time.time()])
+        logger.info(f"Scan of {name} finished: {count} entries, scan took {time_first - time_started:.1f} seconds")
+        logger.debug(f"Execution Time: Building filelist ({name}): {time.time() - time_started} seconds")
+
+    def remote_top_level_dirs(self):
+        """
+        Get all directories directly in remote-data-dir
+        """
+        command = f"find {shlex.quote(self.config['remote-data-dir'])} -mindepth 1 -maxdepth 1 -type d -printf '%p\\0'"
+        process = subprocess.run(self.tools.ssh_command() + [self.config['remote-server'], command],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            logger.error(f"Failed to retrieve directories from remote server, error: {process.stderr}")
             sys.exit(1)
+        return sorted(record.decode('utf-8') for record in process.stdout.split(b'\0') if record)
+
+    def remote_directories(self):
+        """
+        Get all directories below remote-data-dir (including itself) with their mtime
+        :return: dict absolute path -> mtime in nanoseconds
+        """
+        time_started = time.time()
+        command = f"find {shlex.quote(self.config['remote-data-dir'])} -type d -printf '%T@ %p\\0'"
+        process = subprocess.run(self.tools.ssh_command() + [self.config['remote-server'], command],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            logger.error(f"Failed to retrieve directories from remote server, error: {process.stderr}")
+            sys.exit(1)
+        directories = {}
+        for record in process.stdout.split(b'\0'):
+            if record:
+                mtime, path = record.decode('utf-8').split(' ', 1)
+                directories[path] = scan.parse_mtime_ns(mtime)
+        logger.debug(f"Execution Time: Retrieving {len(directories)} directories: {time.time() - time_started} "
+                     f"seconds")
+        return directories
+
+    def get_remote_filelist_incremental(self, base_dir):
+        """
+        List only directories which changed since the last complete run (get-scan-directories). If the mtime of a
+        directory is unchanged, no file was added, removed or renamed directly in it, so it isn't listed again and
+        the files from database are kept. Changes of the content of a file in such a directory are not detected.
+        :return: tuple (generator over scan.Entry, set of unchanged relative directories)
+        """
+        time_started = time.time()
+        logger.info(f"Retrieving directories from server {self.config['remote-server']} directory "
+                    f"{self.config['remote-data-dir']}")
+        remote = self.remote_directories()
+        stored = database.get_directories(self.session)
+
+        self.directory_state = {}
+        unchanged = set()
+        changed = []
+        for path, mtime_ns in remote.items():
+            relpath = self.tools.strip_base_path(path, base_dir)
+            self.directory_state[relpath] = mtime_ns
+            if relpath in stored and stored[relpath][0] == mtime_ns:
+                unchanged.add(relpath)
+                self.directory_file_counts[relpath] = stored[relpath][1]
+            else:
+                changed.append(path)
+
+        if not stored:
+            logger.info("No directory state from a previous complete run, listing all files")
+            listing = self.get_remote_filelist()
+            unchanged = set()
         else:
-            logger.info(f"Got file list from server {self.config['remote-server']} directory '{self.config['remote-data-dir']}'")
-            logger.info(f"Entries found: {count}")
-            logger.debug(f"Execution Time: Building filelist: {time.time() - time_started} seconds")
-            return return_list
+            logger.info(f"Directories: {len(remote)}, changed or new: {len(changed)}, unchanged: {len(unchanged)} "
+                        f"(files reused from database: "
+                        f"{sum(self.directory_file_counts[d] or 0 for d in unchanged)})")
+            shards = min(int(self.config.get('get-scan-shards') or 1), len(changed))
+            listing = heapq.merge(*[self.remote_find_directories(f"changed directories {i + 1}/{shards}",
+                                                                  changed[i::shards]) for i in range(shards)],
+                                  key=lambda e: e.path)
+        logger.debug(f"Execution Time: Compare directories: {time.time() - time_started} seconds")
+        return listing, unchanged
+
+    def save_directory_state(self, time_started):
+        """
+        Store directory state after a complete run. Directories with files which are not in database yet (failed or
+        skipped downloads) and directories modified shortly before the scan (mtime granularity, clock skew) are
+        stored without mtime, so they are listed again next time.
+        """
+        not_before = int((time_started - 60) * 1000000000)
+        directories = []
+        for relpath, mtime_ns in self.directory_state.items():
+            if relpath in self.incomplete_directories or mtime_ns >= not_before:
+                mtime_ns = None
+            directories.append({'path': relpath, 'mtime_ns': mtime_ns,
+                                'file_count': self.directory_file_counts.get(relpath, 0)})
+        database.replace_directories(self.session, directories)
+        logger.info(f"Stored state of {len(directories)} directories for next run")
+
+    def get_remote_filelist(self):
+        """
+        Generator over all files on the remote server as scan.Entry (path, size, mtime), sorted by path
+        ('LC_ALL=C sort').
+
+        With get-scan-shards > 1 the top level directories are split into shards which are scanned by concurrent
+        find calls (over the same multiplexed ssh connection), the sorted outputs are merged into one stream.
+        """
+        count = 0
+        time_started = time.time()
+        data_dir = self.config['remote-data-dir']
+        shards = int(self.config.get('get-scan-shards') or 1)
+
+        logger.info(f"Retrieving file list from server {self.config['remote-server']} directory {data_dir}")
+        if shards > 1:
+            directories = self.remote_top_level_dirs()
+            shards = min(shards, len(directories))
+            streams = [self.remote_find('top level files', [data_dir], '-maxdepth 1')]
+            for i in range(shards):
+                shard = directories[i::shards]
+                logger.debug(f"Scan shard {i + 1}/{shards}: {len(shard)} directories: {shard}")
+                streams.append(self.remote_find(f"shard {i + 1}/{shards}", shard))
+            logger.info(f"Scanning {len(directories)} directories in {shards} shards")
+        else:
+            streams = [self.remote_find('all', [data_dir])]
+
+        for entry in heapq.merge(*streams, key=lambda e: e.path):
+            count += 1
+            yield entry
+            if count % 10000 == 0:
+                logger.info(f"Entries found until now: {count}")
+
+        logger.info(f"Got file list from server {self.config['remote-server']} directory '{data_dir}'")
+        logger.info(f"Entries found: {count}")
+        logger.debug(f"Execution Time: Building filelist: {time.time() - time_started} seconds")
 
     def get_remote_filelist_fom_file(self, file):
-        with open(file) as f:
-            lines = f.read().splitlines()
-        return lines
+        """
+        Read a file list: one path per line (size and mtime unknown) or NUL separated records of
+        find -printf '%s %T@ %p\\0'
+        :return: list of scan.Entry
+        """
+        with open(file, 'rb') as f:
+            content = f.read()
+        if b'\0' in content:
+            return [scan.parse_find_record(record.decode('utf-8')) for record in content.split(b'\0') if record]
+        return [scan.Entry(line.strip()) for line in content.decode('utf-8').splitlines() if line.strip() != ""]
+
+    def register_download(self, thread_session, file):
+        """
+        Build md5sum, mtime and filesize of a downloaded (or local) file and store it in database
+        """
+        time_started = time.time()
+        if self.local_files:
+            path = os.path.abspath(f"{self.config['local-base-dir']}/{file.path}")
+        else:
+            path = os.path.abspath(f"{self.config['local-data-dir']}/{file.path}")
+        st = os.stat(path)
+        mtime = datetime.datetime.fromtimestamp(int(st.st_mtime))
+        filesize = st.st_size
+        hashes = self.fingerprints.hash_file(thread_session, path, st)
+        md5 = hashes['md5']
+        digest_algorithm = self.tools.hasher.digest
+
+        logger.debug(f"Execution Time: Building md5sum and mtime: {time.time() - time_started} seconds")
+        self.scheduler.record('get', filesize)
+
+        downloaded_date = datetime.datetime.now()
+        if not self.local_files:
+            self.tools.storage.add('local-data-dir', path, filesize)
+        duplicate_id = self.md5_index.get_or_add(md5, file.id)
+        if duplicate_id is None:
+            database.update_file_after_download(thread_session, file, filesize, mtime, downloaded_date, md5,
+                                                hashes.get(digest_algorithm), digest_algorithm, writer=self.writer)
+            self.downloaded_count += 1
+            logger.debug("Download finished: {}".format(file.path))
+            if self.on_downloaded is not None:
+                self.on_downloaded(file.id, filesize)
+        else:
+            logger.info(f"File downloaded with another name. Storing filename in Database: {file.filename}")
+            database.update_duplicate_file_after_download(thread_session, file, duplicate_id, mtime, downloaded_date,
+                                                          writer=self.writer)
+            if not self.local_files:
+                time_started = time.time()
+                self.fingerprints.forget(thread_session, st)
+                os.remove(path)
+                self.tools.storage.remove('local-data-dir', path, filesize)
+                logger.debug(f"Execution Time: Remove duplicate file: {time.time() - time_started} seconds")
+            self.skipped_count += 1
+
+    def remote_xargs(self, base_dir, relpaths, command):
+        """
+        Run a command with xargs for a list of files on the remote server with one ssh call. The paths (relative to
+        base_dir) are sent NUL separated on stdin, the command must separate its output records with NUL.
+        :return: list of output records, files which fail (e.g. vanished) are missing
+        """
+        remote_command = f"cd {shlex.quote(base_dir)} && xargs -0 {command} --"
+        process = subprocess.run(self.tools.ssh_command() + [self.config['remote-server'], remote_command],
+                                 input=b'\0'.join(relpath.encode('utf-8') for relpath in relpaths),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # xargs returns 123 if the command failed for some files
+        if process.returncode not in (0, 123):
+            logger.warning(f"Remote command '{command}' failed, rc: {process.returncode} error: {process.stderr}")
+        return [record.decode('utf-8') for record in process.stdout.split(b'\0') if record]
+
+    def precheck_duplicates(self, thread_session, entries, base_dir):
+        """
+        Find duplicates before download (get-precheck-duplicates): take remote size from listing (or get it with one
+        ssh call if unknown), build remote md5sum only of files with a size which is already known and look it up in
+        the md5 index. Duplicates are inserted into database without transfer.
+        :param entries: scan.Entry with relative file paths (relative to base_dir)
+        :return: entries which still need to be downloaded
+        """
+        time_started = time.time()
+        stats = {entry.path: (entry.size, entry.mtime) for entry in entries if entry.size is not None}
+        unknown = [entry.path for entry in entries if entry.size is None]
+        if unknown:
+            for record in self.remote_xargs(base_dir, unknown, "stat --printf='%s %Y %n\\0'"):
+                size, mtime, relpath = record.split(' ', 2)
+                stats[relpath] = (int(size), int(mtime))
+        relpaths = [entry.path for entry in entries]
+
+        sizes = list({size for size, _ in stats.values()})
+        known_sizes = set()
+        for i in range(0, len(sizes), 500):
+            known_sizes |= database.get_known_filesizes(thread_session, sizes[i:i + 500])
+
+        candidates = [relpath for relpath in relpaths if relpath in stats and stats[relpath][0] in known_sizes]
+        md5sums = {}
+        if candidates:
+            # Output of md5sum -z: "<md5sum>  <path>"
+            for record in self.remote_xargs(base_dir, candidates, "md5sum -z"):
+                md5sums[record[34:]] = record[:32]
+
+        remaining = []
+        duplicates = []
+        for entry in entries:
+            duplicate_id = self.md5_index.get(md5sums[entry.path]) if entry.path in md5sums else None
+            if duplicate_id is None:
+                remaining.append(entry)
+            else:
+                duplicates.append((entry.path, duplicate_id))
+
+        if duplicates:
+            files = database.insert_files(thread_session, [(self.tools.strip_path(relpath), relpath)
+                                                           for relpath, _ in duplicates])
+            downloaded_date = datetime.datetime.now()
+            for file, (relpath, duplicate_id) in zip(files, duplicates):
+                logger.info(f"File already exists with another name (id: {duplicate_id}), storing filename in "
+                            f"database without download: {relpath}")
+                mtime = datetime.datetime.fromtimestamp(int(stats[relpath][1]))
+                database.update_duplicate_file_after_download(thread_session, file, duplicate_id, mtime,
+                                                              downloaded_date, writer=self.writer)
+            self.skipped_count += len(duplicates)
+
+        logger.debug(f"Execution Time: Duplicate check before download of {len(relpaths)} files (size matches: "
+                     f"{len(candidates)}, duplicates: {len(duplicates)}): {time.time() - time_started} seconds")
+        return remaining
 
-    def get_thread(self, threadnr, relpath, fullpath):
+    def get_thread(self, entry, fullpath):
         """
-        Thread which will download and insert file into database
-        :param threadnr: thread number
-        :param relpath: relative file path
+        Job which will download and insert file into database
+        :param entry: scan.Entry with relative file path
         :param fullpath: absolut filepath on the remote server (Or local absolut filepath)
         :return:
         """
+        relpath = entry.path
         downloaded = False
         filename = self.tools.strip_path(fullpath)
-        directory = self.tools.strip_filename(relpath)
         thread_session = database.create_session(self.engine)
 
+        if self.precheck_duplicates_enabled and not self.local_files and \
+                not self.precheck_duplicates(thread_session, [entry], self.config['remote-base-dir']):
+            thread_session.close()
+            return False
+
         file = database.insert_file(thread_session, filename, relpath)
         logger.debug("Inserting file into database. Fileid: {}".format(file.id))
 
-        if not self.local_files:
+        try:
+            if self.stream_encrypt:
+                self.stream_file(thread_session, file, fullpath)
+                return
+
+            if not self.local_files:
+                downloaded = self.download_file(thread_session, file, fullpath)
+
+            if self.local_files or downloaded:
+                self.register_download(thread_session, file)
+        finally:
+            thread_session.close()
+
+    def partial_path(self, relpath):
+        """
+        Path of the partial download of a file (rsync --partial-dir)
+        """
+        directory, filename = os.path.split(relpath)
+        return os.path.join(self.config['local-data-dir'], directory, PARTIAL_DIR, filename)
+
+    def record_partial(self, thread_session, file):
+        """
+        Store size of the partial download of a failed or interrupted transfer, it is resumed by the next get
+        """
+        try:
+            partial_size = os.path.getsize(self.partial_path(file.path))
+        except OSError:
+            partial_size = None
+        database.update_partial_size(thread_session, file, partial_size, writer=self.writer)
+        if partial_size:
+            logger.info(f"Partial download kept ({self.tools.convert_size(partial_size)}), resuming it with next "
+                        f"get: {file.path}")
+
+    def download_file(self, thread_session, file, fullpath):
+        """
+        Download one file with rsync, an existing partial download of it is continued
+        :return: True if downloaded
+        """
+        directory = self.tools.strip_filename(file.path)
+        try:
+            os.makedirs(f"{self.config['local-data-dir']}/{directory}", exist_ok=True)
+        except OSError as e:
+            logger.error(f"Failed to create local folder ({self.config['local-data-dir']}/{directory}), exiting: {e.errno}: {e.strerror}")
+            self.interrupted = True
+            return False
+
+        time_started = time.time()
+        command = ['rsync', '--protect-args', '-ae', self.tools.ssh_command_string(), f"--partial-dir={PARTIAL_DIR}",
+                   f"{self.config['remote-server']}:{fullpath}", f"{self.config['local-data-dir']}/{directory}"]
+        rsync = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
+        logger.debug(f"Execution Time: Downloading file: {time.time() - time_started} seconds")
+        if rsync.returncode == 0:
+            return True
+
+        logger.warning("Download failed, file: {} error: {}".format(file.path, rsync.stderr))
+        self.failed_count += 1
+        self.incomplete_directories.add(scan.parent(file.path))
+        self.record_partial(thread_session, file)
+        return False
+
+    def new_filename_encrypted(self, session):
+        """
+        Create a random encrypted filename which is not used yet
+        """
+        filename_enc = self.tools.create_filename_encrypted()
+        while database.filename_encrypted_already_used(session, filename_enc):
+            logger.warning(f"Filename ({filename_enc}) encrypted already exists, creating new one!")
+            filename_enc = self.tools.create_filename_encrypted()
+        return filename_enc
+
+    def stream_file(self, thread_session, file, fullpath):
+        """
+        Download a file with 'ssh cat' and encrypt it while it is transferred (get-stream-encrypt). The plaintext is
+        hashed on the way, only the encrypted file is written to local-enc-dir. The file is stored as downloaded and
+        encrypted in one step.
+        :return: True if the file was transferred (also if it is a duplicate)
+        """
+        filename_enc = self.new_filename_encrypted(thread_session)
+        database.update_filename_enc(thread_session, file.id, filename_enc)
+        dst = os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}")
+
+        time_started = time.time()
+        remote_path = shlex.quote(fullpath)
+        # First line: size and mtime, afterwards the content. The size shows if the file changed while reading it.
+        command = self.tools.ssh_command() + [self.config['remote-server'],
+                                              f"stat -c '%s %Y' -- {remote_path} && exec cat -- {remote_path}"]
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, preexec_fn=os.setpgrp)
+            reader = hashing.HashingReader(process.stdout, self.tools.hasher.algorithms())
+            error = None
             try:
-                os.makedirs(f"{self.config['local-data-dir']}/{directory}", exist_ok=True)
-            except OSError as e:
-                logger.error(f"Failed to create local folder ({self.config['local-data-dir']}/{directory}), exiting: {e.errno}: {e.strerror}")
-                self.interrupted = True
-                return False
-
-            time_started = time.time()
-            command = ['rsync', '--protect-args', '-ae', 'ssh', f"{self.config['remote-server']}:{fullpath}",
-                       f"{self.config['local-data-dir']}/{directory}"]
-            rsync = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
-            if rsync.returncode == 0:
-                downloaded = True
-            else:
-                logger.warning("Download failed, file: {} error: {}".format(file.path, rsync.stderr))
-                self.failed_count += 1
-            logger.debug(f"Execution Time: Downloading file: {time.time() - time_started} seconds")
+                filesize, mtime = (int(value) for value in process.stdout.readline().split())
+                with open(dst, 'wb') as writer:
+                    filesize_enc, md5_enc, _ = cipher.encrypt_stream(reader, writer, self.config['enc-key'])
+            except (OSError, ValueError) as e:
+                error = e
+                process.kill()
+            rc = process.wait()
+            stderr.seek(0)
+            if rc != 0 and rc != -9:
+                error = stderr.read().decode('utf-8', errors='replace').strip() or f"rc {rc}"
+            if error is None and reader.size != filesize:
+                error = f"file changed while reading it, size {filesize}, read {reader.size} bytes"
+        logger.debug(f"Execution Time: Download and encrypt file: {time.time() - time_started} seconds")
+
+        if error is not None:
+            logger.warning(f"Download failed, file: {file.path} error: {error}")
+            if os.path.isfile(dst):
+                os.remove(dst)
+            database.update_filename_enc(thread_session, file.id, None)
+            self.failed_count += 1
+            self.incomplete_directories.add(scan.parent(file.path))
+            return False
 
-        if self.local_files or downloaded:
-            time_started = time.time()
+        hashes = reader.hexdigests()
+        digest_algorithm = self.tools.hasher.digest
+        mtime = datetime.datetime.fromtimestamp(mtime)
+        now = datetime.datetime.now()
+        self.scheduler.record('get', filesize)
+        duplicate_id = self.md5_index.get_or_add(hashes['md5'], file.id)
+        if duplicate_id is not None:
+            logger.info(f"File downloaded with another name. Storing filename in Database: {file.filename}")
+            os.remove(dst)
+            database.update_filename_enc(thread_session, file.id, None)
+            database.update_duplicate_file_after_download(thread_session, file, duplicate_id, mtime, now,
+                                                          writer=self.writer)
+            self.skipped_count += 1
+            return True
+
+        database.update_file_after_download(thread_session, file, filesize, mtime, now, hashes['md5'],
+                                            hashes.get(digest_algorithm), digest_algorithm, writer=self.writer)
+        database.update_file_after_encrypt(thread_session, file, filesize_enc, now, md5_enc, writer=self.writer)
+        self.tools.storage.add('local-enc-dir', dst, filesize_enc)
+        self.downloaded_count += 1
+        logger.debug("Download and encryption finished: {}".format(file.path))
+        if self.on_encrypted is not None:
+            self.on_encrypted(file.id, filesize_enc)
+        return True
+
+    def resume_thread(self, file_id, fullpath):
+        """
+        Job which continues the download of a file, which is in database but not downloaded yet
+        """
+        thread_session = database.create_session(self.engine)
+        try:
+            file = database.get_file_by_id(thread_session, file_id)
             if self.local_files:
-                mtime = datetime.datetime.fromtimestamp(int(os.path.getmtime(os.path.abspath(f"{self.config['local-base-dir']}/{file.path}"))))
-                md5 = self.tools.md5sum(os.path.abspath(f"{self.config['local-base-dir']}/{file.path}"))
-                filesize = os.path.getsize(os.path.abspath(f"{self.config['local-base-dir']}/{file.path}"))
-            else:
-                mtime = datetime.datetime.fromtimestamp(int(os.path.getmtime(os.path.abspath(f"{self.config['local-data-dir']}/{file.path}"))))
-                md5 = self.tools.md5sum(os.path.abspath(f"{self.config['local-data-dir']}/{file.path}"))
-                filesize = os.path.getsize(os.path.abspath(f"{self.config['local-data-dir']}/{file.path}"))
+                if os.path.isfile(fullpath):
+                    self.register_download(thread_session, file)
+            elif self.stream_encrypt:
+                self.stream_file(thread_session, file, fullpath)
+            elif self.download_file(thread_session, file, fullpath):
+                self.register_download(thread_session, file)
+        finally:
+            thread_session.close()
 
-            logger.debug(f"Execution Time: Building md5sum and mtime: {time.time() - time_started} seconds")
+    def submit_download(self, pool, relpaths, fn, *args):
+        """
+        Queue a download job, its files are in self.pending_downloads from now on until the job is done
+        :param relpaths: relative paths of the files the job downloads
+        :return: False if the pool got cancelled
+        """
+        relpaths = set(relpaths)
+        self.pending_downloads.update(relpaths)
+        future = pool.submit(fn, *args)
+        if future is None:
+            self.pending_downloads.difference_update(relpaths)
+            return False
+        future.add_done_callback(lambda _: self.pending_downloads.difference_update(relpaths))
+        return True
 
-            downloaded_date = datetime.datetime.now()
-            file_dup = database.get_file_by_md5(thread_session, md5)
-            if file_dup is None:
-                database.update_file_after_download(thread_session, file, filesize, mtime, downloaded_date, md5)
-                self.downloaded_count += 1
-                logger.debug("Download finished: {}".format(file.path))
+    def resume_downloads(self, pool, base_dir):
+        """
+        Queue all files of earlier runs which were not downloaded (interrupted or failed), before any new file. Files
+        with a partial download continue at its size. Files with a job already are skipped (in watch mode get runs
+        again while jobs are running).
+        :return: count of queued files
+        """
+        files = database.get_unfinished_downloads(self.session)
+        self.session.commit()
+        count = 0
+        for file in files:
+            if self.interrupted or self.tools.calculate_over_max_storage_usage(-1):
+                break
+            if file.path in self.pending_downloads:
+                continue
+            fullpath = f"{base_dir}/{file.path}" if base_dir else file.path
+            if file.partial_size:
+                logger.info(f"Resuming download at {self.tools.convert_size(file.partial_size)}: {fullpath}")
             else:
-                logger.info(f"File downloaded with another name. Storing filename in Database: {file.filename}")
-                database.update_duplicate_file_after_download(thread_session, file, file_dup, mtime, downloaded_date)
-                if not self.local_files:
-                    time_started = time.time()
-                    os.remove(os.path.abspath("{}/{}".format(self.config['local-data-dir'], file.path)))
-                    logger.debug(f"Execution Time: Remove duplicate file: {time.time() - time_started} seconds")
-                self.skipped_count += 1
+                logger.info(f"Retrying download: {fullpath}")
+            if not self.submit_download(pool, [file.path], self.resume_thread, file.id, fullpath):
+                break
+            count += 1
+        return count
 
-        self.active_threads.remove(threadnr)
-        thread_session.close()
+    def get_batch_thread(self, batch, base_dir):
+        """
+        Job which will download a batch of files with one rsync call and insert them into database. Every file is
+        registered as soon as rsync reports it as transferred.
+        :param batch: list of scan.Entry with relative file paths
+        :param base_dir: remote base directory, the relative paths are relative to it
+        """
+        thread_session = database.create_session(self.engine)
+        if self.precheck_duplicates_enabled:
+            batch = self.precheck_duplicates(thread_session, batch, base_dir)
+            if not batch:
+                thread_session.close()
+                return
+        batch = [entry.path for entry in batch]
+
+        inserted = database.insert_files(thread_session, [(self.tools.strip_path(relpath), relpath)
+                                                          for relpath in batch])
+        files = dict(zip(batch, inserted))
+        logger.debug(f"Inserted batch of {len(files)} files into database. Fileids: {files[batch[0]].id}-"
+                     f"{files[batch[-1]].id}")
+        try:
+            self.download_batch(thread_session, files, base_dir)
+        finally:
+            thread_session.close()
+
+    def download_batch(self, thread_session, files, base_dir):
+        """
+        Download files with one rsync call, every file is registered as soon as rsync reports it as transferred
+        :param files: dict relative path -> File
+        :param base_dir: remote base directory, the relative paths are relative to it
+        """
+        batch = list(files)
+        time_started = time.time()
+        with tempfile.NamedTemporaryFile(prefix='tapebackup-files-from-') as files_from:
+            files_from.write(b'\0'.join(relpath.encode('utf-8') for relpath in batch))
+            files_from.flush()
 
-    def get(self, given_file=None):
+            command = ['rsync', '--protect-args', '-a', '-e', self.tools.ssh_command_string(),
+                       f"--files-from={files_from.name}", '--from0', '--8-bit-output', f"--partial-dir={PARTIAL_DIR}",
+                       f"--out-format={RSYNC_OUT_PREFIX}%n",
+                       f"{self.config['remote-server']}:{base_dir}/", f"{self.config['local-data-dir']}/"]
+            # stderr goes to a file and files are registered (md5sum) in another thread, so rsync is never blocked
+            # by a full pipe
+            stderr_file = tempfile.TemporaryFile()
+            registrations = queue.Queue()
+            failed = []
+            # End the transaction of this thread, the registration thread uses the session with its own connection
+            thread_session.commit()
+            registrar = threading.Thread(target=self.register_downloads_thread,
+                                         args=(thread_session, registrations, failed), name='get-register')
+            registrar.start()
+            try:
+                rsync = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file, preexec_fn=os.setpgrp)
+                for line in rsync.stdout:
+                    output = line.rstrip(b'\n').decode('utf-8')
+                    if not output.startswith(RSYNC_OUT_PREFIX):
+                        continue
+                    relpath = output[len(RSYNC_OUT_PREFIX):]
+                    if relpath in files:
+                        registrations.put(files.pop(relpath))
+                    if self.interrupted:
+                        logger.info("Interrupted, stopping rsync of current batch")
+                        rsync.terminate()
+                        break
+                rc = rsync.wait()
+            finally:
+                registrations.put(None)
+                registrar.join()
+                stderr_file.seek(0)
+                stderr = stderr_file.read()
+                stderr_file.close()
+        logger.debug(f"Execution Time: Downloading batch of {len(batch)} files: {time.time() - time_started} seconds")
+
+        # rsync does not report files, which already exist locally with same size and mtime
+        for relpath, file in list(files.items()):
+            if rc == 0 and os.path.isfile(f"{self.config['local-data-dir']}/{relpath}"):
+                self.register_download(thread_session, files.pop(relpath))
+        for file in failed:
+            files[file.path] = file
+
+        if files:
+            logger.warning(f"Download failed for {len(files)} files of batch, rc: {rc} error: {stderr}")
+            for relpath, file in files.items():
+                logger.debug(f"Download failed, file: {relpath}")
+                self.incomplete_directories.add(scan.parent(relpath))
+                self.record_partial(thread_session, file)
+            self.failed_count += len(files)
+
+    def register_downloads_thread(self, thread_session, registrations, failed):
+        """
+        Register files reported by rsync (see get_batch_thread) until None is received
+        :param thread_session: session of the batch, not used by the batch thread until this thread is finished
+        :param registrations: queue.Queue of File
+        :param failed: list, files which could not be registered are appended
+        """
+        try:
+            while True:
+                file = registrations.get()
+                if file is None:
+                    break
+                try:
+                    self.register_download(thread_session, file)
+                except Exception as e:
+                    logger.error(f"Registering downloaded file {file.path} failed: {e}")
+                    thread_session.rollback()
+                    failed.append(file)
+        finally:
+            # Release the connection of this thread before the batch thread uses the session again
+            thread_session.commit()
+
+    @staticmethod
+    def file_changed(entry, row):
+        """
+        Compare size and mtime from listing with database (path, deleted, filesize, mtime), unknown values are
+        ignored. Duplicates have no filesize in database.
+        """
+        _, _, filesize, mtime = row
+        if entry.size is not None and filesize is not None and entry.size != filesize:
+            return True
+        if entry.mtime is not None and mtime is not None and \
+                datetime.datetime.fromtimestamp(int(entry.mtime)) != mtime:
+            return True
+        return False
+
+    def get(self, given_file=None, wait_for_storage=False):
         """
         Get files from remote server or add local files into database
+
+        The sorted file list is merge joined against the sorted paths from database, so neither of them needs to be
+        loaded into memory. New files are downloaded while the list is still read.
         :param given_file: Filename to read list of files from, otherwise it will be retrieved via find
+        :param wait_for_storage: Wait until storage is freed by later stages instead of exiting on max_storage_usage
         :return: Nothing
         """
+        time_started = time.time()
+        unchanged_directories = set()
+        if self.stream_encrypt and not cipher.available():
+            logger.error("'get-stream-encrypt' needs the python module 'cryptography'")
+            sys.exit(1)
         if given_file is not None:
             logger.info(f"Taking filelist from given file {given_file}")
-            file_list = self.get_remote_filelist_fom_file(given_file)
             data_dir = self.config['remote-data-dir']
             base_dir = self.config['remote-base-dir']
+            # A given list can contain any path, so it is sorted here and compared against the whole database
+            entries = {}
+            for entry in self.get_remote_filelist_fom_file(given_file):
+                entries[self.tools.strip_base_path(entry.path, base_dir)] = entry
+            listing = [entry._replace(path=relpath) for relpath, entry in sorted(entries.items())]
+            db_prefix = None
         else:
             if self.local_files:
                 logger.info(f"Retrieving file list from server LOCAL directory "
                             f"{os.path.abspath(self.config['local-data-dir'])}")
-                file_list = self.tools.ls_recursive(os.path.abspath(self.config['local-data-dir']))
+                file_list = self.tools.ls_recursive_sorted(os.path.abspath(self.config['local-data-dir']))
                 data_dir = self.config['local-data-dir']
                 base_dir = self.config['local-base-dir']
             else:
-                file_list = self.get_remote_filelist()
                 data_dir = self.config['remote-data-dir']
                 base_dir = self.config['remote-base-dir']
+                if self.config.get('get-scan-directories', False):
+                    file_list, unchanged_directories = self.get_remote_filelist_incremental(base_dir)
+                else:
+                    file_list = self.get_remote_filelist()
+            listing = (entry._replace(path=self.tools.strip_base_path(entry.path, base_dir)) for entry in file_list)
+            db_prefix = self.tools.strip_base_path(data_dir, base_dir)
+
+        # Duplicate detection of finished downloads is a lookup in memory instead of a query per file
+        self.md5_index.load(self.session)
+        self.session.commit()
 
-        db_file_list = database.get_not_deleted_files(self.session, base_dir)
-        new_files = list(set(file_list)-set(db_file_list))
-        deleted_files = list(set(db_file_list) - set(file_list))
-        self.skipped_count += len(file_list) - len(new_files)
-
-        logger.info(f"Found {len(file_list)} files. New: {len(new_files)}. Deleted: {len(deleted_files)}. Start to process...")
-
-        file_count_current = 0
-        for fpath in new_files:
-            # Check if max-storage-size from config file is reached
-            file_count_current += 1
-            if self.tools.calculate_over_max_storage_usage(-1):
-                while threading.active_count() > 1:
-                    time.sleep(1)
-                logger.warning("max-storage-size reached, exiting!")
+        data_prefix = self.tools.strip_base_path(data_dir, base_dir)
+        known = database.iter_files_by_path(self.session, db_prefix)
+
+        pool = self.scheduler.pool('get')
+        resumed_count = self.resume_downloads(pool, base_dir)
+        batch_files = int(self.config.get('get-batch-files') or 0)
+        batch_size_max = self.tools.back_convert_size(str(self.config.get('get-batch-size') or '0'))
+        batch = []
+        batch_size = 0
+        new_count = 0
+        changed_count = 0
+        deleted_files = []
+        stop_new = False
+        logger.info("Comparing file list with database and start to process new files...")
+        for state, entry, row in scan.merge_diff(listing, known):
+            if self.interrupted:
                 break
+            relpath = entry.path
+            if self.directory_state is not None and state != scan.DELETED:
+                directory = scan.parent(relpath)
+                self.directory_file_counts[directory] = self.directory_file_counts.get(directory, 0) + 1
+
+            if state == scan.KNOWN or state == scan.IGNORED:
+                self.skipped_count += 1
+                if state == scan.KNOWN and self.file_changed(entry, row):
+                    changed_count += 1
+                    logger.info(f"File changed since download, it will not be downloaded again: {relpath}")
+                continue
+            if state == scan.DELETED:
+                # Files of unchanged directories are not listed again, they still exist
+                if scan.parent(relpath) in unchanged_directories:
+                    self.skipped_count += 1
+                    continue
+                ## Only look for files in the data path (then you can still specify subfolder instead of syncing all)
+                if scan.is_below(relpath, data_prefix):
+                    deleted_files.append(relpath)
+                continue
+
+            # Queued or running in watch mode, the job inserts the file
+            if relpath in self.pending_downloads:
+                self.skipped_count += 1
+                continue
+
+            new_count += 1
+            if stop_new:
+                self.incomplete_directories.add(scan.parent(relpath))
+                continue
+
+            # Check if max-storage-size from config file is reached (including this file, if size is known)
+            if self.tools.calculate_over_max_storage_usage(-1 if wait_for_storage or entry.size is None
+                                                           else entry.size):
+                if wait_for_storage:
+                    logger.info("max-storage-size reached, waiting for encrypt and write to free storage")
+                    while self.tools.calculate_over_max_storage_usage(-1) and not self.interrupted:
+                        time.sleep(10)
+                else:
+                    pool.wait()
+                    logger.warning("max-storage-size reached, no more downloads, only detecting deleted files!")
+                    stop_new = True
+                    self.incomplete_directories.add(scan.parent(relpath))
+                    continue
 
             # Check if there is still place available on the mountpoint to prevent getting more files if already nearly full
-            _, _, free = shutil.disk_usage(self.config['local-data-dir'])
-            if free < 100000000000:
-                logger.error("On the local-data-dir is less than 100GB space, exiting to avoid a full disk!")
-                break
+            free = self.tools.storage.free_space('local-data-dir')
+            if free - (entry.size or 0) < 100000000000:
+                logger.error("On the local-data-dir is less than 100GB space, no more downloads to avoid a full "
+                             "disk, only detecting deleted files!")
+                stop_new = True
+                self.incomplete_directories.add(scan.parent(relpath))
+                continue
 
-            if fpath.strip() == "":
+            if given_file is not None and database.file_exists_by_path(self.session, relpath) is not None:
                 continue
-            fullpath = fpath.strip()
-            relpath = self.tools.strip_base_path(fullpath, base_dir)
-            logger.debug(f"Processing {fullpath}")
-
-            if database.file_exists_by_path(self.session, relpath) is None:
-                # Get next thread id
-                for i in range(0, self.config['threads']['get']):
-                    if i not in self.active_threads:
-                        next_thread = i
-                        break
-                logger.info(f"Starting Thread #{next_thread}, processing "
-                            f"({file_count_current}/{len(new_files)}): {fullpath}")
 
-                self.active_threads.append(next_thread)
-                x = threading.Thread(target=self.get_thread,
-                                     args=(next_thread, relpath, fullpath,),
-                                     daemon=True)
-                x.start()
+            fullpath = f"{base_dir}/{relpath}" if base_dir else relpath
+            if batch_files > 0 and not self.local_files and not self.stream_encrypt:
+                batch.append(entry)
+                batch_size += entry.size or 0
+                if len(batch) >= batch_files or 0 < batch_size_max <= batch_size:
+                    logger.info(f"Queueing batch of {len(batch)} new files ({self.tools.convert_size(batch_size)}, "
+                                f"#{new_count - len(batch) + 1}-#{new_count})")
+                    self.submit_download(pool, [entry.path for entry in batch], self.get_batch_thread, batch,
+                                         base_dir)
+                    batch = []
+                    batch_size = 0
+            else:
+                logger.info(f"Queueing new file #{new_count}: {fullpath}")
+                self.submit_download(pool, [relpath], self.get_thread, entry, fullpath)
 
-                while threading.active_count() > self.config['threads']['get']:
-                    time.sleep(0.2)
+        if batch and not self.interrupted:
+            logger.info(f"Queueing batch of {len(batch)} new files")
+            self.submit_download(pool, [entry.path for entry in batch], self.get_batch_thread, batch, base_dir)
+        pool.wait()
+        if self.writer is not None:
+            self.writer.barrier()
 
+        ## Set delete flag for deleted files, only after the whole file list was read successfully
+        for relpath in deleted_files:
             if self.interrupted:
-                while threading.active_count() > 1:
-                    time.sleep(1)
                 break
+            self.deleted_count += 1
+            id = database.set_file_deleted(self.session, relpath, '')
+            logger.info(f"Set delete flag for file: ID: {id}, filepath: {relpath}")
 
-        while threading.active_count() > 1:
-            time.sleep(1)
+        if self.directory_state is not None and not self.interrupted:
+            self.save_directory_state(time_started)
 
-        ## Detect deleted files
-        for file in deleted_files:
-            if self.interrupted:
-                break
-            ## Only look for files in the data path (then you can still specify subfolder instead of syncing all)
-            if data_dir in file:
-                ## Set delete flag in database
-                self.deleted_count += 1
-                id = database.set_file_deleted(self.session, file, base_dir)
-                logger.info(f"Set delete flag for file: ID: {id}, filepath: {file}")
+        logger.info(f"Processing finished: resumed: {resumed_count}, new: {new_count}, downloaded: "
+                    f"{self.downloaded_count}, skipped (already downloaded): {self.skipped_count}, changed: "
+                    f"{changed_count}, failed: {self.failed_count}, deleted: {self.deleted_count}, hashes from "
+                    f"fingerprint cache: {self.fingerprints.hits}")
+
+    def watch_tree(self, watcher, path):
+        """
+        Add inotify watches for a directory and all directories below
+        :return: list of all files found below path
+        """
+        files = []
+        directories = [path]
+        while directories:
+            directory = directories.pop()
+            try:
+                watcher.add_watch(directory)
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            files.append(entry.path)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    logger.error(f"Limit of inotify watches reached while watching {directory}, increase "
+                                 f"'fs.inotify.max_user_watches' (sysctl)")
+                    sys.exit(1)
+                # Directory vanished or is not readable
+                logger.warning(f"Can't watch directory {directory}: {e.strerror}")
+        return files
+
+    def watch_queue_file(self, pool, path, base_dir, debounce):
+        """
+        Queue a file of watch mode for hashing and registration, if it is not in database yet
+        :return: False if the file was modified within the debounce time and must be checked again later
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return True
+        if not stat.S_ISREG(st.st_mode):
+            return True
+        if time.time() - st.st_mtime < debounce:
+            return False
+
+        relpath = self.tools.strip_base_path(path, base_dir)
+        entry = scan.Entry(relpath, st.st_size, st.st_mtime)
+        file = database.file_exists_by_path(self.session, relpath)
+        self.session.commit()
+        if file is not None or relpath in self.pending_downloads:
+            self.skipped_count += 1
+            if file is not None and self.file_changed(entry, (file.path, file.deleted, file.filesize, file.mtime)):
+                logger.info(f"File changed since it was added, it will not be added again: {relpath}")
+            return True
+
+        logger.info(f"Queueing new file: {path}")
+        self.submit_download(pool, [relpath], self.get_thread, entry, path)
+        return True
+
+    def watch_delete_file(self, path, base_dir):
+        """
+        Set delete flag for a file of watch mode, which was deleted or moved away
+        """
+        relpath = self.tools.strip_base_path(path, base_dir)
+        file = database.file_exists_by_path(self.session, relpath)
+        self.session.commit()
+        if file is not None and not file.deleted:
+            self.deleted_count += 1
+            id = database.set_file_deleted(self.session, relpath, '')
+            logger.info(f"Set delete flag for file: ID: {id}, filepath: {relpath}")
+
+    def watch_delete_directory(self, path, base_dir):
+        """
+        Set delete flag for all files below a directory of watch mode, which was moved away
+        """
+        relpath = self.tools.strip_base_path(path, base_dir)
+        deleted = [filepath for filepath, deleted, _, _ in database.iter_files_by_path(self.session, relpath)
+                   if not deleted]
+        for filepath in deleted:
+            self.deleted_count += 1
+            id = database.set_file_deleted(self.session, filepath, '')
+            logger.info(f"Set delete flag for file: ID: {id}, filepath: {filepath}")
+
+    def watch(self):
+        """
+        Continuous ingest of local-data-dir ('--local get --watch'): one full scan at start, afterwards new files are
+        taken from inotify events. A file is queued when it got no event for 'get-watch-debounce' seconds after it was
+        closed, moved in or created, so files which are still written are not hashed too early. Runs until
+        interrupted.
+        """
+        if not self.local_files:
+            logger.error("Watch mode is only possible with '--local'")
+            sys.exit(1)
+        if not inotify.available():
+            logger.error("Watch mode needs inotify (Linux)")
+            sys.exit(1)
+
+        data_dir = os.path.abspath(self.config['local-data-dir'])
+        base_dir = self.config['local-base-dir']
+        debounce = float(self.config.get('get-watch-debounce', 5))
+
+        # Watches are added before the initial scan, so no file is missed between scan and watching
+        time_started = time.time()
+        watcher = inotify.Inotify()
+        self.watch_tree(watcher, data_dir)
+        logger.debug(f"Execution Time: Adding {len(watcher.paths)} inotify watches: {time.time() - time_started} "
+                     f"seconds")
+        self.get()
+
+        pool = self.scheduler.pool('get')
+        # path -> time (monotonic) when it will be queued, if there is no further event
+        pending = {}
+        logger.info(f"Watching {data_dir} for new files ({len(watcher.paths)} directories)")
+        while not self.interrupted:
+            now = time.monotonic()
+            timeout = min(1.0, max(0.0, min(pending.values()) - now)) if pending else 1.0
+            events = watcher.read(timeout)
+            now = time.monotonic()
+            for event in events:
+                if event.mask & inotify.IN_Q_OVERFLOW:
+                    logger.warning("inotify event queue overflow, events got lost, scanning all files again")
+                    # Running jobs still insert files and add hashes, get() reloads the duplicate index
+                    pool.wait()
+                    if self.writer is not None:
+                        self.writer.barrier()
+                    self.watch_tree(watcher, data_dir)
+                    self.get()
+                    continue
+                if event.mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                    if event.path == data_dir:
+                        logger.error(f"Watched directory {data_dir} was deleted or moved, stopping")
+                        self.interrupted = True
+                        break
+                    continue
+
+                if event.mask & inotify.IN_ISDIR:
+                    if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                        # Files can be created before the watch of the new directory is added
+                        for path in self.watch_tree(watcher, event.path):
+                            pending[path] = now + debounce
+                    elif event.mask & inotify.IN_MOVED_FROM:
+                        watcher.remove_path(event.path)
+                        for path in [path for path in pending if path.startswith(event.path + os.sep)]:
+                            del pending[path]
+                        self.watch_delete_directory(event.path, base_dir)
+                    continue
+
+                if event.mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE):
+                    pending[event.path] = now + debounce
+                elif event.mask & inotify.IN_MODIFY:
+                    # Still written, wait again
+                    if event.path in pending:
+                        pending[event.path] = now + debounce
+                elif event.mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    pending.pop(event.path, None)
+                    self.watch_delete_file(event.path, base_dir)
+
+            for path in [path for path, due in pending.items() if due <= now]:
+                if self.interrupted:
+                    break
+                if self.watch_queue_file(pool, path, base_dir, debounce):
+                    del pending[path]
+                else:
+                    pending[path] = now + debounce
 
-        logger.info(f"Processing finished: downloaded: {self.downloaded_count}, skipped (already downloaded): "
-                    f"{self.skipped_count}, failed: {self.failed_count}, deleted: {self.deleted_count}")
+        pool.wait()
+        if self.writer is not None:
+            self.writer.barrier()
+        watcher.close()
+        logger.info(f"Watch mode stopped: added: {self.downloaded_count}, skipped (already known or duplicate): "
+                    f"{self.skipped_count}, deleted: {self.deleted_count}, not processed yet: {len(pending)}")
 
     table_format_verbose = [
         ('Id',                  lambda i: i.id),
@@ -235,6 +1072,7 @@ class Files:
         ('Filesize Encrypted',  lambda i: Tools.convert_size(i.filesize_encrypted)),
         ('md5sum',              lambda i: i.md5sum_file),
         ('md5sum Encrypted',    lambda i: i.md5sum_encrypted),
+        ('Digest',              lambda i: "" if i.digest_file is None else f"{i.digest_algorithm}:{i.digest_file}"),
         ('Tape',                lambda i: "" if i.tape is None else i.tape.label),
         ('Downloaded Date',     lambda i: i.downloaded_date),
         ('Encrypted Date',      lambda i: i.encrypted_date),
@@ -0,0 +1,229 @@
+import logging
+import os
+import threading
+import time
+from lib import database
+from lib.scheduler import Scheduler, ByteQueue
+from functions.files import Files
+from functions.encryption import Encryption
+from functions.tape import Tape
+
+logger = logging.getLogger()
+
+
+class Pipeline:
+    """
+    Runs get, encrypt and write at the same time. The stages are connected by queues which are bounded by bytes:
+        get -> encrypt queue -> encrypt -> write queue -> write (LTFS only)
+    A full queue blocks the previous stage. The write stage only starts writing if enough data is queued (or
+    write-max-wait seconds passed), so the drive can stream instead of starting and stopping for every file.
+    """
+    def __init__(self, config, engine, tapelibrary, tools, local=False):
+        self.config = config
+        self.engine = engine
+        self.session = database.create_session(engine)
+        self.tapelibrary = tapelibrary
+        self.tools = tools
+        self.local_files = local
+        self.interrupted = False
+        self.scheduler = Scheduler(config)
+
+        self.files = Files(config, engine, tapelibrary, tools, local, self.scheduler)
+        self.encryption = Encryption(config, engine, tapelibrary, tools, local, self.scheduler)
+        self.tape = Tape(config, engine, tapelibrary, tools, local)
+
+        pipeline_config = self.config.get('pipeline') or {}
+        self.encrypt_queue = ByteQueue(self.tools.back_convert_size(str(pipeline_config.get('encrypt-buffer', '50G'))))
+        self.write_queue = ByteQueue(self.tools.back_convert_size(str(pipeline_config.get('write-buffer', '100G'))))
+        self.write_min_buffer = self.tools.back_convert_size(str(pipeline_config.get('write-min-buffer', '20G')))
+        self.write_max_wait = int(pipeline_config.get('write-max-wait', 600))
+
+        self.current_tape = None
+        self.tape_keep_free = 0
+        self.written_count = 0
+        self.written_bytes = 0
+        self.delete_after_write = False
+
+    def set_interrupted(self):
+        self.interrupted = True
+        self.files.set_interrupted()
+        self.encryption.set_interrupted()
+        self.tape.set_interrupted()
+        self.scheduler.set_interrupted()
+        self.encrypt_queue.clear()
+        self.write_queue.close()
+
+    def start_tape(self):
+        """
+        Load and mount next tape for the write stage
+        :return: True if a tape is ready for writing
+        """
+        next_tape = self.tape.select_tape()
+        if next_tape is None:
+            return False
+
+        logger.info(f"Using tape {next_tape} for writing")
+        self.tapelibrary.load(next_tape)
+        lto_version = self.tapelibrary.get_current_lto_version()
+        if lto_version < 5:
+            logger.error(f"LTO-{lto_version} Tape found, pipeline supports LTFS (LTO-5 and above) only. "
+                         f"Use './main.py write' for this tape")
+            return False
+
+        self.tape_keep_free = self.tape.prepare_ltfs(next_tape)
+        self.current_tape = next_tape
+        return True
+
+    def tape_free(self, next_file_size=0):
+        return self.tape.capacity.free_space(next_file_size)
+
+    def encrypt_job(self, file_id, filepath, filename_enc):
+        if self.encryption.encrypt_single_file_thread(file_id, filepath, filename_enc):
+            filesize = os.path.getsize(f"{self.config['local-enc-dir']}/{filename_enc}")
+            self.write_queue.put(file_id, filesize)
+
+    def encrypt_stage(self):
+        """
+        Take downloaded files from encrypt queue and encrypt them with the encrypt worker pool
+        """
+        session = database.create_session(self.engine)
+        pool = self.scheduler.pool('encrypt')
+        while True:
+            file_id = self.encrypt_queue.get()
+            if file_id is None:
+                break
+            file = database.get_file_by_id(session, file_id)
+            if not file.downloaded and self.encryption.writer is not None:
+                # Update from get stage is still queued in write-behind writer
+                self.encryption.writer.barrier()
+                session.refresh(file)
+            filename_enc = self.encryption.new_filename_encrypted(session)
+            logger.info(f"Encrypting file (id: {file.id}): {file.filename}")
+            if pool.submit(self.encrypt_job, file.id, file.path, filename_enc) is None:
+                break
+
+        pool.wait()
+        session.close()
+        self.write_queue.close()
+        logger.info("Encrypt stage finished")
+
+    def write_piece(self, file):
+        """
+        Write one file or container to tape, a full tape is replaced by the next one
+        :return: True if written, None if skipped (md5sum mismatch), False if the write stage can't continue
+        """
+        free = self.tape_free(file.filesize_encrypted)
+        if file.filesize_encrypted > (free - self.tape_keep_free):
+            if not self.tape.tape_is_full_ltfs(self.current_tape, free) or not self.start_tape():
+                logger.error("Write stage can't continue, stopping pipeline. Remaining encrypted files will be "
+                             "written with the next './main.py write'")
+                self.set_interrupted()
+                return False
+            free = self.tape_free()
+
+        self.written_count += 1
+        written = self.tape.write_file_ltfs(file, free, self.current_tape, self.written_count,
+                                            self.written_count + len(self.write_queue))
+        if not written:
+            self.written_count -= 1
+        if written is None:
+            # md5sum mismatch, file stays in local-enc-dir for a later write
+            return None
+        elif not written:
+            logger.error("Write stage can't continue, stopping pipeline")
+            self.set_interrupted()
+            return False
+        self.written_bytes += file.filesize_encrypted
+
+        if self.delete_after_write:
+            self.tape.delete_encrypted_file(file)
+        return True
+
+    def write_stage(self):
+        """
+        Write containers left over from './main.py encrypt', then take encrypted files from write queue and write
+        them to tape
+        """
+        containers = database.get_containers_to_be_written(self.tape.session)
+        if containers:
+            logger.info(f"Writing {len(containers)} containers from previous encrypt runs")
+        for container in containers:
+            if self.write_piece(container) is False or self.interrupted:
+                logger.info("Write stage finished")
+                return
+
+        streaming = False
+        while True:
+            if not streaming:
+                logger.debug(f"Write stage waiting for {self.tools.convert_size(self.write_min_buffer)} of "
+                             f"encrypted files (queued: {self.tools.convert_size(self.write_queue.queued_bytes())})")
+            file_id = self.write_queue.get(0 if streaming else self.write_min_buffer, timeout=self.write_max_wait)
+            if file_id is None:
+                break
+            file = database.get_file_by_id(self.tape.session, file_id)
+            if not file.encrypted:
+                # Update from encrypt stage is still queued in write-behind writer
+                self.tape.sync_database()
+
+            if self.write_piece(file) is False:
+                break
+
+            # Keep on writing as long as there are files in queue, otherwise wait for a full buffer again
+            streaming = len(self.write_queue) > 0
+            if self.interrupted:
+                break
+        logger.info("Write stage finished")
+
+    def queue_backlog(self):
+        """
+        Add files which are left over from previous get and encrypt runs (containers are taken by the write stage)
+        """
+        for file in database.get_files_to_be_written(self.session):
+            if not self.write_queue.put(file.id, file.filesize_encrypted):
+                return
+        for file in database.get_files_to_be_encrypted(self.session):
+            if not self.encrypt_queue.put(file.id, file.filesize):
+                return
+
+    def run(self, given_file=None, delete_after_write=False):
+        """
+        Get, encrypt and write files to tape at the same time
+        :param given_file: Filename to read list of files from, otherwise it will be retrieved via find
+        :param delete_after_write: Delete encrypted file directly after writing to tape
+        """
+        time_started = time.time()
+        self.delete_after_write = delete_after_write
+        if delete_after_write:
+            logger.info(f"Option delete-after-write is set, will delete encrypted files directly after writing to tape!")
+
+        if not self.start_tape():
+            return
+        # The tape session will be used by the write stage thread from now on
+        self.tape.session.close()
+
+        writer = threading.Thread(target=self.write_stage, name='write', daemon=True)
+        encrypter = threading.Thread(target=self.encrypt_stage, name='encrypt', daemon=True)
+        writer.start()
+        encrypter.start()
+
+        self.queue_backlog()
+        if not self.interrupted:
+            self.files.on_downloaded = self.encrypt_queue.put
+            self.files.on_encrypted = self.write_queue.put
+            self.files.get(given_file, wait_for_storage=True)
+        self.encrypt_queue.close()
+
+        encrypter.join()
+        writer.join()
+        self.tape.sync_database()
+        self.tape.log_copy_stats(self.current_tape)
+
+        logger.info(f"Pipeline finished: downloaded: {self.files.downloaded_count}, written: {self.written_count} "
+                    f"({self.tools.convert_size(self.written_bytes)}) to tape")
+        logger.debug(f"Execution Time: Pipeline: {time.time() - time_started} seconds")
+
+        # Unmounting current tape if interrupted or no more data to write
+        if os.path.ismount(self.config['local-tape-mount-dir']):
+            logger.info(f"{self.tools.convert_size(self.tape.capacity.reconcile())} space still available on tape "
+                        f"{self.current_tape}")
+            self.tapelibrary.unmount()
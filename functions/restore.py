@@ -4,6 +4,7 @@ import sys
 from lib import database
 from functions.encryption import Encryption
 from lib.tools import Tools
+from lib.scheduler import Scheduler
 from pathlib import Path
 
 logger = logging.getLogger()
@@ -17,12 +18,13 @@ class Restore:
         self.tools = tools
         self.local_files = local
         self.interrupted = False
-        self.encryption = Encryption(config, database, tapelibrary, tools, local)
-        self.active_threads = []
+        self.scheduler = Scheduler(config)
+        self.encryption = Encryption(config, engine, tapelibrary, tools, local, self.scheduler)
         self.jobid = None
 
     def set_interrupted(self):
         self.interrupted = True
+        self.scheduler.set_interrupted()
 
     def start(self, files, tape=None, filelist=""):
         ## TODO: Restore file by given name, path or encrypted name
@@ -191,9 +193,10 @@ class Restore:
         self.tapelibrary.load(tape)
         self.tapelibrary.ltfs()
 
-        ordered_files = self.tools.order_by_startblock(files)
+        members = database.get_container_members(self.session, [file.id for file in files])
+        ordered_files = self.tools.order_by_startblock(files, members)
         for file in ordered_files:
-            self.restore_single_file(file)
+            self.restore_single_file(file, members.get(file.id))
             if self.interrupted:
                 logging.info(f'Restore interrupted')
                 break
@@ -225,12 +228,17 @@ class Restore:
                 grouped[tape] = [file]
         return grouped
 
-    def restore_single_file(self, file):
+    def restore_single_file(self, file, member=None):
         """
         Decrypt a file.
+        :param member: ContainerMember if the file is part of a container
         """
         logger.info('Restoring %s', file.path)
-        success = self.encryption.decrypt_relative(file.filename_encrypted, file.path, mkdir=True)
+        if member is not None:
+            success = self.encryption.decrypt_relative(member.container.filename_encrypted, file.path, mkdir=True,
+                                                       offset=member.offset, length=member.length)
+        else:
+            success = self.encryption.decrypt_relative(file.filename_encrypted, file.path, mkdir=True)
         if success:
             restored_path = Path(self.config['restore-dir']) / file.path
             if self.tools.md5sum(restored_path) != file.md5sum_file:
@@ -5,8 +5,12 @@ import os
 import sys
 import time
 import random
-import shutil
+from tabulate import tabulate
 from lib import database
+from lib.models import Container
+from lib import tapecapacity
+from lib import tapecopy
+from lib import tapeplan
 logger = logging.getLogger()
 
 
@@ -19,10 +23,26 @@ class Tape:
         self.tools = tools
         self.local_files = local
         self.interrupted = False
+        self.writer = database.get_writer(engine, config)
+        self.copy_engine = None
+        self.capacity = None
+        self.copy_stats = {}
 
     def set_interrupted(self):
         self.interrupted = True
 
+    def sync_database(self):
+        """
+        Durability barrier: wait until all queued write-behind updates are committed and reload objects of this
+        session. Call it before relying on the written flag (e.g. deleting encrypted files).
+        """
+        if self.writer is not None:
+            if not self.writer.barrier():
+                logger.error("Queued database updates could not be written, stopping before any encrypted file is "
+                             "deleted or a tape is marked as full")
+                sys.exit(1)
+            self.session.expire_all()
+
     def info(self):
         print(f"Loaderinfo from Device {self.config['devices']['tapelib']}:")
         for i in self.tapelibrary.loaderinfo():
@@ -70,6 +90,100 @@ class Tape:
         print("")
         print(f"Full tapes in library (Could be removed) ({len(tapes_to_remove)}): {tapes_to_remove}")
 
+    def plan(self, size=None, encrypted_only=False):
+        """
+        Dry run of the tape fill planner: show how pending files would be placed on tapes
+        :param size: capacity of a tape, Number[Unit] [Default: free space of the mounted tape]
+        :param encrypted_only: ignore files which are downloaded, but not encrypted yet
+        """
+        if size is not None:
+            capacity = self.tools.back_convert_size(size)
+            total = capacity
+        elif os.path.ismount(self.config['local-tape-mount-dir']):
+            st = os.statvfs(self.config['local-tape-mount-dir'])
+            capacity = st.f_bavail * st.f_frsize
+            total = st.f_blocks * st.f_frsize
+        else:
+            logger.error(f"No tape mounted on {self.config['local-tape-mount-dir']}, give the tape size with -s")
+            return
+
+        if "%" in str(self.config['tape-keep-free']):
+            keep_free = int(total * int(self.config['tape-keep-free'][0:self.config['tape-keep-free'].index("%")]) / 100)
+        else:
+            keep_free = self.tools.back_convert_size(str(self.config['tape-keep-free']))
+        capacity -= keep_free
+
+        files = database.get_files_to_be_written(self.session) + database.get_containers_to_be_written(self.session)
+        if not encrypted_only:
+            files += database.get_files_to_be_encrypted(self.session)
+        plans, too_big = tapeplan.plan_tapes(files, capacity)
+
+        table = []
+        for number, tape_plan in enumerate(plans, start=1):
+            table.append([number, len(tape_plan.files), self.tools.convert_size(tape_plan.planned),
+                          self.tools.convert_size(tape_plan.capacity - tape_plan.planned),
+                          f"{tape_plan.fill_ratio():.2%}"])
+        print(f"Pending files: {len(files)}, capacity per tape: {self.tools.convert_size(capacity)} "
+              f"(tape-keep-free: {self.tools.convert_size(keep_free)})")
+        print(tabulate(table, headers=['Tape', 'Files', 'Planned', 'Unused', 'Fill'], tablefmt='grid'))
+        if too_big:
+            print(f"Files bigger than a tape ({len(too_big)}): {[file.filename for file in too_big]}")
+
+    def reindex(self, tape, index_file=None):
+        """
+        Store the LTFS start block of all files and containers on a tape in database, read once from a LTFS index
+        (XML) or from the mounted tape
+        :param tape: label of tape
+        :param index_file: LTFS index of this tape [Default: read xattrs of the files on the mounted tape]
+        """
+        self.sync_database()
+        pieces = [file for file in database.get_files_by_tapelabel(self.session, tape)
+                  if file.filename_encrypted is not None] + database.get_containers_by_tapelabel(self.session, tape)
+        if not pieces:
+            logger.error(f"No files written on tape {tape} in database")
+            return
+
+        time_started = time.time()
+        positions = {}
+        missing = []
+        if index_file is not None:
+            logger.info(f"Reading LTFS index {index_file}")
+            index = self.tools.parse_ltfs_index(index_file)
+            logger.debug(f"Execution Time: Parse LTFS index ({len(index)} files): {time.time() - time_started} seconds")
+            for piece in pieces:
+                if piece.filename_encrypted not in index:
+                    missing.append(piece)
+                    continue
+                startblock, length = index[piece.filename_encrypted]
+                if length != piece.filesize_encrypted:
+                    logger.warning(f"Length on tape ({length}) not equal to database ({piece.filesize_encrypted}): "
+                                   f"{piece.filename_encrypted} ({piece.filename})")
+                if startblock is not None:
+                    positions[piece.filename_encrypted] = startblock
+        elif os.path.ismount(self.config['local-tape-mount-dir']):
+            logger.info(f"Reading start blocks from mounted tape {self.config['local-tape-mount-dir']}")
+            for piece in pieces:
+                path = f"{self.config['local-tape-mount-dir']}/{piece.filename_encrypted}"
+                if not os.path.isfile(path):
+                    missing.append(piece)
+                    continue
+                startblock = self.tools.ltfs_startblock(path)
+                if startblock is not None:
+                    positions[piece.filename_encrypted] = startblock
+                if self.interrupted:
+                    break
+            logger.debug(f"Execution Time: Read start blocks: {time.time() - time_started} seconds")
+        else:
+            logger.error(f"No tape mounted on {self.config['local-tape-mount-dir']}, give a LTFS index with -i")
+            return
+
+        if missing:
+            logger.warning(f"{len(missing)} files of tape {tape} not found on tape: "
+                           f"{[piece.filename_encrypted for piece in missing[:10]]}")
+        files, containers = database.update_tapepositions(self.session, positions)
+        logger.info(f"Tape {tape}: start block stored for {files} files and {containers} containers "
+                    f"({len(pieces) - files - containers} without)")
+
     def filecount_from_verify_files_config(self, filelist):
         if "%" in self.config['verify-files']:
             return int(len(filelist) * int(self.config['verify-files'][0:self.config['verify-files'].index("%")]) / 100)
@@ -116,22 +230,53 @@ class Tape:
                      "can use the tool 'HPE Library and Tape Tools' to check your drive.")
         logger.error("If it happens more often, you should consider to activate the 'tape-keep-free' option in "
                      "config.yml (Set it higher than than your last reported free size from debug output)")
+        # Queued 'written' updates of this tape must be committed before, or they would be written after the revert
+        if self.writer is not None:
+            if not self.writer.barrier():
+                logger.error("Queued database updates could not be written, run ./main.py db repair after the revert")
+            self.session.expire_all()
         logger.error(f"Reverting {len(database.get_files_by_tapelabel(self.session, tape))} file entries.")
         database.revert_written_to_tape_by_label(self.session, tape)
         self.tapelibrary.force_mkltfs()
         logger.error("Revert files and force format device finished. Exiting now!")
         sys.exit(1)
 
+    def get_copy_engine(self):
+        """
+        Buffers of config 'tape-copy' are allocated once, at the first file written to tape
+        """
+        if self.copy_engine is None:
+            copy_config = self.config.get('tape-copy') or {}
+            block_size = self.tools.back_convert_size(str(copy_config.get('block-size') or tapecopy.BLOCK_SIZE))
+            buffers = int(copy_config.get('buffers') or tapecopy.BUFFERS)
+            logger.debug(f"Tape copy buffers: {buffers} x {self.tools.convert_size(block_size)}")
+            self.copy_engine = tapecopy.CopyEngine(block_size, buffers)
+        return self.copy_engine
+
+    def log_copy_stats(self, tape):
+        """
+        Log files, bytes and sustained speed written to a tape by this run
+        """
+        stats = self.copy_stats.pop(tape, None)
+        if stats is None or stats['files'] == 0:
+            return
+        speed = stats['bytes'] / stats['seconds'] / 1024 / 1024 if stats['seconds'] > 0 else 0
+        logger.info(f"Tape {tape}: written {stats['files']} files ({self.tools.convert_size(stats['bytes'])}) in "
+                    f"{int(stats['seconds'])} seconds, {speed:.1f} MB/s, reader stalls: {stats['stalls']}")
+
     def write_file_ltfs(self, file, free, tape, count, filecount):
+        """
+        Copy encrypted file to LTFS, the file is marked as written only after the copy returned successfully and the
+        md5sum of the copied bytes is the same as md5sum_encrypted in database
+        :return: True if file was written, None if it was skipped because of a md5sum mismatch, False on errors
+        """
         logger.debug(f"Tape: Free: {free}, Fileid: {file.id}, Filesize: {file.filesize_encrypted}")
 
         logger.info(f"Writing file to tape ({count}/{filecount}): {file.filename}")
-        time_started = time.time()
+        source = f"{self.config['local-enc-dir']}/{file.filename_encrypted}"
+        destination = f"{self.config['local-tape-mount-dir']}/{file.filename_encrypted}"
         try:
-            shutil.copy2(
-                f"{self.config['local-enc-dir']}/{file.filename_encrypted}",
-                f"{self.config['local-tape-mount-dir']}/"
-            )
+            result = self.get_copy_engine().copy(source, destination)
         except OSError as error:
             if error.errno == 28:
                 # This means no space left on device
@@ -141,8 +286,43 @@ class Tape:
                 logger.error(f"You have now stale file entries in database and maybe a broken LTFS, you need to "
                              f"manually format this tape and set written=0, written_date=NULL and tape=NULL on files "
                              f"which has this tape '{tape}' assigned")
-        logger.debug(f"Execution Time: Copy file to tape: {time.time() - time_started} seconds")
-        database.update_file_after_write(self.session, file, datetime.datetime.now(), tape)
+                return False
+
+        speed = result.size / result.seconds / 1024 / 1024 if result.seconds > 0 else 0
+        logger.debug(f"Execution Time: Copy file to tape: {result.seconds} seconds ({speed:.1f} MB/s, reader stalls: "
+                     f"{result.stalls})")
+
+        if file.md5sum_encrypted is not None and result.md5 != file.md5sum_encrypted:
+            logger.error(f"md5sum of encrypted file ({result.md5}) not equal to database ({file.md5sum_encrypted}), "
+                         f"file is not marked as written and removed from tape: {source}")
+            try:
+                os.remove(destination)
+            except OSError as error:
+                logger.error(f"Removing {destination} from tape failed: {error}")
+            return None
+
+        if self.capacity is not None:
+            self.capacity.add(result.size)
+        stats = self.copy_stats.setdefault(tape, {'files': 0, 'bytes': 0, 'seconds': 0.0, 'stalls': 0})
+        stats['files'] += 1
+        stats['bytes'] += result.size
+        stats['seconds'] += result.seconds
+        stats['stalls'] += result.stalls
+
+        # Start block is stored, so restore and verify can be ordered without reading it from tape
+        try:
+            tape_position = self.tools.ltfs_startblock(destination)
+        except OSError as error:
+            logger.warning(f"Reading start block of {destination} failed: {error}")
+            tape_position = None
+
+        if isinstance(file, Container):
+            self.sync_database()
+            database.update_container_after_write(self.session, file, datetime.datetime.now(), tape, tape_position)
+        else:
+            database.update_file_after_write(self.session, file, datetime.datetime.now(), tape, tape_position,
+                                             writer=self.writer)
+        return True
 
     def write_file_tar(self, filelist, free, tape):
         tape_position = self.tapelibrary.get_current_block()
@@ -174,7 +354,9 @@ class Tape:
 
         logger.debug(f"Execution Time: Copy files via tar to tape: {time.time() - time_started} seconds")
         for file in filelist:
-            database.update_file_after_write(self.session, file, datetime.datetime.now(), tape, tape_position)
+            database.update_file_after_write(self.session, file, datetime.datetime.now(), tape, tape_position,
+                                             writer=self.writer)
+        self.sync_database()
         new_tape_position = self.tapelibrary.get_current_block()
         database.update_tape_end_position(self.session, tape, new_tape_position)
 
@@ -182,9 +364,14 @@ class Tape:
         # For LTO-5 and above with LTFS support
         logger.warning(f"Tape is full ({self.tools.convert_size(free)} left): I am testing now a few media, writing "
                        f"summary into database and unloading tape")
+        self.log_copy_stats(tape)
 
+        self.sync_database()
         files = database.get_files_by_tapelabel(self.session, tape)
-        if not self.test_backup_pieces_ltfs(files, self.filecount_from_verify_files_config(files)):
+        # Files and containers on tape, members of containers are part of their container
+        pieces = [file for file in files if file.filename_encrypted is not None] + \
+            database.get_containers_by_tapelabel(self.session, tape)
+        if not self.test_backup_pieces_ltfs(pieces, self.filecount_from_verify_files_config(pieces)):
             logger.error(
                 "md5sum on tape not equal to database. Stopping everything. Need manual check of the tape!")
             logger.error(f"If you do not use this tape anymore, or want to write all data again, you need to manual "
@@ -205,9 +392,17 @@ class Tape:
             return False
 
         ## WRITE Textfile containing (encryped_name|original_fullpath) of all files encrypted to tape
+        ## Members of containers: (id|original_fullpath|container|offset|length)
+        members = database.get_container_members(self.session,
+                                                 [file.id for file in files if file.filename_encrypted is None])
         with open('tapebackup_{}.txt'.format(dt), 'w') as f:
             for file in database.get_files_by_tapelabel(self.session, tape):
-                f.write('"{}";"{}";"{}"\n'.format(file.id, file.path, file.filename_encrypted))
+                if file.id in members:
+                    member = members[file.id]
+                    f.write('"{}";"{}";"{}";"{}";"{}"\n'.format(file.id, file.path, member.container.filename_encrypted,
+                                                             member.offset, member.length))
+                else:
+                    f.write('"{}";"{}";"{}"\n'.format(file.id, file.path, file.filename_encrypted))
         command = ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-iter', '100000', '-in', f'tapebackup_{dt}.txt',
                    '-out', f"{self.config['local-tape-mount-dir']}/tapebackup_{dt}.txt.enc", '-k', self.config['enc-key']]
         openssl = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -220,11 +415,13 @@ class Tape:
         ## DELETE all Files, that has been transfered to tape
         time_started = time.time()
         count = 1
-        to_delete = database.get_files_by_tapelabel(self.session, tape)
+        to_delete = pieces
         for file in to_delete:
             if os.path.exists("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted)):
                 logger.info(f"Deleting encrypted file ({count}/{len(to_delete)}): {file.filename_encrypted} ({file.filename})")
-                os.remove("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted))
+                path = "{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted)
+                os.remove(path)
+                self.tools.storage.remove('local-enc-dir', path, file.filesize_encrypted)
             count += 1
         logger.debug(f"Execution Time: Deleted encrypted files written to tape: {time.time() - time_started} seconds")
 
@@ -249,24 +446,86 @@ class Tape:
         ## TODO: Write DATABASE and stuff to file, see tape_is_full_ltfs
         #database.mark_tape_as_full(self.session, tape, datetime.datetime.now(), len(files))
 
-    def write(self, delete_after_write=False):
-        full = False
+    def select_tape(self):
+        """
+        Choose the tape for the next write operation
+        :return: label of tape or None if there is no free tape in library
+        """
         tapes, tapes_to_remove = self.tapelibrary.get_tapes_tags_from_library(self.session)
         if len(tapes_to_remove) > 0:
             logger.warning(f"These tapes are full, please remove from library: {tapes_to_remove}")
 
         if len(tapes) == 0:
             logger.error(f"No free Tapes in Library, but you can remove these full ones: {tapes_to_remove}")
-            return
-
-        if delete_after_write:
-            logger.info(f"Option delete-after-write is set, will delete encrypted files directly after writing to tape!")
+            return None
 
         started_tape = database.get_started_tape(self.session)
         if started_tape not in tapes:
             next_tape = tapes.pop(0)
         else:
             next_tape = started_tape[0]
+        return next_tape
+
+    def prepare_ltfs(self, next_tape):
+        """
+        Mount (and maybe format) ltfs on the loaded tape and register tape in database
+        :return: bytes which should be kept free on tape
+        """
+        ## Mount and maybe format tapedevice
+        self.tapelibrary.ltfs()
+
+        ## Write used tape into database
+        database.write_tape_into_database(self.session, next_tape)
+
+        time_started = time.time()
+        st = os.statvfs(self.config['local-tape-mount-dir'])
+        logger.info("Tape: Used: {} ({} GB), Free: {} ({} GB), Total: {} ({} GB)".format(
+            (st.f_blocks - st.f_bfree) * st.f_frsize,
+            int((st.f_blocks - st.f_bfree) * st.f_frsize / 1024 / 1024 / 1024),
+            (st.f_bavail * st.f_frsize),
+            int((st.f_bavail * st.f_frsize) / 1024 / 1024 / 1024),
+            (st.f_blocks * st.f_frsize),
+            int((st.f_blocks * st.f_frsize) / 1024 / 1024 / 1024)
+        ))
+        logger.debug(f"Execution Time: Getting tape space info: {time.time() - time_started} seconds")
+
+        if "%" in str(self.config['tape-keep-free']):
+            tape_keep_free = int(st.f_blocks * st.f_frsize *
+                                 int(self.config['tape-keep-free'][0:self.config['tape-keep-free'].index("%")]) /
+                                 100)
+        else:
+            tape_keep_free = self.tools.back_convert_size(str(self.config['tape-keep-free']))
+        logger.debug(f"Keep {tape_keep_free} ({self.tools.convert_size(tape_keep_free)}) free on tape given by config file!")
+
+        capacity_config = self.config.get('tape-capacity') or {}
+        self.capacity = tapecapacity.TapeCapacity(
+            self.config['local-tape-mount-dir'], tape_keep_free,
+            self.tools.back_convert_size(str(capacity_config.get('file-overhead') or tapecapacity.FILE_OVERHEAD)),
+            self.tools.back_convert_size(str(capacity_config.get('reconcile-every') or tapecapacity.RECONCILE_BYTES)))
+        return tape_keep_free
+
+    def delete_encrypted_file(self, file):
+        """
+        Delete encrypted file from local-enc-dir (--delete-after-write)
+        """
+        self.sync_database()
+        if os.path.exists("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted)):
+            logger.info(f"Deleting encrypted file: {file.filename_encrypted} ({file.filename})")
+            path = "{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted)
+            os.remove(path)
+            self.tools.storage.remove('local-enc-dir', path, file.filesize_encrypted)
+
+    def write(self, delete_after_write=False):
+        full = False
+        free = 0
+        count = 1
+        filecount = 0
+        next_tape = self.select_tape()
+        if next_tape is None:
+            return
+
+        if delete_after_write:
+            logger.info(f"Option delete-after-write is set, will delete encrypted files directly after writing to tape!")
 
         logger.info(f"Using tape {next_tape} for writing")
         self.tapelibrary.load(next_tape)
@@ -274,56 +533,55 @@ class Tape:
 
         if lto_version >= 5:
             logger.info(f"LTO-{lto_version} Tape found, use LTFS for backup")
-            ## Mount and maybe format tapedevice
-            self.tapelibrary.ltfs()
-
-            ## Write used tape into database
-            database.write_tape_into_database(self.session, next_tape)
-
-            time_started = time.time()
-            st = os.statvfs(self.config['local-tape-mount-dir'])
-            logger.info("Tape: Used: {} ({} GB), Free: {} ({} GB), Total: {} ({} GB)".format(
-                (st.f_blocks - st.f_bfree) * st.f_frsize,
-                int((st.f_blocks - st.f_bfree) * st.f_frsize / 1024 / 1024 / 1024),
-                (st.f_bavail * st.f_frsize),
-                int((st.f_bavail * st.f_frsize) / 1024 / 1024 / 1024),
-                (st.f_blocks * st.f_frsize),
-                int((st.f_blocks * st.f_frsize) / 1024 / 1024 / 1024)
-            ))
-            logger.debug(f"Execution Time: Getting tape space info: {time.time() - time_started} seconds")
-
-            if "%" in str(self.config['tape-keep-free']):
-                tape_keep_free = int(st.f_blocks * st.f_frsize *
-                                     int(self.config['tape-keep-free'][0:self.config['tape-keep-free'].index("%")]) /
-                                     100)
-            else:
-                tape_keep_free = self.tools.back_convert_size(str(self.config['tape-keep-free']))
-            logger.debug(f"Keep {tape_keep_free} ({self.tools.convert_size(tape_keep_free)}) free on tape given by config file!")
-
-            files = database.get_files_to_be_written(self.session)
-            filecount = self.tools.count_files_fit_on_tape(files, ((st.f_bavail * st.f_frsize) - tape_keep_free))
+            tape_keep_free = self.prepare_ltfs(next_tape)
+            free = self.capacity.free_space()
+
+            files = database.get_files_to_be_written(self.session) + \
+                database.get_containers_to_be_written(self.session)
+            tape_plan = tapeplan.plan(files, free - tape_keep_free)
+            filecount = len(tape_plan.files)
+            logger.info(f"Planned {filecount} of {len(files)} files ({self.tools.convert_size(tape_plan.planned)}) for "
+                        f"this tape, expected fill: {tape_plan.fill_ratio():.1%} of "
+                        f"{self.tools.convert_size(tape_plan.capacity)}")
+            remaining = list(tape_plan.remaining)
+            failed = False
             count = 1
-            for file in files:
-                st = os.statvfs(self.config['local-tape-mount-dir'])
-                free = (st.f_bavail * st.f_frsize)
+            for file in tape_plan.files:
+                free = self.capacity.free_space(file.filesize_encrypted)
 
-                ## Check if enough space on tape, otherwise unmount and use next tape
+                ## Check if enough space on tape (LTFS needs more than planned), otherwise keep it for the next tape
                 if file.filesize_encrypted > (free - tape_keep_free):
-                    full = self.tape_is_full_ltfs(next_tape, free)
-                    break
-                else:
-                    self.write_file_ltfs(file, free, next_tape, count, filecount)
+                    logger.debug(f"File doesn't fit on tape anymore, keeping it for next tape: {file.filename}")
+                    remaining.append(file)
+                    continue
+                written = self.write_file_ltfs(file, free, next_tape, count, filecount)
+                if written:
                     count += 1
+                elif written is None:
+                    # md5sum mismatch, file stays in local-enc-dir and is not marked as written
+                    if self.interrupted:
+                        break
+                    continue
+                else:
+                    failed = True
+                    break
 
                 # Delete file if --delete-after-write is specified
                 if delete_after_write:
-                    if os.path.exists("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted)):
-                        logger.info(f"Deleting encrypted file: {file.filename_encrypted} ({file.filename})")
-                        os.remove("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted))
+                    self.delete_encrypted_file(file)
 
                 if self.interrupted:
                     break
 
+            ## Files left which don't fit, unmount and use next tape
+            if remaining and not failed and not self.interrupted:
+                full = self.tape_is_full_ltfs(next_tape, free)
+            if not full:
+                if not failed:
+                    # Log tracked against real free space
+                    free = self.capacity.reconcile()
+                self.log_copy_stats(next_tape)
+
         elif lto_version == 4:
             logger.info("LTO-4 Tape found, use tar for backup")
             self.tapelibrary.set_necessary_lto4_options()
@@ -350,6 +608,7 @@ class Tape:
             files_for_next_chunk = []
             files_next_chunk_size = 0
             files = database.get_files_to_be_written(self.session)
+            filecount = len(files)
             for file in files:
                 free = self.tapelibrary.get_free_tapespace_lto4()
                 ## Check if enough space on tape, otherwise unmount and use next tape
@@ -372,12 +631,11 @@ class Tape:
                     else:
                         files_for_next_chunk.append(file)
                         files_next_chunk_size += file.filesize_encrypted
+                count += 1
 
                 # Delete file if --delete-after-write is specified
                 if delete_after_write:
-                    if os.path.exists("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted)):
-                        logger.info(f"Deleting encrypted file: {file.filename_encrypted} ({file.filename})")
-                        os.remove("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted))
+                    self.delete_encrypted_file(file)
 
                 if self.interrupted:
                     break
@@ -385,8 +643,10 @@ class Tape:
             if len(files_for_next_chunk) > 0:
                 self.write_file_tar(files_for_next_chunk, free, next_tape)
 
+        self.sync_database()
+
         # Info some stats, especially interesting when written is manual interrupted
-        logger.info(f"Written {count} of {filecount} files. {self.tools.convert_size(st.f_bavail * st.f_frsize)} "
+        logger.info(f"Written {count - 1} of {filecount} files. {self.tools.convert_size(free)} "
                     f"space still avalable on tape.")
 
         if full:
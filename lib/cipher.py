@@ -0,0 +1,163 @@
+import collections
+import hashlib
+import logging
+import secrets
+import threading
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    HAS_CRYPTOGRAPHY = True
+except ImportError:
+    HAS_CRYPTOGRAPHY = False
+
+logger = logging.getLogger()
+
+# Parameters of 'openssl enc -aes-256-cbc -pbkdf2 -iter 100000 -k <key>'
+OPENSSL_MAGIC = b'Salted__'
+SALT_SIZE = 8
+KEY_SIZE = 32
+BLOCK_SIZE = 16
+PBKDF2_DIGEST = 'sha256'
+PBKDF2_ITERATIONS = 100000
+HEADER_SIZE = len(OPENSSL_MAGIC) + SALT_SIZE
+
+CHUNK_SIZE = 1024 * 1024
+
+## Derived keys of the last salts decrypted, members of the same container are decrypted with the same salt
+KEY_CACHE_SIZE = 64
+_key_cache = collections.OrderedDict()
+_key_cache_lock = threading.Lock()
+
+
+def available():
+    """
+    Check if the python encryption engine can be used (needs the 'cryptography' module)
+    """
+    return HAS_CRYPTOGRAPHY
+
+
+def derive_key_iv(password, salt, iterations=PBKDF2_ITERATIONS):
+    """
+    Derive key and iv the same way openssl enc does with -pbkdf2
+    :param password: encryption key from config
+    :param salt: 8 byte salt
+    :param iterations: pbkdf2 iterations
+    :return: tuple (key, iv)
+    """
+    key_iv = hashlib.pbkdf2_hmac(PBKDF2_DIGEST, password.encode('utf-8'), salt, iterations, KEY_SIZE + BLOCK_SIZE)
+    return key_iv[:KEY_SIZE], key_iv[KEY_SIZE:]
+
+
+def cached_key_iv(password, salt):
+    """
+    derive_key_iv for decryption, the last KEY_CACHE_SIZE salts are kept. The cache is keyed by a sha256 of the
+    password, the password itself is not stored.
+    """
+    cache_key = (hashlib.sha256(password.encode('utf-8')).digest(), salt)
+    with _key_cache_lock:
+        if cache_key in _key_cache:
+            _key_cache.move_to_end(cache_key)
+            return _key_cache[cache_key]
+    key_iv = derive_key_iv(password, salt)
+    with _key_cache_lock:
+        _key_cache[cache_key] = key_iv
+        if len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+    return key_iv
+
+
+def encrypted_size(filesize):
+    """
+    Size of the encrypted file (header + PKCS#7 padded ciphertext) for a given plaintext size
+    """
+    return HEADER_SIZE + (filesize // BLOCK_SIZE + 1) * BLOCK_SIZE
+
+
+def encrypt_stream(reader, writer, password, salt=None, hash_plain=False, chunk_size=CHUNK_SIZE):
+    """
+    Encrypt a stream in a single pass, output is byte compatible with
+    'openssl enc -aes-256-cbc -pbkdf2 -iter 100000'. The md5sum of the written ciphertext (and optionally of the
+    plaintext) is calculated on the fly, so no file needs to be read a second time.
+    :param reader: binary file object to read plaintext from
+    :param writer: binary file object to write ciphertext into
+    :param password: encryption key
+    :param salt: 8 byte salt, random if not given
+    :param hash_plain: additionally calculate md5sum of the plaintext
+    :param chunk_size: read size in bytes
+    :return: tuple (bytes written, md5sum encrypted, md5sum plaintext or None)
+    """
+    if salt is None:
+        salt = secrets.token_bytes(SALT_SIZE)
+    key, iv = derive_key_iv(password, salt)
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    padder = padding.PKCS7(BLOCK_SIZE * 8).padder()
+
+    md5_encrypted = hashlib.md5()
+    md5_plain = hashlib.md5() if hash_plain else None
+    written = 0
+
+    def emit(data):
+        nonlocal written
+        if data:
+            writer.write(data)
+            md5_encrypted.update(data)
+            written += len(data)
+
+    emit(OPENSSL_MAGIC + salt)
+    while True:
+        buf = reader.read(chunk_size)
+        if not buf:
+            break
+        if md5_plain is not None:
+            md5_plain.update(buf)
+        emit(encryptor.update(padder.update(buf)))
+    emit(encryptor.update(padder.finalize()) + encryptor.finalize())
+
+    return written, md5_encrypted.hexdigest(), md5_plain.hexdigest() if md5_plain is not None else None
+
+
+def encrypt_file(src, dst, password, hash_plain=False, chunk_size=CHUNK_SIZE):
+    """
+    Encrypt file src into dst, see encrypt_stream
+    """
+    with open(src, 'rb') as reader, open(dst, 'wb') as writer:
+        return encrypt_stream(reader, writer, password, hash_plain=hash_plain, chunk_size=chunk_size)
+
+
+def decrypt_range(reader, writer, password, offset, length, chunk_size=CHUNK_SIZE):
+    """
+    Decrypt only a part of a file encrypted by encrypt_stream or openssl, e.g. one member of a container. In CBC mode
+    every block is decrypted with the ciphertext block before it, so reading can start at any block.
+    :param reader: seekable binary file object of the encrypted file
+    :param writer: binary file object to write plaintext into
+    :param offset: start in the plaintext
+    :param length: bytes of plaintext
+    :return: tuple (bytes written, md5sum of the written plaintext)
+    """
+    header = reader.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or not header.startswith(OPENSSL_MAGIC):
+        raise ValueError("Not an encrypted file (header missing)")
+    key, iv = cached_key_iv(password, header[len(OPENSSL_MAGIC):])
+
+    first_block = offset // BLOCK_SIZE
+    if first_block > 0:
+        reader.seek(HEADER_SIZE + (first_block - 1) * BLOCK_SIZE)
+        iv = reader.read(BLOCK_SIZE)
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+
+    skip = offset - first_block * BLOCK_SIZE
+    remaining = length
+    md5_plain = hashlib.md5()
+    chunk_size -= chunk_size % BLOCK_SIZE
+    while remaining > 0:
+        needed = skip + remaining
+        buf = reader.read(min(chunk_size, needed + (-needed % BLOCK_SIZE)))
+        if not buf:
+            raise ValueError(f"Encrypted file ends {remaining} bytes before the end of the range")
+        data = decryptor.update(buf)[skip:skip + remaining]
+        skip = 0
+        writer.write(data)
+        md5_plain.update(data)
+        remaining -= len(data)
+    return length, md5_plain.hexdigest()
@@ -0,0 +1,84 @@
+import hashlib
+import logging
+
+logger = logging.getLogger()
+
+## Files smaller than this are packed into containers (config 'container: file-size'), 0 disables containers
+FILE_SIZE = 0
+
+## Size of the plaintext of a container (config 'container: size')
+CONTAINER_SIZE = 4 * 1024 * 1024 * 1024
+
+
+def group_files(files, file_size, container_size):
+    """
+    Group small files for containers, sorted by path so files of a directory end up in the same container
+    :param files: files waiting for encryption
+    :param file_size: files smaller than this are packed
+    :param container_size: a group is closed when its files reach this size
+    :return: list of lists of files, the last group can be smaller than container_size
+    """
+    small = sorted((file for file in files if file.filesize is not None and file.filesize < file_size),
+                   key=lambda file: file.path)
+    groups = []
+    group = []
+    size = 0
+    for file in small:
+        group.append(file)
+        size += file.filesize
+        if size >= container_size:
+            groups.append(group)
+            group = []
+            size = 0
+    if group:
+        groups.append(group)
+    return groups
+
+
+class MemberReader:
+    """
+    Reads the members of a container one after another like a single stream, for cipher.encrypt_stream. Offset,
+    length and md5sum of every member are recorded while reading.
+    """
+    def __init__(self, members):
+        """
+        :param members: list of tuples (file, path)
+        """
+        self.members = list(members)
+        self.index = 0
+        self.current = None
+        self.offset = 0
+        self.start = 0
+        self.md5 = None
+        self.positions = []
+
+    def open_next(self):
+        if self.index >= len(self.members):
+            return False
+        self.current = open(self.members[self.index][1], 'rb')
+        self.start = self.offset
+        self.md5 = hashlib.md5()
+        return True
+
+    def close_current(self):
+        self.current.close()
+        self.current = None
+        file = self.members[self.index][0]
+        self.positions.append((file, self.start, self.offset - self.start, self.md5.hexdigest()))
+        self.index += 1
+
+    def read(self, size=-1):
+        while True:
+            if self.current is None and not self.open_next():
+                return b''
+            data = self.current.read(size)
+            if data:
+                self.md5.update(data)
+                self.offset += len(data)
+                return data
+            self.close_current()
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
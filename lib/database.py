@@ -1,20 +1,71 @@
+import atexit
 import datetime
 import logging
 import os
-from sqlalchemy import create_engine, func, or_, and_
-from sqlalchemy.orm import sessionmaker
+import sys
+import threading
+from sqlalchemy import create_engine, event, func, insert, or_, and_
+from sqlalchemy.orm import joinedload, sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
 
 from lib.decorators import retry_transaction
-from lib.models import Config, File, Tape, RestoreJob, RestoreJobFileMap
+from lib.models import Config, Container, ContainerMember, Directory, File, Fingerprint, Tape, RestoreJob, \
+    RestoreJobFileMap
+from lib.writebehind import WriteBehind
 
 logger = logging.getLogger()
 
+_writers = {}
+_writers_lock = threading.Lock()
 
-def connect(db_path):
+## SQLite pragmas which are set on every new connection
+PROFILES = {
+    # SQLite defaults: rollback journal, every commit is synced
+    'default': {},
+    # Readers don't block the writer, commits are only synced on checkpoints (still safe on application crash)
+    'wal': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 30000,
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def connect(db_path, tuning=None):
     """
     Create database engine
-    """
-    engine = create_engine(f"sqlite:///{db_path}")
+    :param db_path: path of sqlite database
+    :param tuning: dict from config 'database-tuning': profile (key of PROFILES), pragmas (overrides single pragmas
+                   of the profile) and pool-size (0 opens a new connection per session)
+    """
+    tuning = tuning or {}
+    profile = tuning.get('profile', 'default')
+    if profile not in PROFILES:
+        logger.error(f"Unknown database profile '{profile}', possible profiles: {', '.join(PROFILES)}")
+        sys.exit(1)
+    pragmas = dict(PROFILES[profile])
+    pragmas.update(tuning.get('pragmas') or {})
+    pool_size = int(tuning.get('pool-size', 0))
+
+    if pool_size > 0:
+        # Connections are reused by the worker threads, a session is still only used by one thread at a time
+        engine = create_engine(f"sqlite:///{db_path}", poolclass=QueuePool, pool_size=pool_size, max_overflow=-1,
+                               connect_args={'check_same_thread': False})
+    else:
+        engine = create_engine(f"sqlite:///{db_path}", poolclass=NullPool)
+
+    if pragmas:
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    logger.debug(f"Database profile: {profile}, pragmas: {pragmas}, pool size: {pool_size}")
     return engine
 
 
@@ -27,6 +78,10 @@ def create_tables(engine):
     Tape.__table__.create(bind=engine, checkfirst=True)
     RestoreJob.__table__.create(bind=engine, checkfirst=True)
     RestoreJobFileMap.__table__.create(bind=engine, checkfirst=True)
+    Directory.__table__.create(bind=engine, checkfirst=True)
+    Fingerprint.__table__.create(bind=engine, checkfirst=True)
+    Container.__table__.create(bind=engine, checkfirst=True)
+    ContainerMember.__table__.create(bind=engine, checkfirst=True)
 
 
 def create_session(engine):
@@ -37,6 +92,25 @@ def create_session(engine):
     return session()
 
 
+def get_writer(engine, config):
+    """
+    Get the write-behind writer of an engine, there is only one writer thread per database. Pending updates are
+    written on exit.
+    :return: WriteBehind or None if disabled in config ('database-write-behind')
+    """
+    writer_config = config.get('database-write-behind') or {}
+    if not writer_config.get('enabled', False):
+        return None
+
+    with _writers_lock:
+        if engine not in _writers:
+            writer = WriteBehind(engine, float(writer_config.get('flush-interval', 2)),
+                                 int(writer_config.get('flush-size', 500)))
+            atexit.register(writer.close)
+            _writers[engine] = writer
+        return _writers[engine]
+
+
 def db_model_version_need_update(engine, session, db_version):
     """
     Check if the database model needs an upgrade
@@ -54,11 +128,11 @@ def db_model_version_need_update(engine, session, db_version):
     return True
 
 
-def init(db_path, db_version):
+def init(db_path, db_version, tuning=None):
     """
     Initialize a new database
     """
-    engine = connect(db_path)
+    engine = connect(db_path, tuning)
     session = create_session(engine)
     if not os.path.exists(db_path):
         logger.info("Creating database")
@@ -109,6 +183,26 @@ def insert_file(session, filename, relative_path):
     session.commit()
     return file
 
+@retry_transaction()
+def insert_files(session, files):
+    """
+    Create new file entries with one commit
+    :param session: orm session
+    :param files: list of tuples (file name, relative file path)
+    :return: list of inserted file objects
+    """
+    objects = [File(filename=filename, path=relative_path) for filename, relative_path in files]
+    session.add_all(objects)
+    session.commit()
+    return objects
+
+
+def get_file_by_id(session, file_id):
+    """
+    Get a file by its id
+    """
+    return session.query(File).filter(File.id == file_id).first()
+
 
 @retry_transaction(sleeptime=0.5)
 def get_file_by_md5(session, md5):
@@ -118,8 +212,22 @@ def get_file_by_md5(session, md5):
     return session.query(File).filter(File.md5sum_file == md5).first()
 
 
+@retry_transaction(sleeptime=0.5)
+def get_known_filesizes(session, filesizes):
+    """
+    Get the sizes of the given list which belong to at least one downloaded file (duplicates excluded)
+    :return: set of filesizes
+    """
+    return {filesize for filesize, in session.query(File.filesize).filter(
+        File.filesize.in_(filesizes),
+        File.md5sum_file.isnot(None),
+        File.duplicate_id.is_(None)
+    ).distinct()}
+
+
 @retry_transaction()
-def update_file_after_download(session, file, filesize, mtime, downloaded_date, md5):
+def update_file_after_download(session, file, filesize, mtime, downloaded_date, md5, digest=None,
+                               digest_algorithm=None, writer=None):
     """
     Update file object after download
     :param session: orm session
@@ -128,28 +236,45 @@ def update_file_after_download(session, file, filesize, mtime, downloaded_date,
     :param mtime:
     :param downloaded_date:
     :param md5:
+    :param digest: stronger digest of the file (hexdigest) or None
+    :param digest_algorithm: hashlib name of digest
+    :param writer: queue update in write-behind writer instead of committing it directly
     :return:
     """
+    if writer is not None:
+        writer.update(File, dict(id=file.id, filesize=filesize, mtime=mtime, downloaded_date=downloaded_date,
+                                 md5sum_file=md5, digest_file=digest, digest_algorithm=digest_algorithm,
+                                 partial_size=None, downloaded=True))
+        return
+
     file.filesize = filesize
     file.mtime = mtime
     file.downloaded_date = downloaded_date
     file.md5sum_file = md5
+    file.digest_file = digest
+    file.digest_algorithm = digest_algorithm
+    file.partial_size = None
     file.downloaded = True
 
     session.commit()
 
 @retry_transaction()
-def update_duplicate_file_after_download(session, file, duplicate_file, mtime, downloaded_date):
+def update_duplicate_file_after_download(session, file, duplicate_id, mtime, downloaded_date, writer=None):
     """
     Add an alternative file if file already exists(by md5sum)
     :param session: orm session
     :param file: file object
-    :param duplicate_file: file object of duplicate file with same md5sum
+    :param duplicate_id: id of duplicate file with same md5sum
     :param mtime: mtime of file
     :param downloaded_date: downlodaded date of alternative file
+    :param writer: queue update in write-behind writer instead of committing it directly
     :return: file object
     """
-    file.duplicate_id = duplicate_file.id
+    if writer is not None:
+        writer.update(File, dict(id=file.id, duplicate_id=duplicate_id, mtime=mtime, downloaded_date=downloaded_date))
+        return file
+
+    file.duplicate_id = duplicate_id
     file.mtime = mtime
     file.downloaded_date = downloaded_date
 
@@ -229,6 +354,32 @@ def get_broken_db_download_entry(session):
     return session.query(File).filter(File.duplicate_id.is_(None), File.downloaded.is_(False)).all()
 
 
+def get_unfinished_downloads(session):
+    """
+    Get files which were inserted but not downloaded (interrupted or failed), biggest partial downloads first
+    """
+    return session.query(File).filter(
+        File.duplicate_id.is_(None),
+        File.downloaded.is_(False),
+        or_(File.deleted.is_(None), File.deleted.is_(False))
+    ).order_by(File.partial_size.is_(None), File.partial_size.desc(), File.id).all()
+
+
+@retry_transaction()
+def update_partial_size(session, file, partial_size, writer=None):
+    """
+    Store size of the partial download of a file
+    :param partial_size: bytes in partial-dir or None
+    :param writer: queue update in write-behind writer instead of committing it directly
+    """
+    if writer is not None:
+        writer.update(File, dict(id=file.id, partial_size=partial_size))
+        return
+
+    file.partial_size = partial_size
+    session.commit()
+
+
 def get_broken_db_encrypt_entry(session):
     """
     Get a list with malformed (typically unfinished) encrypt entries.
@@ -246,12 +397,13 @@ def update_broken_db_encrypt_entry(session, file):
 
 def get_files_to_be_written(session):
     """
-    Get all files that are ready to be written onto a tape.
+    Get all files that are ready to be written onto a tape (members of containers are written with their container).
     """
     return session.query(File).filter(
         File.downloaded.is_(True),
         File.encrypted.is_(True),
-        File.written.is_(False)
+        File.written.is_(False),
+        File.id.notin_(session.query(ContainerMember.file_id))
     ).all()
 
 
@@ -264,6 +416,97 @@ def get_not_deleted_files(session, base_path):
         return_data.append(f"{base_path}/{tut[0]}")
     return return_data
 
+def iter_files_by_path(session, prefix=None, batch_size=10000):
+    """
+    Iterate (path, deleted, filesize, mtime) of all files sorted by path, uses the unique index on path. It reads in
+    batches, every batch is a short read transaction, so other threads can still write to database while iterating.
+    :param prefix: only files inside of this relative directory
+    """
+    if prefix is None or prefix == '.':
+        last, end = None, None
+    else:
+        # All paths starting with 'prefix/' are between 'prefix/' and 'prefix0' ('0' follows '/')
+        last, end = f"{prefix}/", f"{prefix}0"
+
+    while True:
+        query = session.query(File.path, File.deleted, File.filesize, File.mtime)
+        if last is not None:
+            query = query.filter(File.path > last)
+        if end is not None:
+            query = query.filter(File.path < end)
+        rows = query.order_by(File.path).limit(batch_size).all()
+        session.rollback()
+        if not rows:
+            return
+        for row in rows:
+            yield row.path, bool(row.deleted), row.filesize, row.mtime
+        last = rows[-1].path
+
+
+def get_directories(session):
+    """
+    Get state of all directories from last complete scan
+    :return: dict path -> (mtime_ns, file_count)
+    """
+    directories = {row.path: (row.mtime_ns, row.file_count)
+                   for row in session.query(Directory.path, Directory.mtime_ns, Directory.file_count)}
+    session.rollback()
+    return directories
+
+
+@retry_transaction()
+def replace_directories(session, directories):
+    """
+    Replace state of all directories in one transaction
+    :param directories: list of dicts with path, mtime_ns and file_count
+    """
+    session.query(Directory).delete()
+    session.bulk_insert_mappings(Directory, directories)
+    session.commit()
+
+
+@retry_transaction(sleeptime=0.5)
+def get_fingerprint(session, device, inode):
+    """
+    Get cached digests of a file
+    :return: row (size, mtime_ns, md5sum, digest, digest_algorithm) or None
+    """
+    fingerprint = session.query(Fingerprint.size, Fingerprint.mtime_ns, Fingerprint.md5sum, Fingerprint.digest,
+                                Fingerprint.digest_algorithm).filter(Fingerprint.device == device,
+                                                                     Fingerprint.inode == inode).first()
+    session.rollback()
+    return fingerprint
+
+
+@retry_transaction()
+def upsert_fingerprint(session, values, writer=None):
+    """
+    Store digests of a file, replaces the fingerprint of the same device and inode
+    :param values: dict with device, inode, size, mtime_ns, md5sum, digest and digest_algorithm
+    :param writer: queue insert in write-behind writer instead of committing it directly
+    """
+    if writer is not None:
+        writer.upsert(Fingerprint, values)
+        return
+
+    session.execute(insert(Fingerprint.__table__).prefix_with('OR REPLACE'), [values])
+    session.commit()
+
+
+@retry_transaction()
+def delete_fingerprint(session, device, inode, writer=None):
+    """
+    Remove the fingerprint of a file which gets deleted
+    :param writer: queue delete in write-behind writer instead of committing it directly
+    """
+    if writer is not None:
+        writer.delete(Fingerprint, dict(device=device, inode=inode))
+        return
+
+    session.query(Fingerprint).filter(Fingerprint.device == device, Fingerprint.inode == inode).delete()
+    session.commit()
+
+
 @retry_transaction()
 def set_file_deleted(session, filepath, base_path):
     """
@@ -314,7 +557,9 @@ def get_files_to_be_encrypted(session):
     """
     Get all files which are downloaded and waiting to be encrypted.
     """
-    return session.query(File).filter(File.downloaded.is_(True), File.encrypted.is_(False)).all()
+    # written is always false here, the condition lets SQLite use the partial index ix_file_pending
+    return session.query(File).filter(File.downloaded.is_(True), File.encrypted.is_(False),
+                                      File.written.is_(False)).all()
 
 
 @retry_transaction(sleeptime=0.5)
@@ -322,7 +567,8 @@ def filename_encrypted_already_used(session, filename_encrypted):
     """
     Check if filename_encrypted is already in use to prevent errors.
     """
-    return len(session.query(File).filter(File.filename_encrypted == filename_encrypted).all()) > 0
+    return len(session.query(File).filter(File.filename_encrypted == filename_encrypted).all()) > 0 or \
+        session.query(Container).filter(Container.filename_encrypted == filename_encrypted).first() is not None
 
 
 @retry_transaction()
@@ -337,10 +583,16 @@ def update_filename_enc(session, file_id, filename_enc):
 
 
 @retry_transaction()
-def update_file_after_encrypt(session, file, filesize, encrypted_date, md5sum_encrypted):
+def update_file_after_encrypt(session, file, filesize, encrypted_date, md5sum_encrypted, writer=None):
     """
     Update file after encryption to set filessize, date and md5sum
+    (queued in write-behind writer if given)
     """
+    if writer is not None:
+        writer.update(File, dict(id=file.id, filesize_encrypted=filesize, encrypted_date=encrypted_date,
+                                 md5sum_encrypted=md5sum_encrypted, encrypted=True))
+        return
+
     file.filesize_encrypted = filesize
     file.encrypted_date = encrypted_date
     file.md5sum_encrypted = md5sum_encrypted
@@ -388,26 +640,122 @@ def get_started_tape(session):
 @retry_transaction()
 def revert_written_to_tape_by_label(session, label):
     """
-    Use with caution! This will remove written and tape dependencies from all files attached to given label
+    Use with caution! This will remove written and tape dependencies from all files and containers attached to given
+    label
     """
-    for file in get_files_by_tapelabel(session, label):
+    for file in get_files_by_tapelabel(session, label) + get_containers_by_tapelabel(session, label):
         file.written = False
         file.written_date = None
         file.tape_id = None
         session.commit()
 
 @retry_transaction()
-def update_file_after_write(session, file, dt, label, tape_position=None):
+def update_file_after_write(session, file, dt, label, tape_position=None, writer=None):
     """
     Update file after written to tape with date, tape_id and position
+    (queued in write-behind writer if given, call writer.barrier() before relying on it)
     """
     tape = session.query(Tape).filter(Tape.label == label).first()
+    if writer is not None:
+        writer.update(File, dict(id=file.id, written_date=dt, tape_id=tape.id, written=True,
+                                 tapeposition=tape_position))
+        return
+
     file.written_date = dt
     file.tape_id = tape.id
     file.written = True
     file.tapeposition = tape_position
     session.commit()
 
+@retry_transaction()
+def insert_container(session, filename_encrypted, filesize, filesize_encrypted, md5sum_encrypted, encrypted_date,
+                     members, batch_size=500):
+    """
+    Add an encrypted container and mark its members as encrypted
+    :param members: list of tuples (file id, offset, length), offset and length in the plaintext of the container
+    :return: container
+    """
+    container = Container(filename_encrypted=filename_encrypted, filesize=filesize,
+                          filesize_encrypted=filesize_encrypted, md5sum_encrypted=md5sum_encrypted,
+                          encrypted_date=encrypted_date, member_count=len(members))
+    session.add(container)
+    session.flush()
+    session.bulk_insert_mappings(ContainerMember, [dict(container_id=container.id, file_id=file_id, offset=offset,
+                                                        length=length) for file_id, offset, length in members])
+    file_ids = [file_id for file_id, _, _ in members]
+    for i in range(0, len(file_ids), batch_size):
+        session.query(File).filter(File.id.in_(file_ids[i:i + batch_size])).update(
+            dict(filename_encrypted=None, encrypted_date=encrypted_date, encrypted=True), synchronize_session=False)
+    session.commit()
+    return container
+
+
+def get_containers_to_be_written(session):
+    """
+    Get all containers which are not written to tape yet
+    """
+    return session.query(Container).filter(Container.written.is_(False)).order_by(Container.id).all()
+
+
+def get_containers_by_tapelabel(session, label):
+    """
+    Get all containers which are written on a specific tape.
+    """
+    return session.query(Container).join(Tape).filter(Tape.label == label).all()
+
+
+def get_container_members(session, file_ids, batch_size=500):
+    """
+    Get the container position of files which are members of a container
+    :return: dict file id -> ContainerMember (with container loaded)
+    """
+    file_ids = list(file_ids)
+    members = {}
+    for i in range(0, len(file_ids), batch_size):
+        for member in session.query(ContainerMember).options(joinedload(ContainerMember.container)).filter(
+                ContainerMember.file_id.in_(file_ids[i:i + batch_size])):
+            members[member.file_id] = member
+    return members
+
+
+@retry_transaction()
+def update_container_after_write(session, container, dt, label, tape_position=None):
+    """
+    Update container and all its members after the container was written to tape
+    """
+    tape = session.query(Tape).filter(Tape.label == label).first()
+    session.query(File).filter(
+        File.id.in_(session.query(ContainerMember.file_id).filter(ContainerMember.container_id == container.id))
+    ).update(dict(written_date=dt, tape_id=tape.id, written=True), synchronize_session=False)
+    container.written_date = dt
+    container.tape_id = tape.id
+    container.tapeposition = tape_position
+    container.written = True
+    session.commit()
+
+
+@retry_transaction()
+def update_tapepositions(session, positions, batch_size=500):
+    """
+    Set the LTFS start block of files and containers in bulk
+    :param positions: dict filename_encrypted -> start block
+    :return: tuple (count of files, count of containers)
+    """
+    names = list(positions)
+    files = 0
+    containers = 0
+    for i in range(0, len(names), batch_size):
+        batch = names[i:i + batch_size]
+        rows = session.query(File.id, File.filename_encrypted).filter(File.filename_encrypted.in_(batch)).all()
+        session.bulk_update_mappings(File, [dict(id=id, tapeposition=positions[name]) for id, name in rows])
+        files += len(rows)
+        rows = session.query(Container.id, Container.filename_encrypted).filter(
+            Container.filename_encrypted.in_(batch)).all()
+        session.bulk_update_mappings(Container, [dict(id=id, tapeposition=positions[name]) for id, name in rows])
+        containers += len(rows)
+    session.commit()
+    return files, containers
+
 @retry_transaction()
 def update_tape_end_position(session, label, tape_position):
     """
@@ -1,10 +1,36 @@
 import logging
 import sqlite3
+import threading
 import time
 from sqlalchemy.exc import OperationalError
 
 logger = logging.getLogger()
 
+_retry_count = 0
+_retry_count_lock = threading.Lock()
+
+
+def count_retry():
+    """
+    Count a retry because of a locked database
+    """
+    global _retry_count
+    with _retry_count_lock:
+        _retry_count += 1
+
+
+def get_retry_count(reset=False):
+    """
+    Get number of retries because of a locked database since start (or last reset)
+    """
+    global _retry_count
+    with _retry_count_lock:
+        count = _retry_count
+        if reset:
+            _retry_count = 0
+    return count
+
+
 def retry_transaction(max_retries=10, sleeptime=5):
     """
     Decorator to wrap functions which writes to the sqlite database to prevent "database is locked" error with multithreading.
@@ -16,6 +42,7 @@ def retry_transaction(max_retries=10, sleeptime=5):
                     return fn(session, *args, **kwargs)
                 except (OperationalError, sqlite3.OperationalError) as e:
                     session.rollback()
+                    count_retry()
                     if attempt == max_retries - 1:
                         logger.error("Database locked, giving up. (%s/%s). Error: %s", attempt+1, max_retries, e)
                         logger.error("Please run ./main.py db repair to remove stale entries!")
@@ -0,0 +1,81 @@
+import logging
+import os
+import time
+from lib import database
+
+logger = logging.getLogger()
+
+## Files modified less than this many seconds before hashing are not cached, a change within the same timestamp
+## would not be noticed
+RACY_SECONDS = 2
+
+
+def _signed(value):
+    """
+    SQLite integers are signed 64 bit, device and inode numbers are unsigned
+    """
+    return value - 2 ** 64 if value >= 2 ** 63 else value
+
+
+class FingerprintCache:
+    """
+    Reuses md5sum and digest of a file if device, inode, size and mtime_ns are the same as when it was hashed
+    (config 'fingerprint-cache'). Saves hashing files again after an interrupted run or a database repair.
+    """
+    def __init__(self, config, hasher, writer=None):
+        self.enabled = bool(config.get('fingerprint-cache', True))
+        self.hasher = hasher
+        self.writer = writer
+        self.hits = 0
+
+    def hash_file(self, session, path, st=None, algorithms=None):
+        """
+        Hash a file or take its digests from cache
+        :param st: os.stat result of path, if already known
+        :param algorithms: 'md5' and optionally the configured digest [Default: both]
+        :return: dict algorithm -> hexdigest
+        """
+        if algorithms is None:
+            algorithms = self.hasher.algorithms()
+        if not self.enabled:
+            return self.hasher.hash_file(path, algorithms)
+
+        if st is None:
+            st = os.stat(path)
+        device = _signed(st.st_dev)
+        inode = _signed(st.st_ino)
+        row = database.get_fingerprint(session, device, inode)
+        hashes = {}
+        if row is not None and row.size == st.st_size and row.mtime_ns == st.st_mtime_ns:
+            if row.md5sum is not None:
+                hashes['md5'] = row.md5sum
+            if row.digest is not None:
+                hashes[row.digest_algorithm] = row.digest
+            if all(algorithm in hashes for algorithm in algorithms):
+                self.hits += 1
+                logger.debug(f"Digests taken from fingerprint cache: {path}")
+                return hashes
+
+        time_started = time.time()
+        hashes = self.hasher.hash_file(path, algorithms)
+        st_after = os.stat(path)
+        if (st_after.st_size, st_after.st_mtime_ns) != (st.st_size, st.st_mtime_ns) or \
+                time_started - st.st_mtime < RACY_SECONDS:
+            # Changed while hashing or too recently modified, don't trust it next time
+            return hashes
+
+        digest_algorithm = next((algorithm for algorithm in hashes if algorithm != 'md5'), None)
+        database.upsert_fingerprint(session, dict(device=device, inode=inode, size=st.st_size,
+                                                  mtime_ns=st.st_mtime_ns, md5sum=hashes.get('md5'),
+                                                  digest=hashes.get(digest_algorithm),
+                                                  digest_algorithm=digest_algorithm),
+                                    writer=self.writer)
+        return hashes
+
+    def forget(self, session, st):
+        """
+        Remove the fingerprint of a file before it is deleted, its inode can be used again by another file
+        :param st: os.stat result of the file
+        """
+        if self.enabled:
+            database.delete_fingerprint(session, _signed(st.st_dev), _signed(st.st_ino), writer=self.writer)
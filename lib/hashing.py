@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+
+logger = logging.getLogger()
+
+## Read block size, hashlib releases the GIL while hashing blocks this big, so threads hash in parallel
+BLOCK_SIZE = 4 * 1024 * 1024
+
+## Stronger digests which can be stored additionally to md5 (config 'hashing: digest')
+DIGESTS = ('sha256', 'sha512', 'blake2b', 'blake2s', 'sha3_256')
+
+
+def new_hashes(algorithms):
+    return [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+
+
+def hash_stream(reader, algorithms=('md5',), block_size=BLOCK_SIZE):
+    """
+    Hash a binary stream with one or more algorithms in a single pass. The stream is read with readinto() into one
+    buffer, which is used again for every block.
+    :return: dict algorithm -> hexdigest
+    """
+    hashes = new_hashes(algorithms)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    while True:
+        count = reader.readinto(buffer)
+        if not count:
+            break
+        for _, h in hashes:
+            h.update(view[:count])
+    return {algorithm: h.hexdigest() for algorithm, h in hashes}
+
+
+def hash_mmap(path, algorithms=('md5',), block_size=BLOCK_SIZE):
+    """
+    Like hash_stream, but the file is mapped into memory instead of copied into a buffer
+    :return: dict algorithm -> hexdigest
+    """
+    hashes = new_hashes(algorithms)
+    with open(path, mode='rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(m)
+                try:
+                    for offset in range(0, size, block_size):
+                        block = view[offset:offset + block_size]
+                        for _, h in hashes:
+                            h.update(block)
+                        block.release()
+                finally:
+                    view.release()
+    return {algorithm: h.hexdigest() for algorithm, h in hashes}
+
+
+def hash_file(path, algorithms=('md5',), block_size=BLOCK_SIZE, use_mmap=False):
+    """
+    Hash a file with hash_stream or hash_mmap
+    :return: dict algorithm -> hexdigest
+    """
+    if use_mmap:
+        return hash_mmap(path, algorithms, block_size)
+    with open(path, mode='rb', buffering=0) as f:
+        return hash_stream(f, algorithms, block_size)
+
+
+class HashingReader:
+    """
+    Wraps a binary stream and hashes everything which is read from it, e.g. to hash a download while it is
+    encrypted
+    """
+    def __init__(self, reader, algorithms=('md5',)):
+        self.reader = reader
+        self.hashes = new_hashes(algorithms)
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        if data:
+            for _, h in self.hashes:
+                h.update(data)
+            self.size += len(data)
+        return data
+
+    def hexdigests(self):
+        """
+        :return: dict algorithm -> hexdigest of all data read until now
+        """
+        return {algorithm: h.hexdigest() for algorithm, h in self.hashes}
+
+
+class Hasher:
+    """
+    Hashes files with the settings of config 'hashing':
+        digest: stronger digest stored additionally to md5 (e.g. sha256, blake2b), empty for md5 only
+        block-size: read block size (parsed by the caller, e.g. 4M)
+        mmap: map files into memory instead of reading them
+        threads: files hashed at the same time over all stages, 0 for no limit. Set it to what the staging
+            storage handles best (e.g. 1-2 for a single disk, more for SSD or an array)
+    """
+    def __init__(self, config, block_size=BLOCK_SIZE):
+        hashing_config = config.get('hashing') or {}
+        # Checked against DIGESTS when the config is loaded
+        self.digest = hashing_config.get('digest') or None
+        self.block_size = block_size
+        self.use_mmap = bool(hashing_config.get('mmap', False))
+        self.threads = int(hashing_config.get('threads') or 0)
+        self.slots = threading.BoundedSemaphore(self.threads) if self.threads > 0 else None
+
+    def algorithms(self, digest=True):
+        """
+        :param digest: include the stronger digest
+        """
+        if digest and self.digest is not None:
+            return 'md5', self.digest
+        return 'md5',
+
+    def hash_file(self, path, algorithms=None):
+        """
+        Hash a file, waits while 'threads' other files are hashed
+        :param algorithms: hashlib algorithms [Default: md5 and configured digest]
+        :return: dict algorithm -> hexdigest
+        """
+        if algorithms is None:
+            algorithms = self.algorithms()
+        if self.slots is not None:
+            self.slots.acquire()
+        try:
+            return hash_file(path, algorithms, self.block_size, self.use_mmap)
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+    def md5sum(self, path):
+        return self.hash_file(path, ('md5',))['md5']
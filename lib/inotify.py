@@ -0,0 +1,141 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+from collections import namedtuple
+
+logger = logging.getLogger()
+
+# Event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+Event = namedtuple('Event', ['wd', 'mask', 'cookie', 'name', 'path'])
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        if name is None:
+            raise OSError(errno.ENOSYS, "C library not found")
+        _libc = ctypes.CDLL(name, use_errno=True)
+        for function in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+            if not hasattr(_libc, function):
+                raise OSError(errno.ENOSYS, f"{function} not available")
+    return _libc
+
+
+def available():
+    """
+    Check if inotify can be used (Linux only)
+    """
+    try:
+        _get_libc()
+        return True
+    except OSError:
+        return False
+
+
+class Inotify:
+    """
+    Minimal inotify wrapper (ctypes, no dependencies). Watches are not recursive, every directory needs its own watch.
+    Events carry the full path (directory of the watch + name).
+    """
+    def __init__(self, mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE | IN_MODIFY |
+                 IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK):
+        self.libc = _get_libc()
+        self.mask = mask
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.watches = {}
+        self.paths = {}
+
+    def add_watch(self, path):
+        """
+        Watch a directory, adding the same directory again returns the existing watch descriptor
+        :return: watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(self.mask))
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        old_path = self.watches.get(wd)
+        if old_path is not None and old_path != path:
+            self.paths.pop(old_path, None)
+        self.watches[wd] = path
+        self.paths[path] = wd
+        return wd
+
+    def remove_path(self, path):
+        """
+        Forget the watches of a directory and all directories below (e.g. after it was moved away)
+        """
+        prefix = path + os.sep
+        for watched in [watched for watched in self.paths if watched == path or watched.startswith(prefix)]:
+            wd = self.paths.pop(watched)
+            self.watches.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds for events
+        :return: list of Event, empty on timeout
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                if directory is not None and self.paths.get(directory) == wd:
+                    del self.paths[directory]
+                self.watches.pop(wd, None)
+                continue
+            if directory is None and not mask & IN_Q_OVERFLOW:
+                continue
+            path = os.path.join(directory, name) if directory is not None and name else directory
+            events.append(Event(wd, mask, cookie, name, path))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
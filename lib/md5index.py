@@ -0,0 +1,133 @@
+import bisect
+import logging
+import threading
+import time
+from array import array
+from lib.models import File
+
+logger = logging.getLogger()
+
+DIGEST_SIZE = 16
+
+
+class _DigestView:
+    """
+    Read only sequence over the digests in a bytearray, used for bisect
+    """
+    def __init__(self, digests):
+        self.digests = digests
+
+    def __len__(self):
+        return len(self.digests) // DIGEST_SIZE
+
+    def __getitem__(self, i):
+        return bytes(self.digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+
+
+class Md5Index:
+    """
+    Compact in memory index md5sum -> file id for duplicate detection.
+
+    Files from database are kept in a sorted array of 16 byte digests plus an array of ids (binary search), about
+    24 bytes per file. Files added while running are kept in a dict. All access is protected by a lock.
+    """
+    def __init__(self):
+        self.digests = bytearray()
+        self.ids = array('q')
+        self.added = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.ids) + len(self.added)
+
+    def load(self, session, batch_size=100000):
+        """
+        Load md5sums of all downloaded files (without duplicates) from database
+        """
+        time_started = time.time()
+        digests = bytearray()
+        ids = array('q')
+        last = None
+        is_sorted = True
+        query = session.query(File.md5sum_file, File.id).filter(
+            File.md5sum_file.isnot(None),
+            File.duplicate_id.is_(None)
+        ).order_by(File.md5sum_file, File.id).yield_per(batch_size)
+        for md5, file_id in query:
+            try:
+                digest = bytes.fromhex(md5)
+            except ValueError:
+                continue
+            if len(digest) != DIGEST_SIZE or digest == last:
+                continue
+            if last is not None and digest < last:
+                is_sorted = False
+            digests += digest
+            ids.append(file_id)
+            last = digest
+
+        if not is_sorted:
+            # md5sums with upper case letters are not sorted by the database like the bytes
+            order = sorted(range(len(ids)), key=lambda i: digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+            digests = b''.join(bytes(digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]) for i in order)
+            digests = bytearray(digests)
+            ids = array('q', (ids[i] for i in order))
+
+        with self.lock:
+            self.digests = digests
+            self.ids = ids
+            self.added = {}
+
+        count = len(ids)
+        memory = self.memory_usage()
+        logger.info(f"Loaded md5 index with {count} files, memory: {memory / 1024 / 1024:.1f} MiB "
+                    f"({self.memory_per_million() / 1024 / 1024:.1f} MiB per million files)")
+        logger.debug(f"Execution Time: Loading md5 index: {time.time() - time_started} seconds")
+
+    def _find(self, digest):
+        i = bisect.bisect_left(_DigestView(self.digests), digest)
+        if i < len(self.ids) and self.digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] == digest:
+            return self.ids[i]
+        return self.added.get(digest)
+
+    def get(self, md5):
+        """
+        :return: file id with this md5sum or None
+        """
+        digest = bytes.fromhex(md5)
+        with self.lock:
+            return self._find(digest)
+
+    def add(self, md5, file_id):
+        with self.lock:
+            self.added.setdefault(bytes.fromhex(md5), file_id)
+
+    def get_or_add(self, md5, file_id):
+        """
+        Look up md5sum and add it with file_id if it is unknown, in one step so two threads can't both add the same
+        md5sum
+        :return: id of the existing file or None if it was added
+        """
+        digest = bytes.fromhex(md5)
+        with self.lock:
+            existing = self._find(digest)
+            if existing is None:
+                self.added[digest] = file_id
+            return existing
+
+    def memory_usage(self):
+        """
+        Approximate memory usage in bytes
+        """
+        with self.lock:
+            memory = self.ids.buffer_info()[1] * self.ids.itemsize + len(self.digests)
+            # dict entry with bytes key and int value
+            memory += len(self.added) * 150
+        return memory
+
+    def memory_per_million(self):
+        """
+        Memory usage of the sorted arrays per million files in bytes
+        """
+        return (DIGEST_SIZE + self.ids.itemsize) * 1000000
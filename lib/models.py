@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, UniqueConstraint, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, UniqueConstraint, ForeignKey, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 Base = declarative_base()
@@ -31,8 +31,13 @@ class File(Base):
     filesize_encrypted = Column(Integer)
     md5sum_file = Column(String)
     md5sum_encrypted = Column(String)
+    # Stronger digest of the file (config 'hashing: digest'), built in the same pass as md5sum_file
+    digest_file = Column(String)
+    digest_algorithm = Column(String)
     tape_id = Column(Integer, ForeignKey('tape.id'))
     downloaded_date = Column(DateTime)
+    # Bytes of an interrupted download kept in the rsync partial-dir, NULL if there is none
+    partial_size = Column(Integer)
     encrypted_date = Column(DateTime)
     written_date = Column(DateTime)
     tapeposition = Column(Integer)
@@ -47,6 +52,15 @@ class File(Base):
     tape = relationship("Tape", back_populates="files")
     restoreJobFileMap = relationship("RestoreJobFileMap", back_populates="file")
 
+    __table_args__ = (
+        Index('ix_file_md5sum_file', 'md5sum_file'),
+        Index('ix_file_filesize', 'filesize'),
+        Index('ix_file_tape_id', 'tape_id'),
+        Index('ix_file_state', 'downloaded', 'encrypted', 'written'),
+        # Only files which are not on tape yet, stays small while the table grows
+        Index('ix_file_pending', 'downloaded', 'encrypted', sqlite_where=text('written IS 0')),
+    )
+
     def __repr__(self):
         return f'File object: {self.path}'
 
@@ -64,6 +78,7 @@ class Tape(Base):
     verified_last = Column(DateTime)
 
     files = relationship("File", back_populates="tape")
+    containers = relationship("Container", back_populates="tape")
 
     def __repr__(self):
         return f'Tape object: {self.label}'
@@ -91,7 +106,110 @@ class RestoreJobFileMap(Base):
     file = relationship("File", back_populates="restoreJobFileMap")
     restore_job = relationship("RestoreJob")
 
-    __table_args__ = (UniqueConstraint('file_id', 'restore_job_id'),)
+    __table_args__ = (
+        UniqueConstraint('file_id', 'restore_job_id'),
+        Index('ix_restore_job_file_map_restore_job_id', 'restore_job_id'),
+    )
 
     def __repr__(self):
         return f'Restore job file map object: {self.id} job {self.restore_job_id} file {self.file_id} restored {self.restored}'
+
+
+class Directory(Base):
+    """
+    State of a remote directory from the last complete get run (get-scan-directories). If the mtime of a directory
+    is unchanged, its direct files are unchanged too and they are not listed again. mtime_ns is NULL if the
+    directory has to be listed again next time.
+    """
+    __tablename__ = 'directory'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False, unique=True)
+    mtime_ns = Column(Integer)
+    file_count = Column(Integer, default=0)
+
+    def __repr__(self):
+        return f'Directory object: {self.path}'
+
+
+class Fingerprint(Base):
+    """
+    Digests of a local file, valid as long as device, inode, size and mtime_ns are unchanged. Used to skip hashing
+    files again (e.g. after an interrupted get).
+    """
+    __tablename__ = 'fingerprint'
+
+    id = Column(Integer, primary_key=True)
+    device = Column(Integer, nullable=False)
+    inode = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+    mtime_ns = Column(Integer, nullable=False)
+    md5sum = Column(String)
+    digest = Column(String)
+    digest_algorithm = Column(String)
+
+    __table_args__ = (
+        UniqueConstraint('device', 'inode'),
+    )
+
+    def __repr__(self):
+        return f'Fingerprint object: {self.device}:{self.inode}'
+
+
+class Container(Base):
+    """
+    Small files packed into one encrypted file (config 'container'). The plaintext of the members is concatenated and
+    encrypted like a single file, offsets of the members are stored in ContainerMember. Member files are encrypted and
+    written together with their container, they have no filename_encrypted themselves.
+    """
+    __tablename__ = 'container'
+
+    id = Column(Integer, primary_key=True)
+    filename_encrypted = Column(String, nullable=False, unique=True)
+    filesize = Column(Integer)
+    filesize_encrypted = Column(Integer)
+    md5sum_encrypted = Column(String)
+    member_count = Column(Integer, default=0)
+    tape_id = Column(Integer, ForeignKey('tape.id'))
+    encrypted_date = Column(DateTime)
+    written_date = Column(DateTime)
+    # LTFS start block on tape
+    tapeposition = Column(Integer)
+    written = Column(Boolean, default=False)
+
+    tape = relationship("Tape", back_populates="containers")
+    members = relationship("ContainerMember", back_populates="container")
+
+    __table_args__ = (
+        Index('ix_container_tape_id', 'tape_id'),
+    )
+
+    @property
+    def filename(self):
+        return f"container {self.id} ({self.member_count} files)"
+
+    def __repr__(self):
+        return f'Container object: {self.filename_encrypted}'
+
+
+class ContainerMember(Base):
+    """
+    Position of a file inside the plaintext of its container
+    """
+    __tablename__ = 'container_member'
+
+    id = Column(Integer, primary_key=True)
+    container_id = Column(Integer, ForeignKey('container.id'), nullable=False)
+    file_id = Column(Integer, ForeignKey('file.id'), nullable=False, unique=True)
+    offset = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
+
+    container = relationship("Container", back_populates="members")
+    file = relationship("File")
+
+    __table_args__ = (
+        Index('ix_container_member_container_id', 'container_id'),
+    )
+
+    def __repr__(self):
+        return f'Container member object: container {self.container_id} file {self.file_id} offset {self.offset}'
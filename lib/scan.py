@@ -0,0 +1,117 @@
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger()
+
+## One file of a listing, size (bytes) and mtime (seconds since epoch, float) are None if unknown
+Entry = namedtuple('Entry', ['path', 'size', 'mtime'], defaults=(None, None))
+
+## find -printf format of a listing record, parsed by parse_find_record
+FIND_PRINTF = '%s %T@ %p\\0'
+
+NEW = 'new'
+KNOWN = 'known'
+DELETED = 'deleted'
+IGNORED = 'ignored'
+
+
+def merge_diff(listing, known):
+    """
+    Merge join of a sorted file listing against the sorted file paths from database. Both sides are consumed as
+    streams, nothing is loaded into memory.
+
+    Yields (state, entry, row):
+        NEW: path is only in listing (row is None)
+        KNOWN: path is in listing and in database
+        IGNORED: path is in listing and in database, but marked as deleted there
+        DELETED: path is only in database and not marked as deleted yet (entry has the path only)
+
+    :param listing: iterable of Entry with relative paths, sorted by code point (same as 'LC_ALL=C sort' for utf-8)
+    :param known: iterable of tuples from database, relative path first and deleted flag second, sorted the same way
+    """
+    listing = _ensure_sorted(listing, 'file listing', key=lambda i: i.path)
+    known = _ensure_sorted(known, 'database', key=lambda i: i[0])
+
+    row = next(known, None)
+    for entry in listing:
+        while row is not None and row[0] < entry.path:
+            if not row[1]:
+                yield DELETED, Entry(row[0]), row
+            row = next(known, None)
+
+        if row is not None and row[0] == entry.path:
+            yield (IGNORED if row[1] else KNOWN), entry, row
+            row = next(known, None)
+        else:
+            yield NEW, entry, None
+
+    while row is not None:
+        if not row[1]:
+            yield DELETED, Entry(row[0]), row
+        row = next(known, None)
+
+
+def _ensure_sorted(iterable, name, key=lambda i: i):
+    """
+    Pass through items, raises ValueError if they are not strictly ascending. A wrong order would mark existing
+    files as deleted, so never continue with it.
+    """
+    last = None
+    for item in iterable:
+        current = key(item)
+        if last is not None and current <= last:
+            raise ValueError(f"Entries from {name} are not sorted: '{last}' before '{current}'")
+        last = current
+        yield item
+
+
+def is_below(path, prefix):
+    """
+    Check if relative path is inside of directory prefix ('.' or None means everything)
+    """
+    if prefix is None or prefix == '.':
+        return True
+    return path.startswith(f"{prefix}/")
+
+
+def parse_find_record(record):
+    """
+    Parse a record of find -printf FIND_PRINTF ('<size> <mtime> <path>') into an Entry
+    """
+    size, mtime, path = record.split(' ', 2)
+    return Entry(path, int(size), float(mtime))
+
+
+def parse_mtime_ns(value):
+    """
+    Parse a timestamp of find %T@ ('<seconds>.<fraction>') into integer nanoseconds without float rounding
+    """
+    seconds, _, fraction = value.partition('.')
+    return int(seconds) * 1000000000 + int((fraction + '000000000')[:9])
+
+
+def parent(path):
+    """
+    Directory of a relative path ('.' for files on top level)
+    """
+    directory, _, _ = path.rpartition('/')
+    return directory or '.'
+
+
+def iter_records(stream, separator=b'\0', chunk_size=1048576):
+    """
+    Split a binary stream into records, reading it in big chunks instead of lines
+    :return: generator over decoded records (empty records are skipped)
+    """
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        records = (rest + chunk).split(separator)
+        rest = records.pop()
+        for record in records:
+            if record:
+                yield record.decode('utf-8')
+    if rest:
+        yield rest.decode('utf-8')
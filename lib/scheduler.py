@@ -0,0 +1,371 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger()
+
+
+class WorkerPool:
+    """
+    Bounded pool of worker threads for one stage (get, encrypt, ...).
+
+    submit() blocks as long as all workers are busy and the queue is full, so the caller is throttled without
+    polling threading.active_count(). Every job returns a future. The number of workers can be changed while jobs
+    are running with resize() (up to max_workers), jobs report their processed files with record().
+    """
+    def __init__(self, name, workers, queue_size=0, max_workers=None):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, max_workers or workers), thread_name_prefix=name)
+        self.futures = set()
+        self.running = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.cancelled = threading.Event()
+        self.completed_files = 0
+        self.completed_bytes = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue a job, blocks until a slot is free.
+        :return: future, or None if the pool got cancelled while waiting
+        """
+        with self.changed:
+            while len(self.futures) >= self.workers + self.queue_size:
+                if self.cancelled.is_set():
+                    return None
+                self.changed.wait(0.5)
+            if self.cancelled.is_set():
+                return None
+            future = self.executor.submit(self._run, fn, args, kwargs)
+            self.futures.add(future)
+        future.add_done_callback(self._job_done)
+        return future
+
+    def _run(self, fn, args, kwargs):
+        """
+        Run a job as soon as less than self.workers jobs are running, a cancelled job returns without waiting
+        """
+        with self.changed:
+            while self.running >= self.workers:
+                if self.cancelled.is_set():
+                    return None
+                self.changed.wait()
+            if self.cancelled.is_set():
+                return None
+            self.running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.changed:
+                self.running -= 1
+                self.changed.notify_all()
+
+    def _job_done(self, future):
+        with self.changed:
+            self.futures.discard(future)
+            self.changed.notify_all()
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Job in worker pool '{self.name}' failed: {future.exception()!r}",
+                         exc_info=future.exception())
+
+    def active(self):
+        """
+        Count of running and queued jobs
+        """
+        with self.lock:
+            return len(self.futures)
+
+    def busy(self):
+        """
+        True if all workers are running a job
+        """
+        with self.lock:
+            return self.running >= self.workers
+
+    def resize(self, workers):
+        """
+        Change the number of jobs running at the same time, running jobs are not interrupted
+        """
+        with self.changed:
+            self.workers = workers
+            self.changed.notify_all()
+
+    def record(self, size):
+        """
+        Count a processed file for throughput statistics
+        :param size: filesize in bytes
+        """
+        with self.lock:
+            self.completed_files += 1
+            self.completed_bytes += size or 0
+
+    def stats(self):
+        """
+        :return: tuple (files, bytes) processed until now
+        """
+        with self.lock:
+            return self.completed_files, self.completed_bytes
+
+    def wait(self):
+        """
+        Wait until all submitted jobs are finished
+        """
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+
+    def cancel(self):
+        """
+        Cancel all queued jobs, running jobs will finish their current operation
+        """
+        self.cancelled.set()
+        with self.changed:
+            futures = list(self.futures)
+            self.changed.notify_all()
+        cancelled = sum(1 for future in futures if future.cancel())
+        if cancelled > 0:
+            logger.debug(f"Cancelled {cancelled} queued jobs in worker pool '{self.name}'")
+
+    def shutdown(self, wait=True):
+        """
+        :param wait: wait for running jobs, if False queued jobs are cancelled
+        """
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+class Scheduler:
+    """
+    Holds one worker pool per stage, sized from config['threads'][stage]. With 'adaptive-threads' the pool sizes are
+    changed while running by an AdaptiveController.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.interrupted = False
+        self.controller = None
+
+    def pool(self, stage, workers=None, queue_size=None):
+        """
+        Get (or create) the worker pool of a stage
+        :param stage: name of the stage, also key in config['threads']
+        :param workers: number of workers [Default: config['threads'][stage] or 1]
+        :param queue_size: number of jobs waiting in queue additionally to running ones [Default: workers]
+        """
+        with self.lock:
+            if stage not in self.pools:
+                if workers is None:
+                    workers = self.config.get('threads', {}).get(stage, 1)
+                if queue_size is None:
+                    queue_size = workers
+                max_workers = None
+                adaptive = self.config.get('adaptive-threads') or {}
+                if adaptive.get('enabled', False) and stage in adaptive:
+                    bounds = adaptive[stage]
+                    max_workers = int(bounds.get('max', workers))
+                    workers = min(max(workers, int(bounds.get('min', 1))), max_workers)
+                    if self.controller is None:
+                        self.controller = AdaptiveController(self, adaptive)
+                        self.controller.start()
+                self.pools[stage] = WorkerPool(stage, workers, queue_size, max_workers)
+                if self.interrupted:
+                    self.pools[stage].cancel()
+            return self.pools[stage]
+
+    def record(self, stage, size):
+        """
+        Count a processed file of a stage for throughput statistics
+        """
+        with self.lock:
+            pool = self.pools.get(stage)
+        if pool is not None:
+            pool.record(size)
+
+    def set_interrupted(self):
+        """
+        Cancel queued jobs in all pools and refuse new ones. Takes the pool locks, so don't call it in a signal
+        handler of a thread which submits jobs.
+        """
+        with self.lock:
+            self.interrupted = True
+            pools = list(self.pools.values())
+        if self.controller is not None:
+            self.controller.stop()
+        for pool in pools:
+            pool.cancel()
+
+    def wait(self):
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.wait()
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            pools = list(self.pools.values())
+        if self.controller is not None:
+            self.controller.stop()
+        for pool in pools:
+            pool.shutdown(wait)
+
+
+class AdaptiveController:
+    """
+    Changes the worker count of stages while running (config 'adaptive-threads'), AIMD-style: every interval the
+    throughput (bytes/s and files/s) of a busy stage is compared with the previous interval. As long as it does not
+    drop, one worker is added (additive increase, up to 'max'). If it drops by more than 'tolerance', the workers are
+    multiplied with 'decrease-factor' (multiplicative decrease, down to 'min'). If the last added worker brought no
+    gain, the count is kept. Stages whose workers are not all busy (e.g. waiting for the file list) are not changed.
+    """
+    def __init__(self, scheduler, config):
+        self.scheduler = scheduler
+        self.interval = float(config.get('interval', 30))
+        self.tolerance = float(config.get('tolerance', 0.1))
+        self.decrease_factor = float(config.get('decrease-factor', 0.75))
+        self.config = config
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='adaptive-threads', daemon=True)
+        # stage -> (time, files, bytes, rate of last interval, last change of workers)
+        self.state = {}
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.scheduler.lock:
+                pools = [(stage, pool) for stage, pool in self.scheduler.pools.items() if stage in self.config]
+            for stage, pool in pools:
+                self.adjust(stage, pool)
+
+    @staticmethod
+    def change(rate, previous):
+        """
+        Relative change of throughput, mean of bytes/s and files/s
+        """
+        changes = [(now - before) / before for now, before in zip(rate, previous) if before > 0]
+        return sum(changes) / len(changes) if changes else 0.0
+
+    def adjust(self, stage, pool):
+        now = time.monotonic()
+        files, size = pool.stats()
+        last = self.state.get(stage)
+        self.state[stage] = (now, files, size, None, 0)
+        if last is None:
+            return
+        last_time, last_files, last_size, last_rate, last_change = last
+        duration = now - last_time
+        rate = ((size - last_size) / duration, (files - last_files) / duration)
+        bounds = self.config[stage]
+        minimum = int(bounds.get('min', 1))
+        maximum = int(bounds.get('max', pool.workers))
+        workers = pool.workers
+        rate_info = f"{rate[0] / 1024 / 1024:.1f} MiB/s, {rate[1]:.1f} files/s"
+
+        if not pool.busy() and last_change <= 0:
+            decision, new_workers = "not all workers busy, keeping", workers
+        elif last_rate is None:
+            decision, new_workers = "first measurement with all workers busy, adding one", min(workers + 1, maximum)
+        else:
+            change = self.change(rate, last_rate)
+            rate_info += f" ({change:+.0%})"
+            if change < -self.tolerance:
+                new_workers = max(minimum, int(workers * self.decrease_factor))
+                decision = "throughput dropped, decreasing"
+            elif last_change > 0 and change < self.tolerance:
+                decision, new_workers = "no gain from last added worker, keeping", workers
+            else:
+                decision, new_workers = "throughput not dropping, adding one", min(workers + 1, maximum)
+
+        if new_workers != workers:
+            pool.resize(new_workers)
+        logger.info(f"Adaptive threads '{stage}': {rate_info} with {workers} workers, {decision}: {new_workers} "
+                    f"workers (min: {minimum}, max: {maximum})")
+        self.state[stage] = (now, files, size, rate, new_workers - workers)
+
+
+class ByteQueue:
+    """
+    FIFO queue between two stages which is bounded by the sum of the item sizes (bytes) instead of the item count.
+
+    put() blocks while the queue is full, get() can wait until a minimum amount of bytes is queued. After close()
+    put() drops items and get() returns the remaining items followed by None.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = deque()
+        self.bytes = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
+
+    def queued_bytes(self):
+        with self.cond:
+            return self.bytes
+
+    def put(self, item, size):
+        """
+        Add an item, blocks while the queue is full. An item bigger than max_bytes is accepted if the queue is empty.
+        :return: False if the queue is closed
+        """
+        with self.cond:
+            while not self.closed and self.items and self.bytes + size > self.max_bytes:
+                self.cond.wait()
+            if self.closed:
+                return False
+            self.items.append((item, size))
+            self.bytes += size
+            self.cond.notify_all()
+            return True
+
+    def get(self, min_bytes=0, timeout=None):
+        """
+        Get next item, waits until at least min_bytes are queued (or the queue got closed or timeout passed)
+        :return: item or None if queue is closed and empty
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while not self.closed:
+                if self.items and self.bytes >= min_bytes:
+                    break
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # Waited long enough, take whatever comes next
+                        min_bytes = 0
+                        deadline = None
+                        continue
+                    self.cond.wait(remaining)
+                else:
+                    self.cond.wait()
+            if not self.items:
+                return None
+            item, size = self.items.popleft()
+            self.bytes -= size
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def clear(self):
+        """
+        Close queue and drop all waiting items
+        """
+        with self.cond:
+            self.closed = True
+            self.items.clear()
+            self.bytes = 0
+            self.cond.notify_all()
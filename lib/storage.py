@@ -0,0 +1,191 @@
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger()
+
+## Directories counted against max_storage_usage
+STAGING_DIRS = ('local-data-dir', 'local-enc-dir', 'local-verify-dir')
+
+## Free space is read again from the filesystem (statvfs, cheap) after this many seconds
+FREE_REFRESH_INTERVAL = 10
+
+
+def scan_size(path, visit=None):
+    """
+    Size of all files below path (scandir, symlinks are not followed), missing directories count as 0
+    :param visit: called with every directory before it is read
+    """
+    total = 0
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        if visit is not None:
+            visit(directory)
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except FileNotFoundError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return total
+
+
+class StorageLedger:
+    """
+    Used bytes of the staging directories (local-data-dir, local-enc-dir, local-verify-dir) and free bytes of their
+    filesystems, kept up to date in memory.
+
+    A baseline is scanned at first use, afterwards get, encrypt and write report every file they add or delete with
+    add() and remove(), so checks are O(1) instead of walking all directories for every file. Every
+    'storage-resync-interval' seconds the directories are scanned again to correct drift (failed transfers, files
+    changed by other programs), the free space of the filesystems is read again every FREE_REFRESH_INTERVAL seconds.
+    Changes reported while a resync scans are kept per directory: they are dropped when the scan reads their
+    directory afterwards (the scan sees them) and added to the scanned sizes otherwise.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.resync_interval = float(config.get('storage-resync-interval', 600))
+        self.lock = threading.Lock()
+        # Only one resync scans at a time
+        self.resync_lock = threading.Lock()
+        self.used = {}
+        self.free = {}
+        self.devices = {}
+        self.last_resync = None
+        self.last_free_refresh = None
+        # Changes by add() while a resync is scanning: directory -> {key: bytes}, None if no resync is running
+        self.pending = None
+
+    def paths(self):
+        paths = {}
+        for key in STAGING_DIRS:
+            path = self.config.get(key)
+            if path:
+                paths[key] = os.path.abspath(path)
+        return paths
+
+    def resync(self):
+        """
+        Scan all staging directories and read the free space of their filesystems
+        """
+        first = self.last_resync is None
+        # Without a baseline callers have to wait for it, otherwise they go on with the current values
+        if not self.resync_lock.acquire(blocking=first):
+            return
+        try:
+            if first and self.last_resync is not None:
+                return
+            self.scan()
+        finally:
+            self.resync_lock.release()
+
+    def scan(self):
+        time_started = time.time()
+        with self.lock:
+            self.pending = {}
+        used = {key: scan_size(path, self.visit) for key, path in self.paths().items()}
+        with self.lock:
+            for changes in self.pending.values():
+                for key, size in changes.items():
+                    used[key] = used.get(key, 0) + size
+            self.pending = None
+            self.used = used
+            self.last_resync = time.monotonic()
+        self.refresh_free()
+        logger.debug(f"Execution Time: Resync staging storage ({self.total_used()} bytes used): "
+                     f"{time.time() - time_started} seconds")
+
+    def visit(self, directory):
+        """
+        The scan reads directory now, changes reported before are part of the scanned size
+        """
+        with self.lock:
+            self.pending.pop(directory, None)
+
+    def refresh_free(self):
+        devices = {}
+        free = {}
+        for key, path in self.paths().items():
+            try:
+                device = os.stat(path).st_dev
+            except FileNotFoundError:
+                continue
+            devices[key] = device
+            if device not in free:
+                free[device] = shutil.disk_usage(path)[2]
+        with self.lock:
+            self.devices = devices
+            self.free = free
+            self.last_free_refresh = time.monotonic()
+
+    def refresh(self):
+        """
+        Scan again if the resync interval is over (or nothing was scanned yet)
+        """
+        now = time.monotonic()
+        if self.last_resync is None or now - self.last_resync >= self.resync_interval:
+            self.resync()
+        elif now - self.last_free_refresh >= FREE_REFRESH_INTERVAL:
+            self.refresh_free()
+
+    def add(self, key, path, size):
+        """
+        Account a file which was added to a staging directory
+        :param key: config key of the directory, e.g. 'local-data-dir'
+        :param path: path of the file
+        :param size: filesize in bytes
+        """
+        if not size:
+            return
+        with self.lock:
+            if self.pending is not None:
+                changes = self.pending.setdefault(os.path.dirname(os.path.abspath(path)), {})
+                changes[key] = changes.get(key, 0) + size
+            if self.last_resync is None:
+                return
+            self.used[key] = self.used.get(key, 0) + size
+            device = self.devices.get(key)
+            if device in self.free:
+                self.free[device] -= size
+
+    def remove(self, key, path, size):
+        """
+        Account a file which was deleted from a staging directory
+        """
+        self.add(key, path, -size if size else 0)
+
+    def total_used(self):
+        with self.lock:
+            return sum(self.used.values())
+
+    def free_space(self, key):
+        """
+        :return: free bytes on the filesystem of a staging directory
+        """
+        self.refresh()
+        with self.lock:
+            device = self.devices.get(key)
+            if device in self.free:
+                return self.free[device]
+        return shutil.disk_usage(self.config[key])[2]
+
+    def over_max_usage(self, limit, new_file_size=-1):
+        """
+        :param limit: max_storage_usage in bytes
+        :param new_file_size: size of a file which will be added, -1 if unknown
+        :return: True if the staging directories (plus the new file) reach the limit
+        """
+        self.refresh()
+        current_size = self.total_used()
+        if new_file_size == -1:
+            return current_size >= limit
+        return current_size + new_file_size >= limit
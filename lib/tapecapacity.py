@@ -0,0 +1,93 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+## Bytes LTFS needs per file additionally to its data blocks (index entry, extent list)
+FILE_OVERHEAD = 4 * 1024
+
+## Free space is read again from the tape (statvfs) after this many bytes were written
+RECONCILE_BYTES = 10 * 1024 * 1024 * 1024
+
+## Tracked and real free space differing by more than this is logged as warning, 'file-overhead' is too far off
+DRIFT_WARNING_BYTES = 1024 * 1024 * 1024
+
+
+class TapeCapacity:
+    """
+    Free space of the mounted LTFS tape, tracked locally. statvfs on a LTFS mount can block behind index syncs, so it
+    is read once after mounting and then only every 'reconcile-every' bytes or when the tracked free space comes near
+    'tape-keep-free'. In between every written file is subtracted, rounded up to LTFS blocks plus 'file-overhead'.
+    Tracked and real free space are logged at every reconcile to calibrate 'file-overhead' (config 'tape-capacity').
+    """
+    def __init__(self, path, keep_free, file_overhead=FILE_OVERHEAD, reconcile_bytes=RECONCILE_BYTES):
+        """
+        :param path: LTFS mount directory
+        :param keep_free: bytes kept free on tape (tape-keep-free)
+        :param file_overhead: bytes per file additionally to its blocks (parsed by the caller, e.g. 4K)
+        :param reconcile_bytes: read free space from tape again after this many bytes (parsed by the caller, e.g. 10G)
+        """
+        self.path = path
+        self.keep_free = keep_free
+        self.file_overhead = file_overhead
+        self.reconcile_bytes = reconcile_bytes
+        self.block_size = None
+        self.lock = threading.Lock()
+        self.free = 0
+        self.written_bytes = 0
+        self.written_files = 0
+        self.reconcile()
+
+    def statvfs(self):
+        time_started = time.time()
+        st = os.statvfs(self.path)
+        logger.debug(f"Execution Time: Getting tape space info: {time.time() - time_started} seconds")
+        self.block_size = st.f_frsize
+        return st.f_bavail * st.f_frsize
+
+    def reconcile(self):
+        """
+        Read the real free space from tape and log the difference to the tracked free space
+        :return: free bytes on tape
+        """
+        free = self.statvfs()
+        with self.lock:
+            if self.written_files > 0:
+                difference = self.free - free
+                level = logging.WARNING if abs(difference) > DRIFT_WARNING_BYTES else logging.DEBUG
+                logger.log(level, f"Tape free: tracked {self.free}, real {free}, difference {difference} bytes after "
+                                  f"{self.written_files} files ({int(difference / self.written_files)} bytes per file, "
+                                  f"add to 'file-overhead')")
+            self.free = free
+            self.written_bytes = 0
+            self.written_files = 0
+        return free
+
+    def add(self, size):
+        """
+        Account a file which was written to tape
+        :param size: filesize in bytes
+        """
+        blocks = -(-size // self.block_size)
+        with self.lock:
+            self.free -= blocks * self.block_size + self.file_overhead
+            self.written_bytes += size
+            self.written_files += 1
+
+    def free_space(self, next_file_size=0):
+        """
+        Tracked free space, read again from tape if 'reconcile-every' bytes were written since the last read or if the
+        next file would come within 'reconcile-every' bytes of 'tape-keep-free'
+        :param next_file_size: size of the file which will be written next
+        :return: free bytes on tape
+        """
+        with self.lock:
+            free = self.free
+            due = self.written_files > 0 and (
+                self.written_bytes >= self.reconcile_bytes or
+                free - next_file_size - self.keep_free < self.reconcile_bytes)
+        if due:
+            free = self.reconcile()
+        return free
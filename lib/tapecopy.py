@@ -0,0 +1,113 @@
+import hashlib
+import logging
+import mmap
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger()
+
+## Size of one buffer and number of buffers in the ring: up to BLOCK_SIZE * BUFFERS bytes are read ahead
+BLOCK_SIZE = 8 * 1024 * 1024
+BUFFERS = 16
+
+CopyResult = namedtuple('CopyResult', ['size', 'seconds', 'md5', 'stalls'])
+
+_END = object()
+
+
+class CopyEngine:
+    """
+    Copies files to tape with a reader thread and a ring of page aligned buffers (anonymous mmap). The reader fills
+    free buffers from the source file and hashes them, the calling thread only writes full buffers to the
+    destination. A slow moment of the staging disk is covered by the buffers which were read ahead, so the drive
+    keeps streaming instead of stopping and repositioning (shoe-shining).
+    """
+    def __init__(self, block_size=BLOCK_SIZE, buffers=BUFFERS):
+        self.block_size = block_size
+        self.buffers = [mmap.mmap(-1, block_size) for _ in range(max(2, buffers))]
+
+    def close(self):
+        for buffer in self.buffers:
+            buffer.close()
+        self.buffers = []
+
+    def read(self, src, free, full, stop, md5):
+        """
+        Reader thread: fill free buffers from src, hash them and pass them to the writer
+        """
+        try:
+            fd = os.open(src, os.O_RDONLY)
+            try:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while True:
+                    buffer = free.get()
+                    if buffer is None or stop.is_set():
+                        break
+                    count = os.readv(fd, [buffer])
+                    if count == 0:
+                        break
+                    md5.update(memoryview(buffer)[:count])
+                    full.put((buffer, count))
+            finally:
+                os.close(fd)
+            full.put((_END, None))
+        except OSError as e:
+            full.put((_END, e))
+
+    def copy(self, src, dst):
+        """
+        Copy src to dst (permissions and timestamps like shutil.copy2)
+        :return: CopyResult (bytes, seconds, md5sum of the copied bytes, count of waits for the reader)
+        :raises OSError: read or write error, e.g. errno 28 if the tape is full
+        """
+        free = queue.Queue()
+        full = queue.Queue()
+        for buffer in self.buffers:
+            free.put(buffer)
+        stop = threading.Event()
+        md5 = hashlib.md5()
+        size = 0
+        stalls = 0
+
+        time_started = time.time()
+        reader = threading.Thread(target=self.read, args=(src, free, full, stop, md5), name='tape-read',
+                                  daemon=True)
+        reader.start()
+        try:
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                while True:
+                    try:
+                        buffer, count = full.get_nowait()
+                    except queue.Empty:
+                        buffer, count = full.get()
+                        if buffer is not _END:
+                            # Drive had to wait for the staging disk
+                            stalls += 1
+                    if buffer is _END:
+                        if count is not None:
+                            raise count
+                        break
+                    view = memoryview(buffer)[:count]
+                    written = 0
+                    while written < count:
+                        written += os.write(fd, view[written:])
+                    view.release()
+                    size += count
+                    free.put(buffer)
+            finally:
+                os.close(fd)
+        finally:
+            stop.set()
+            # Unblock reader if it waits for a free buffer
+            free.put(None)
+            reader.join()
+        st = os.stat(src)
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.chmod(dst, st.st_mode & 0o7777)
+        # First wait is the start of the copy, not a stall
+        return CopyResult(size, time.time() - time_started, md5.hexdigest(), max(0, stalls - 1))
@@ -0,0 +1,92 @@
+import bisect
+import logging
+from lib import cipher
+
+logger = logging.getLogger()
+
+
+def planned_size(file):
+    """
+    Size of a file or container on tape: filesize_encrypted if it is encrypted already, otherwise predicted from
+    filesize (CBC ciphertext size depends only on the plaintext size)
+    """
+    if file.filesize_encrypted is not None:
+        return file.filesize_encrypted
+    return cipher.encrypted_size(file.filesize or 0)
+
+
+class TapePlan:
+    """
+    Files selected for one tape
+        files: files to write, in the order they were given (database order)
+        remaining: files which don't fit, largest first
+        planned: bytes of files
+        capacity: bytes available on tape (free minus tape-keep-free)
+    """
+    def __init__(self, files, remaining, planned, capacity):
+        self.files = files
+        self.remaining = remaining
+        self.planned = planned
+        self.capacity = capacity
+
+    def fill_ratio(self):
+        return self.planned / self.capacity if self.capacity > 0 else 0.0
+
+
+def plan(files, capacity, size=planned_size):
+    """
+    Select the files for a tape with first fit decreasing: files are placed largest first, every file which still fits
+    is taken (not only the files before the first one which doesn't fit). A filler pass afterwards exchanges placed
+    files with bigger remaining files, as long as the gap on tape is big enough for the difference.
+    :param files: files waiting to be written
+    :param capacity: free bytes on tape minus tape-keep-free
+    :param size: function file -> bytes on tape
+    :return: TapePlan
+    """
+    sizes = [size(file) for file in files]
+    order = sorted(range(len(files)), key=lambda i: sizes[i], reverse=True)
+
+    gap = capacity
+    placed = []
+    remaining = []
+    for i in order:
+        if sizes[i] <= gap:
+            placed.append(i)
+            gap -= sizes[i]
+        else:
+            remaining.append(i)
+
+    # Filler pass: placed files sorted by size, exchange the smallest placed file which leaves room for a remaining one
+    placed.sort(key=lambda i: sizes[i])
+    placed_sizes = [sizes[i] for i in placed]
+    still_remaining = []
+    for i in remaining:
+        position = bisect.bisect_left(placed_sizes, sizes[i] - gap)
+        if gap > 0 and position < len(placed) and placed_sizes[position] < sizes[i]:
+            gap -= sizes[i] - placed_sizes[position]
+            still_remaining.append(placed.pop(position))
+            placed_sizes.pop(position)
+            position = bisect.bisect_left(placed_sizes, sizes[i])
+            placed.insert(position, i)
+            placed_sizes.insert(position, sizes[i])
+        else:
+            still_remaining.append(i)
+
+    still_remaining.sort(key=lambda i: sizes[i], reverse=True)
+    return TapePlan([files[i] for i in sorted(placed)], [files[i] for i in still_remaining], capacity - gap,
+                    capacity)
+
+
+def plan_tapes(files, capacity, size=planned_size):
+    """
+    Plan files onto as many tapes of the same capacity as needed (dry run)
+    :return: tuple (list of TapePlan, files which are bigger than capacity)
+    """
+    plans = []
+    too_big = [file for file in files if size(file) > capacity]
+    files = [file for file in files if size(file) <= capacity]
+    while files:
+        tape_plan = plan(files, capacity, size)
+        plans.append(tape_plan)
+        files = tape_plan.remaining
+    return plans, too_big
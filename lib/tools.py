@@ -1,6 +1,5 @@
 import errno
 import logging
-import hashlib
 import os
 import re
 import math
@@ -8,10 +7,12 @@ import string
 import secrets
 import tarfile
 import xattr
-from functools import partial
+from xml.etree import ElementTree
 from datetime import datetime
 from tabulate import tabulate
 from pathlib import Path
+from lib import hashing, scan, tapeplan
+from lib.storage import StorageLedger
 
 logger = logging.getLogger()
 
@@ -20,18 +21,17 @@ class Tools:
         self.config = config
         #self.database = database
         self.alphabet = string.ascii_letters + string.digits
+        # Used and free bytes of the staging directories, shared by all stages using this instance
+        self.storage = StorageLedger(config)
+        self.hasher = hashing.Hasher(config, self.back_convert_size(
+            str((config.get('hashing') or {}).get('block-size') or hashing.BLOCK_SIZE)))
 
     @staticmethod
     def _md5sum(reader):
-        d = hashlib.md5()
-        for buf in iter(partial(reader.read, 4096), b''):
-            d.update(buf)
-        return d.hexdigest()
+        return hashing.hash_stream(reader)['md5']
 
-    @classmethod
-    def md5sum(cls, filename):
-        with open(filename, mode='rb') as f:
-            return cls._md5sum(f)
+    def md5sum(self, filename):
+        return self.hasher.md5sum(filename)
 
     @classmethod
     def md5sum_tar(cls, archive):
@@ -56,6 +56,48 @@ class Tools:
                     files.append(os.path.join(r, file))
         return files
 
+    def ls_recursive_sorted(self, path):
+        """
+        Generator over all files below path as scan.Entry (path, size, mtime), sorted like 'LC_ALL=C sort' sorts the
+        full paths. Directories are sorted as 'name/', so the order of the whole path string is kept over all levels.
+        """
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    entries.append((f"{entry.name}/", entry.path, None))
+                elif entry.is_file():
+                    entries.append((entry.name, entry.path, entry.stat()))
+        for _, entry_path, st in sorted(entries, key=lambda i: i[0]):
+            if st is None:
+                yield from self.ls_recursive_sorted(entry_path)
+            else:
+                yield scan.Entry(entry_path, st.st_size, st.st_mtime)
+
+    def ssh_command(self):
+        """
+        ssh command with connection multiplexing, all ssh and rsync calls share one connection to remote-server
+        (configured by 'ssh-control-path', empty disables it)
+        """
+        control_path = self.config.get('ssh-control-path', '/tmp/tapebackup-ssh-%C')
+        if not control_path:
+            return ['ssh']
+        return ['ssh', '-o', 'ControlMaster=auto', '-o', f'ControlPath={control_path}', '-o', 'ControlPersist=300']
+
+    def ssh_command_string(self):
+        """
+        ssh command for rsync -e
+        """
+        return ' '.join(self.ssh_command())
+
+    @staticmethod
+    def sorted_shell_command(command, sort_options=''):
+        """
+        Wrap a (remote) shell command, so its output gets sorted with 'LC_ALL=C sort' but the exit code of the
+        command itself is returned instead of the exit code of sort
+        """
+        return f"{{ rc=$( {{ {{ {command}; echo $? >&3; }} | LC_ALL=C sort {sort_options} >&4; }} 3>&1 ); exit $rc; }} 4>&1"
+
     @staticmethod
     def convert_size(size_bytes):
         if size_bytes is None or size_bytes == 0:
@@ -94,22 +136,14 @@ class Tools:
         return total
 
     def calculate_over_max_storage_usage(self, new_file_size):
+        """
+        Check max_storage_usage against the used size of the staging directories (from self.storage, not scanned
+        on every call)
+        :param new_file_size: size of a file which will be added, -1 if unknown
+        """
         if self.config['max_storage_usage'] == '' or self.config['max_storage_usage'] is None:
             return False
-        current_size = self.folder_size(self.config['local-data-dir']) \
-                       + self.folder_size(self.config['local-enc-dir']) \
-                       + self.folder_size(self.config['local-verify-dir'])
-
-        if new_file_size == -1:
-            if current_size >= self.back_convert_size(self.config['max_storage_usage']):
-                return True
-            else:
-                return False
-        else:
-            if (current_size + new_file_size) >= self.back_convert_size(self.config['max_storage_usage']):
-                return True
-            else:
-                return False
+        return self.storage.over_max_usage(self.back_convert_size(self.config['max_storage_usage']), new_file_size)
 
     @staticmethod
     def datetime_from_db(field):
@@ -145,41 +179,82 @@ class Tools:
         table = tabulate(data, headers=headers, tablefmt='grid')
         print(table)
 
-    def order_by_startblock(self, files):
+    @staticmethod
+    def ltfs_startblock(path):
+        """
+        Start block of a file on LTFS (xattr ltfs.startblock)
+        :return: block number or None if the filesystem has no such attribute
+        """
+        try:
+            return int(xattr.getxattr(str(path), 'ltfs.startblock'))
+        except OSError as e:
+            if e.errno in (errno.ENODATA, errno.ENOTSUP):
+                return None
+            raise
+
+    def order_by_startblock(self, files, members=None):
+        """
+        Sort files by their position on tape. The start block is taken from database (tapeposition, recorded while
+        writing or by 'tape reindex'), only files without it are looked up on the mounted tape.
+        :param members: dict file id -> ContainerMember, members of a container are sorted by the start of the
+                        container and their offset in it
+        """
+        if members is None:
+            members = {}
+        starts = {}
         start_and_files = list()
         for file in files:
-            src = Path(self.config['local-tape-mount-dir']) / file.filename_encrypted
-
-            try:
-                start_str = xattr.getxattr(src.resolve(), 'ltfs.startblock')
-                start = int(start_str)
-            except OSError as e:
-                if e.errno == errno.ENODATA:
-                    logging.debug(f'No xattrs available for {file.filename_encrypted}, falling back to inode ordering')
-                    stat_result = src.stat()
-                    start = stat_result.st_ino
-                else:
-                    raise
+            member = members.get(file.id)
+            piece = member.container if member is not None else file
+            filename_encrypted = piece.filename_encrypted
+            src = Path(self.config['local-tape-mount-dir']) / filename_encrypted
+
+            if piece.tapeposition is not None:
+                starts[filename_encrypted] = piece.tapeposition
+            elif filename_encrypted not in starts:
+                start = self.ltfs_startblock(src.resolve())
+                if start is None:
+                    logging.debug(f'No xattrs available for {filename_encrypted}, falling back to inode ordering')
+                    start = src.stat().st_ino
+                starts[filename_encrypted] = start
+            start = starts[filename_encrypted]
 
             logger.debug(f'{src} starts at {start}')
-            start_and_files.append((start, file))
+            start_and_files.append(((start, member.offset if member is not None else 0), file))
 
         return [y for x,y in sorted(start_and_files, key=lambda i: i[0])]
 
     @staticmethod
     def count_files_fit_on_tape(filelist, free_space):
         """
-        Get a count of files that will be written to tape
+        Get a count of files that will be written to tape (see tapeplan.plan)
         :param filelist: list of files that could be written to tape
         :param free_space: current free space minus preserved on target tape
         :return: Integer: count of files
         """
-        cur_space = 0
-        count = 0
-        for file in filelist:
-            if (cur_space + file.filesize) < free_space:
-                cur_space += file.filesize
-                count += 1
-            else:
-                return count
-        return count
+        return len(tapeplan.plan(filelist, free_space).files)
+
+    @staticmethod
+    def parse_ltfs_index(index_file):
+        """
+        Read start block and length of all files from a LTFS index (XML). The index is read incrementally, it can
+        contain millions of files.
+        :return: dict filename -> (startblock, length), startblock of the first extent, None for empty files
+        """
+        positions = {}
+        parents = []
+        for event, element in ElementTree.iterparse(index_file, events=('start', 'end')):
+            if event == 'start':
+                parents.append(element)
+                continue
+            parents.pop()
+            if element.tag != 'file':
+                continue
+            name = element.findtext('name')
+            length = int(element.findtext('length') or 0)
+            extents = [(int(extent.findtext('fileoffset') or 0), int(extent.findtext('startblock')))
+                       for extent in element.iter('extent')]
+            positions[name] = (min(extents)[1] if extents else None, length)
+            # Drop parsed files, so memory doesn't grow with the index
+            parents[-1].remove(element)
+        return positions
@@ -0,0 +1,153 @@
+import logging
+import time
+from sqlalchemy import text
+from lib import database
+from lib.models import Config, Container, ContainerMember, Directory, File, Fingerprint, RestoreJobFileMap
+
+logger = logging.getLogger()
+
+
+def create_indexes(engine, table, names):
+    """
+    Create indexes of a table which are defined in the model but missing in database
+    :param names: names of the indexes, later versions add their own indexes
+    """
+    with engine.connect() as connection:
+        existing = {row[1] for row in connection.execute(text(f"PRAGMA index_list({table.name})"))}
+    for index in table.indexes:
+        if index.name not in names or index.name in existing:
+            continue
+        time_started = time.time()
+        index.create(bind=engine)
+        logger.info(f"Index {index.name} on table {table.name} created")
+        logger.debug(f"Execution Time: Create index {index.name}: {time.time() - time_started} seconds")
+
+
+def add_columns(engine, table, names):
+    """
+    Add columns of a table which are defined in the model but missing in database
+    """
+    with engine.begin() as connection:
+        existing = {row[1] for row in connection.execute(text(f"PRAGMA table_info({table.name})"))}
+        for name in names:
+            if name in existing:
+                continue
+            column = table.columns[name]
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                                    f"{column.type.compile(dialect=engine.dialect)}"))
+            logger.info(f"Column {column.name} added to table {table.name}")
+
+
+def upgrade_to_2(engine):
+    """
+    Indexes for md5sum lookups, state flags (to be encrypted/written), tape and restore job queries
+    """
+    create_indexes(engine, File.__table__, ['ix_file_md5sum_file', 'ix_file_tape_id', 'ix_file_state',
+                                            'ix_file_pending'])
+    create_indexes(engine, RestoreJobFileMap.__table__, ['ix_restore_job_file_map_restore_job_id'])
+    # Statistics for the query planner, so it can choose between the full and the partial state index
+    with engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+
+
+def upgrade_to_3(engine):
+    """
+    Index on filesize for the duplicate check before download
+    """
+    create_indexes(engine, File.__table__, ['ix_file_filesize'])
+
+
+def upgrade_to_4(engine):
+    """
+    Directory table for get-scan-directories
+    """
+    Directory.__table__.create(bind=engine, checkfirst=True)
+    logger.info("Table directory created")
+
+
+def upgrade_to_5(engine):
+    """
+    Columns for a stronger digest of the file (config 'hashing: digest')
+    """
+    add_columns(engine, File.__table__, ['digest_file', 'digest_algorithm'])
+
+
+def upgrade_to_6(engine):
+    """
+    Fingerprint table, digests of local files by device, inode, size and mtime
+    """
+    Fingerprint.__table__.create(bind=engine, checkfirst=True)
+    logger.info("Table fingerprint created")
+
+
+def upgrade_to_7(engine):
+    """
+    Size of interrupted downloads, which are resumed by the next get
+    """
+    add_columns(engine, File.__table__, ['partial_size'])
+
+
+def upgrade_to_8(engine):
+    """
+    Container tables, small files packed into one encrypted file (config 'container')
+    """
+    Container.__table__.create(bind=engine, checkfirst=True)
+    ContainerMember.__table__.create(bind=engine, checkfirst=True)
+    logger.info("Tables container and container_member created")
+
+
+def upgrade_to_9(engine):
+    """
+    LTFS start block of containers (files use tapeposition), run './main.py tape reindex' for tapes written before
+    """
+    add_columns(engine, Container.__table__, ['tapeposition'])
+
+
+## Database model version: function which upgrades from the previous version
+UPGRADES = {
+    2: upgrade_to_2,
+    3: upgrade_to_3,
+    4: upgrade_to_4,
+    5: upgrade_to_5,
+    6: upgrade_to_6,
+    7: upgrade_to_7,
+    8: upgrade_to_8,
+    9: upgrade_to_9,
+}
+
+
+def current_version(session):
+    version = session.query(Config).filter(Config.name == 'version').first()
+    return None if version is None else int(version.value)
+
+
+def upgrade(engine, db_version):
+    """
+    Run all upgrades from the version in database up to db_version, the version is stored after every step
+    :return: True if database is on db_version
+    """
+    session = database.create_session(engine)
+    version = current_version(session)
+    if version is None:
+        logger.error("No database version found, please run './main.py db migrate' first")
+        session.close()
+        return False
+
+    if version == db_version:
+        logger.info(f"Database is already on version {db_version}")
+    elif version > db_version:
+        logger.error(f"Database version {version} is newer than this program ({db_version}), please update")
+        session.close()
+        return False
+
+    for next_version in range(version + 1, db_version + 1):
+        logger.info(f"Upgrading database from version {next_version - 1} to {next_version}")
+        time_started = time.time()
+        UPGRADES[next_version](engine)
+        database.insert_or_update_db_version(session, next_version)
+        logger.info(f"Database upgraded to version {next_version}")
+        logger.debug(f"Execution Time: Upgrade database to version {next_version}: {time.time() - time_started} "
+                     f"seconds")
+
+    session.close()
+    return True
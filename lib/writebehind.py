@@ -0,0 +1,171 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from sqlalchemy import delete, insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from lib.decorators import count_retry
+
+logger = logging.getLogger()
+
+_STOP = object()
+_UPSERT = object()
+_DELETE = object()
+
+
+class WriteBehind:
+    """
+    Single database writer for updates from worker threads.
+
+    Updates are queued (model + dict with primary key 'id') and written by one thread in batches: all updates
+    collected within flush_interval seconds (or flush_size updates) are written with executemany and committed
+    once. Rows queued with upsert() are inserted (or replaced on a unique conflict) and rows queued with delete()
+    are deleted in the same transaction. barrier() blocks until everything queued before was committed, use it
+    before any action that relies on the database state (e.g. deleting a local file after it was marked as
+    written).
+    """
+    def __init__(self, engine, flush_interval=2.0, flush_size=500, max_retries=10, sleeptime=1):
+        self.session = sessionmaker(bind=engine)()
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_retries = max_retries
+        self.sleeptime = sleeptime
+        self.queue = queue.Queue()
+        self.failed = False
+        self.thread = threading.Thread(target=self.run, name='db-writer', daemon=True)
+        self.thread.start()
+
+    def update(self, model, values):
+        """
+        Queue an update of one row
+        :param model: orm model class
+        :param values: dict of column values, must contain the primary key 'id'
+        """
+        self.queue.put((model, values))
+
+    def upsert(self, model, values):
+        """
+        Queue an insert of one row, an existing row with the same unique key is replaced (INSERT OR REPLACE)
+        :param model: orm model class
+        :param values: dict of column values
+        """
+        self.queue.put((_UPSERT, (model, values)))
+
+    def delete(self, model, values):
+        """
+        Queue a delete of the rows which have all the given column values
+        :param model: orm model class
+        :param values: dict of column values
+        """
+        self.queue.put((_DELETE, (model, values)))
+
+    def barrier(self):
+        """
+        Block until all updates queued until now are committed
+        :return: False if writing failed. A failure stays reported by all later barriers: the lost updates leave the
+                 database behind the files, nothing relying on it is safe until './main.py db repair' was run.
+        """
+        event = threading.Event()
+        self.queue.put((None, event))
+        while not event.wait(1):
+            # Writer thread stopped, nobody will set the event anymore
+            if not self.thread.is_alive():
+                logger.error("Database writer thread is not running anymore")
+                self.failed = True
+                break
+        return not self.failed
+
+    def close(self):
+        """
+        Write all pending updates and stop writer thread
+        """
+        if self.thread.is_alive():
+            self.barrier()
+            self.queue.put((_STOP, None))
+            self.thread.join()
+        self.session.close()
+
+    def run(self):
+        stop = False
+        while not stop:
+            model, values = self.queue.get()
+            updates = []
+            barriers = []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if model is _STOP:
+                    stop = True
+                    break
+                if model is None:
+                    barriers.append(values)
+                    break
+                updates.append((model, values))
+                if len(updates) >= self.flush_size:
+                    break
+                try:
+                    model, values = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            try:
+                if updates:
+                    self.flush(updates)
+            finally:
+                for event in barriers:
+                    event.set()
+
+    def flush(self, updates):
+        """
+        Write collected updates in one transaction, in the order they were queued. Consecutive operations of the same
+        kind and model are written together, several updates of the same row within them are merged.
+        """
+        steps = []
+        for model, values in updates:
+            kind = None
+            if model is _UPSERT or model is _DELETE:
+                kind, (model, values) = model, values
+            if not steps or steps[-1][0] is not kind or steps[-1][1] is not model:
+                steps.append((kind, model, {} if kind is None else []))
+            rows = steps[-1][2]
+            if kind is None:
+                rows.setdefault(values['id'], {}).update(values)
+            else:
+                rows.append(values)
+
+        time_started = time.time()
+        for attempt in range(self.max_retries):
+            try:
+                for kind, model, rows in steps:
+                    if kind is None:
+                        self.session.bulk_update_mappings(model, list(rows.values()))
+                    elif kind is _UPSERT:
+                        self.session.execute(insert(model.__table__).prefix_with('OR REPLACE'), rows)
+                    else:
+                        for values in rows:
+                            self.session.execute(delete(model.__table__).where(
+                                *[model.__table__.c[column] == value for column, value in values.items()]))
+                self.session.commit()
+                break
+            except (OperationalError, sqlite3.OperationalError) as e:
+                self.session.rollback()
+                count_retry()
+                if attempt == self.max_retries - 1:
+                    logger.error("Database locked, giving up writing %s updates. (%s/%s). Error: %s",
+                                 len(updates), attempt + 1, self.max_retries, e)
+                    logger.error("Please run ./main.py db repair to remove stale entries!")
+                    self.failed = True
+                    return
+                logger.warning("Database locked, waiting %s seconds for next retry (%s/%s).",
+                               self.sleeptime, attempt + 1, self.max_retries)
+                time.sleep(self.sleeptime)
+            except Exception as e:
+                # Not retried (e.g. IntegrityError), the writer thread keeps running for the next updates
+                self.session.rollback()
+                logger.error("Writing %s updates failed. Error: %s", len(updates), e)
+                logger.error("Please run ./main.py db repair to remove stale entries!")
+                self.failed = True
+                return
+        logger.debug(f"Execution Time: Write-behind flushed {len(updates)} updates: {time.time() - time_started} "
+                     f"seconds")
@@ -6,14 +6,15 @@ import logging
 import argparse
 import os
 import signal
+import threading
 import psutil
-from lib import database
+from lib import database, hashing
 from lib import Tapelibrary, Tools
 
 
 pname = "Tapebackup"
 pversion = '0.2'
-db_model_version = 1
+db_model_version = 9
 logger_format = '[%(levelname)-7s] (%(asctime)s) %(filename)s::%(lineno)d %(message)s'
 log_dir = 'logs'
 debug = False
@@ -57,10 +58,15 @@ def signal_handler(signalo, frame):
         for process in children:
             process.send_signal(signal.SIGTERM)
 
+        # Drop queued jobs, running ones end with their subprocesses
+        scheduler = getattr(current_class, 'scheduler', None)
+        if scheduler is not None:
+            threading.Thread(target=scheduler.shutdown, kwargs={'wait': False}, name='shutdown').start()
         sys.exit(1)
     else:
         interrupted = True
-        current_class.set_interrupted()
+        # Not called in the signal handler itself, the main thread can hold locks set_interrupted() needs
+        threading.Thread(target=current_class.set_interrupted, name='interrupt').start()
         print(' I will stop after current Operation!')
 
 signal.signal(signal.SIGINT, signal_handler)
@@ -138,6 +144,13 @@ def check_requirements():
         sys.exit(0)
 
 
+def check_config():
+    digest = (cfg.get('hashing') or {}).get('digest')
+    if digest and digest not in hashing.DIGESTS:
+        logger.error(f"Unknown digest in config 'hashing': {digest}, possible: {', '.join(hashing.DIGESTS)}")
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Tape backup from remote or local server to tape library")
     parser.add_argument("-v", "--version", action="store_true", help="Show version and exit")
@@ -165,12 +178,18 @@ if __name__ == "__main__":
     subparsers = parser.add_subparsers(title='Commands', dest='command')
     subparser_get = subparsers.add_parser('get', help='Get Files from remote Server')
     subparser_get.add_argument('-f', '--file', type=str, help='Take filelist from file (one file per line -> full path), instead of building filelist itself')
+    subparser_get.add_argument('-w', '--watch', action="store_true", help="Only with '--local': Keep running and add new files as soon as they are written (inotify)")
     subparser_encrypt = subparsers.add_parser('encrypt',
                                               help='Enrypt files and build directory for one tape media size')
     subparser_write = subparsers.add_parser('write', help='Write directory into')
     subparser_write.add_argument("-d", "--delete-after-write", action="store_true",
                                         help="Delete encrypted file directly after writing to tape to save space [Default: Deleting files after a tape is full and verified]")
 
+    subparser_pipeline = subparsers.add_parser('pipeline', help='Get, encrypt and write files to tape at the same time')
+    subparser_pipeline.add_argument('-f', '--file', type=str, help='Take filelist from file (one file per line -> full path), instead of building filelist itself')
+    subparser_pipeline.add_argument("-d", "--delete-after-write", action="store_true",
+                                    help="Delete encrypted file directly after writing to tape to save space [Default: Deleting files after a tape is full and verified]")
+
     subparser_verify = subparsers.add_parser('verify', help='Verify Files (random or given filename) on Tape')
     subparser_verify_group = subparser_verify.add_mutually_exclusive_group(required=True)
     subparser_verify_group.add_argument("-f", "--file", type=str, nargs='?', const='',
@@ -216,11 +235,27 @@ if __name__ == "__main__":
     subsubparser_db.add_parser('backup', help='Backup SQLite DB to given GIT repo')
     subsubparser_db.add_parser('status', help='Show SQLite Information')
     subsubparser_db.add_parser('migrate', help='Migrate database from schema pre version 0.3')
+    subsubparser_db.add_parser('upgrade', help='Upgrade database model to current version (e.g. new indexes)')
+
+    subparser_bench = subparsers.add_parser('bench', help='Benchmarks')
+    subsubparser_bench = subparser_bench.add_subparsers(title='Subcommands', dest='command_sub')
+    subparser_bench_db = subsubparser_bench.add_parser('db', help='Compare database profiles (lock retries) with concurrent get threads')
+    subparser_bench_db.add_argument("-t", "--threads", type=int, default=8, help="Number of concurrent threads [Default: 8]")
+    subparser_bench_db.add_argument("-n", "--files", type=int, default=200, help="Number of files per thread [Default: 200]")
+    subparser_bench_hash = subsubparser_bench.add_parser('hash', help='Compare hashing speed (old md5sum, readinto, mmap, threads) on local-data-dir')
+    subparser_bench_hash.add_argument("-s", "--size", type=str, default="1G", help="Size of every test file, Number[Unit] [Default: 1G]")
+    subparser_bench_hash.add_argument("-n", "--files", type=int, default=4, help="Number of test files [Default: 4]")
 
     subparser_tape = subparsers.add_parser('tape', help='Tapelibrary operations')
     subsubparser_tape = subparser_tape.add_subparsers(title='Subcommands', dest='command_sub')
     subsubparser_tape.add_parser('info', help='Get Informations about Tapes and Devices')
     subsubparser_tape.add_parser('status', help='Get Informations about Tapes (offline/online and to be removed)')
+    subparser_tape_reindex = subsubparser_tape.add_parser('reindex', help='Store start blocks of all files on a tape in database (for restore and verify ordering)')
+    subparser_tape_reindex.add_argument("-i", "--index", type=str, help="LTFS index (XML) of the tape [Default: read from mounted tape]")
+    subparser_tape_reindex.add_argument('label', type=str, help='Label of tape')
+    subparser_tape_plan = subsubparser_tape.add_parser('plan', help='Dry run: show how pending files would be packed onto tapes')
+    subparser_tape_plan.add_argument("-s", "--size", type=str, help="Tape capacity, Number[Unit] [Default: free space of mounted tape]")
+    subparser_tape_plan.add_argument("-e", "--encrypted-only", action="store_true", help="Only plan encrypted files, ignore files waiting for encryption")
 
     subparser_config = subparsers.add_parser('config', help='Configuration operations')
     subsubparser_config = subparser_config.add_subparsers(title='Subcommands', dest='command_sub')
@@ -256,6 +291,7 @@ if __name__ == "__main__":
     with open(cfgfile, 'r') as ymlfile:
         cfg = yaml.full_load(ymlfile)
 
+    check_config()
     if args.command != "db" and args.command != "config" and args.command != "debug":
         check_requirements()
     else:
@@ -263,7 +299,7 @@ if __name__ == "__main__":
             check_requirements()
 
     # Init database
-    db_engine = database.init(cfg['database'], db_model_version)
+    db_engine = database.init(cfg['database'], db_model_version, cfg.get('database-tuning'))
     if not db_engine:
         if args.command == "db":
             if args.command_sub != "migrate" and args.command_sub != "upgrade":
@@ -286,7 +322,10 @@ if __name__ == "__main__":
 
         from functions.files import Files
         current_class = Files(cfg, db_engine, tapelibrary, tools, args.local)
-        current_class.get(args.file)
+        if args.watch:
+            current_class.watch()
+        else:
+            current_class.get(args.file)
 
     elif args.command == "encrypt":
         logger.info("Starting encrypt operation, logging into logs/encrypt.log")
@@ -306,6 +345,15 @@ if __name__ == "__main__":
         current_class = Tape(cfg, db_engine, tapelibrary, tools)
         current_class.write(delete_after_write=args.delete_after_write)
 
+    elif args.command == "pipeline":
+        logger.info("Starting pipeline operation, logging into logs/pipeline.log")
+        change_logger_filehandler('pipeline.log')
+        logger.info("########## NEW SESSION ##########")
+
+        from functions.pipeline import Pipeline
+        current_class = Pipeline(cfg, db_engine, tapelibrary, tools, args.local)
+        current_class.run(args.file, delete_after_write=args.delete_after_write)
+
     elif args.command == "verify":
         logger.info("Starting verify operation, logging into logs/verify.log")
         change_logger_filehandler('verify.log')
@@ -386,6 +434,10 @@ if __name__ == "__main__":
             current_class.info()
         elif args.command_sub == "status":
             current_class.status()
+        elif args.command_sub == "plan":
+            current_class.plan(args.size, args.encrypted_only)
+        elif args.command_sub == "reindex":
+            current_class.reindex(args.label, args.index)
         elif args.command_sub is None:
             subparser_tape.print_help()
 
@@ -395,6 +447,9 @@ if __name__ == "__main__":
         logger.info("########## NEW SESSION ##########")
 
         from functions.db import Db
+        if not db_engine:
+            # Database needs migration or upgrade, connect without version check
+            db_engine = database.connect(cfg['database'], cfg.get('database-tuning'))
         current_class = Db(cfg, db_engine, tapelibrary, tools)
         if args.command_sub == "repair":
             current_class.repair()
@@ -407,9 +462,25 @@ if __name__ == "__main__":
             current_class.backup()
         elif args.command_sub == "migrate":
             current_class.migrate(db_model_version)
+        elif args.command_sub == "upgrade":
+            current_class.upgrade(db_model_version)
         elif args.command_sub is None:
             subparser_db.print_help()
 
+    elif args.command == "bench":
+        logger.info("Starting bench operation, logging into logs/bench.log")
+        change_logger_filehandler('bench.log')
+        logger.info("########## NEW SESSION ##########")
+
+        from functions.bench import Bench
+        current_class = Bench(cfg, db_engine, tapelibrary, tools)
+        if args.command_sub == "db":
+            current_class.db(args.threads, args.files)
+        elif args.command_sub == "hash":
+            current_class.hash(args.size, args.files)
+        elif args.command_sub is None:
+            subparser_bench.print_help()
+
     elif args.command == "config":
         if args.command_sub == "create_key":
             create_key()